@@ -0,0 +1,21 @@
+"""
+Django app configuration.
+"""
+
+import threading
+
+from django.apps import AppConfig
+
+from django_python3_ldap.conf import settings
+
+
+class DjangoPython3LdapConfig(AppConfig):
+
+    name = "django_python3_ldap"
+    verbose_name = "Django Python3 LDAP"
+
+    def ready(self):
+        # Connect to the LDAP servers in the background, so startup isn't blocked.
+        if settings.LDAP_AUTH_WARM_UP:
+            from django_python3_ldap.ldap import warm_up
+            threading.Thread(target=warm_up, name="django_python3_ldap.warm_up", daemon=True).start()
@@ -1,18 +1,48 @@
 """
 Django authentication backend.
 """
+import asyncio
+import copy
+import weakref
+
 from asgiref.sync import sync_to_async
 from django.contrib.auth.backends import ModelBackend
 
 from django_python3_ldap import ldap
+from django_python3_ldap.conf import settings
+
+
+# Event loop -> {authentication key: task}.
+_authentication_tasks = weakref.WeakKeyDictionary()
 
 
 @sync_to_async
-def run_authentication_async(*args, **kwargs):
+def _run_authentication(*args, **kwargs):
+    return ldap.authenticate(*args, **kwargs)
+
+
+async def run_authentication_async(*args, **kwargs):
     """
     Executes the ldap.authenticate function, wrapped in asynchronous execution.
+
+    If LDAP_AUTH_COALESCE_AUTHENTICATION is enabled, concurrent identical
+    authentication attempts on the same event loop await a single call.
     """
-    return ldap.authenticate(*args, **kwargs)
+    if not settings.LDAP_AUTH_COALESCE_AUTHENTICATION:
+        return await _run_authentication(*args, **kwargs)
+    key = ldap.get_authentication_key(**kwargs)
+    if key is None:
+        return await _run_authentication(*args, **kwargs)
+    tasks = _authentication_tasks.setdefault(asyncio.get_running_loop(), {})
+    task = tasks.get(key)
+    shared = task is not None
+    if not shared:
+        task = tasks[key] = asyncio.ensure_future(_run_authentication(*args, **kwargs))
+        task.add_done_callback(lambda task: tasks.pop(key, None))
+    # Cancelling one caller must not cancel the call shared with the others.
+    user = await asyncio.shield(task)
+    # Give each caller its own user instance.
+    return copy.copy(user) if shared else user
 
 
 class LDAPBackend(ModelBackend):
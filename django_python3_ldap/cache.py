@@ -0,0 +1,135 @@
+"""
+In-process caches, with an optional shared Django cache tier.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from django_python3_ldap.conf import settings
+
+
+class TTLCache(object):
+
+    """
+    A thread-safe, size-bounded LRU cache whose items expire
+    after a time to live.
+    """
+
+    def __init__(self):
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl, maxsize):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class TieredCache(object):
+
+    """
+    An in-process TTLCache, backed by an optional shared Django cache.
+
+    The cache is configured by the names of the settings holding its
+    time to live, maximum in-process size and Django cache alias. Settings
+    are read on every call, so they can be changed at runtime. A time to
+    live of zero or None disables the cache.
+    """
+
+    def __init__(self, key_prefix, ttl_setting, maxsize_setting, alias_setting):
+        self._key_prefix = key_prefix
+        self._ttl_setting = ttl_setting
+        self._maxsize_setting = maxsize_setting
+        self._alias_setting = alias_setting
+        self._local = TTLCache()
+
+    @property
+    def ttl(self):
+        return getattr(settings, self._ttl_setting)
+
+    def _get_shared_cache(self):
+        alias = getattr(settings, self._alias_setting)
+        return caches[alias] if alias else None
+
+    def _make_shared_key(self, key):
+        return "{key_prefix}:{digest}".format(
+            key_prefix=self._key_prefix,
+            digest=hashlib.sha256(repr(key).encode("utf-8")).hexdigest(),
+        )
+
+    def get(self, key):
+        """
+        Returns the cached value for the given key, or None.
+        """
+        if not self.ttl:
+            return None
+        value = self._local.get(key)
+        if value is None:
+            shared_cache = self._get_shared_cache()
+            if shared_cache is not None:
+                value = shared_cache.get(self._make_shared_key(key))
+                if value is not None:
+                    self._local.set(key, value, self.ttl, getattr(settings, self._maxsize_setting))
+        return value
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+        self._local.set(key, value, self.ttl, getattr(settings, self._maxsize_setting))
+        shared_cache = self._get_shared_cache()
+        if shared_cache is not None:
+            shared_cache.set(self._make_shared_key(key), value, self.ttl)
+
+    def delete(self, key):
+        self._local.delete(key)
+        shared_cache = self._get_shared_cache()
+        if shared_cache is not None:
+            shared_cache.delete(self._make_shared_key(key))
+
+    def delete_many(self, keys):
+        """
+        Deletes the given keys, with a single round trip to the shared cache.
+        """
+        keys = list(keys)
+        if not keys:
+            return
+        for key in keys:
+            self._local.delete(key)
+        shared_cache = self._get_shared_cache()
+        if shared_cache is not None:
+            shared_cache.delete_many([self._make_shared_key(key) for key in keys])
+
+    def clear(self):
+        """
+        Clears the in-process cache.
+        """
+        self._local.clear()
@@ -1,15 +1,25 @@
 """
 Settings used by django-python3.
 """
+import contextvars
+from contextlib import contextmanager
 from ssl import PROTOCOL_TLS
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+# A tuple of (directory name, settings) for the directory in use, or None.
+_directory = contextvars.ContextVar("django_python3_ldap.directory", default=None)
 
 
 class LazySetting(object):
 
     """
     A proxy to a named Django setting.
+
+    Within use_directory(), settings given for the directory
+    in LDAP_AUTH_DIRECTORIES take precedence.
     """
 
     def __init__(self, name, default=None):
@@ -19,6 +29,9 @@ class LazySetting(object):
     def __get__(self, obj, cls):
         if obj is None:
             return self
+        directory = _directory.get()
+        if directory is not None and self.name in directory[1]:
+            return directory[1][self.name]
         return getattr(obj._settings, self.name, self.default)
 
 
@@ -64,6 +77,11 @@ class LazySettings(object):
         default="ou=people,dc=example,dc=com",
     )
 
+    LDAP_AUTH_SEARCH_BASES_CONCURRENT = LazySetting(
+        name="LDAP_AUTH_SEARCH_BASES_CONCURRENT",
+        default=False,
+    )
+
     LDAP_AUTH_OBJECT_CLASS = LazySetting(
         name="LDAP_AUTH_OBJECT_CLASS",
         default="inetOrgPerson",
@@ -79,6 +97,16 @@ class LazySettings(object):
         },
     )
 
+    LDAP_AUTH_SEARCH_ATTRIBUTES = LazySetting(
+        name="LDAP_AUTH_SEARCH_ATTRIBUTES",
+        default=None,
+    )
+
+    LDAP_AUTH_LAZY_ATTRIBUTES = LazySetting(
+        name="LDAP_AUTH_LAZY_ATTRIBUTES",
+        default=(),
+    )
+
     LDAP_AUTH_USER_LOOKUP_FIELDS = LazySetting(
         name="LDAP_AUTH_USER_LOOKUP_FIELDS",
         default=(
@@ -136,6 +164,166 @@ class LazySettings(object):
         default=None,
     )
 
+    LDAP_AUTH_SEARCH_BIND = LazySetting(
+        name="LDAP_AUTH_SEARCH_BIND",
+        default=False,
+    )
+
+    LDAP_AUTH_DN_CACHE_TTL = LazySetting(
+        name="LDAP_AUTH_DN_CACHE_TTL",
+        default=3600,
+    )
+
+    LDAP_AUTH_DN_CACHE_MAX_SIZE = LazySetting(
+        name="LDAP_AUTH_DN_CACHE_MAX_SIZE",
+        default=10000,
+    )
+
+    LDAP_AUTH_DN_CACHE_ALIAS = LazySetting(
+        name="LDAP_AUTH_DN_CACHE_ALIAS",
+        default=None,
+    )
+
+    LDAP_AUTH_NEGATIVE_CACHE_TTL = LazySetting(
+        name="LDAP_AUTH_NEGATIVE_CACHE_TTL",
+        default=0,
+    )
+
+    LDAP_AUTH_NEGATIVE_CACHE_MAX_SIZE = LazySetting(
+        name="LDAP_AUTH_NEGATIVE_CACHE_MAX_SIZE",
+        default=10000,
+    )
+
+    LDAP_AUTH_NEGATIVE_CACHE_ALIAS = LazySetting(
+        name="LDAP_AUTH_NEGATIVE_CACHE_ALIAS",
+        default=None,
+    )
+
+    LDAP_AUTH_ATTRIBUTE_REFRESH_TTL = LazySetting(
+        name="LDAP_AUTH_ATTRIBUTE_REFRESH_TTL",
+        default=0,
+    )
+
+    LDAP_AUTH_ATTRIBUTE_REFRESH_MAX_SIZE = LazySetting(
+        name="LDAP_AUTH_ATTRIBUTE_REFRESH_MAX_SIZE",
+        default=10000,
+    )
+
+    LDAP_AUTH_ATTRIBUTE_REFRESH_ALIAS = LazySetting(
+        name="LDAP_AUTH_ATTRIBUTE_REFRESH_ALIAS",
+        default=None,
+    )
+
+    LDAP_AUTH_ATTRIBUTE_REFRESH_BACKGROUND = LazySetting(
+        name="LDAP_AUTH_ATTRIBUTE_REFRESH_BACKGROUND",
+        default=False,
+    )
+
+    LDAP_AUTH_ATTRIBUTE_REFRESH_WORKERS = LazySetting(
+        name="LDAP_AUTH_ATTRIBUTE_REFRESH_WORKERS",
+        default=2,
+    )
+
+    LDAP_AUTH_ATTRIBUTE_REFRESH_QUEUE_SIZE = LazySetting(
+        name="LDAP_AUTH_ATTRIBUTE_REFRESH_QUEUE_SIZE",
+        default=1000,
+    )
+
+    LDAP_AUTH_THROTTLE_USER_RATE = LazySetting(
+        name="LDAP_AUTH_THROTTLE_USER_RATE",
+        default=None,
+    )
+
+    LDAP_AUTH_THROTTLE_CLIENT_RATE = LazySetting(
+        name="LDAP_AUTH_THROTTLE_CLIENT_RATE",
+        default=None,
+    )
+
+    LDAP_AUTH_THROTTLE_CLIENT_KEY = LazySetting(
+        name="LDAP_AUTH_THROTTLE_CLIENT_KEY",
+        default="django_python3_ldap.throttle.get_client_ip",
+    )
+
+    LDAP_AUTH_THROTTLE_CACHE_ALIAS = LazySetting(
+        name="LDAP_AUTH_THROTTLE_CACHE_ALIAS",
+        default="default",
+    )
+
+    LDAP_AUTH_COALESCE_AUTHENTICATION = LazySetting(
+        name="LDAP_AUTH_COALESCE_AUTHENTICATION",
+        default=False,
+    )
+
+    LDAP_AUTH_WARM_UP = LazySetting(
+        name="LDAP_AUTH_WARM_UP",
+        default=False,
+    )
+
+    LDAP_AUTH_SLOW_OPERATION_THRESHOLD = LazySetting(
+        name="LDAP_AUTH_SLOW_OPERATION_THRESHOLD",
+        default=None,
+    )
+
+    LDAP_AUTH_SLOW_OPERATION_SAMPLE_RATE = LazySetting(
+        name="LDAP_AUTH_SLOW_OPERATION_SAMPLE_RATE",
+        default=1.0,
+    )
+
+    LDAP_AUTH_SLOW_OPERATION_RATE_LIMIT = LazySetting(
+        name="LDAP_AUTH_SLOW_OPERATION_RATE_LIMIT",
+        default=(10, 60),
+    )
+
+    LDAP_AUTH_HEDGE_SEARCHES = LazySetting(
+        name="LDAP_AUTH_HEDGE_SEARCHES",
+        default=False,
+    )
+
+    LDAP_AUTH_HEDGE_PERCENTILE = LazySetting(
+        name="LDAP_AUTH_HEDGE_PERCENTILE",
+        default=95,
+    )
+
+    LDAP_AUTH_HEDGE_MIN_DELAY = LazySetting(
+        name="LDAP_AUTH_HEDGE_MIN_DELAY",
+        default=0.01,
+    )
+
+    LDAP_AUTH_HEDGE_BUDGET = LazySetting(
+        name="LDAP_AUTH_HEDGE_BUDGET",
+        default=0.05,
+    )
+
+    LDAP_AUTH_REFERRALS = LazySetting(
+        name="LDAP_AUTH_REFERRALS",
+        default="follow",
+    )
+
+    LDAP_AUTH_REFERRAL_HOSTS = LazySetting(
+        name="LDAP_AUTH_REFERRAL_HOSTS",
+        default=[],
+    )
+
+    LDAP_AUTH_REFERRAL_HOP_LIMIT = LazySetting(
+        name="LDAP_AUTH_REFERRAL_HOP_LIMIT",
+        default=None,
+    )
+
+    LDAP_AUTH_REFERRAL_TIME_LIMIT = LazySetting(
+        name="LDAP_AUTH_REFERRAL_TIME_LIMIT",
+        default=None,
+    )
+
+    LDAP_AUTH_SCHEMA_CACHE_DIR = LazySetting(
+        name="LDAP_AUTH_SCHEMA_CACHE_DIR",
+        default=None,
+    )
+
+    LDAP_AUTH_SCHEMA_CACHE_TTL = LazySetting(
+        name="LDAP_AUTH_SCHEMA_CACHE_TTL",
+        default=86400,
+    )
+
     LDAP_AUTH_CONNECT_ARGS = LazySetting(
         name="LDAP_AUTH_CONNECT_ARGS",
         default={},
@@ -146,6 +334,16 @@ class LazySettings(object):
         default=False,
     )
 
+    LDAP_AUTH_CONNECT_RACE = LazySetting(
+        name="LDAP_AUTH_CONNECT_RACE",
+        default=False,
+    )
+
+    LDAP_AUTH_CONNECT_RACE_DELAY = LazySetting(
+        name="LDAP_AUTH_CONNECT_RACE_DELAY",
+        default=0.25,
+    )
+
     LDAP_AUTH_CONNECT_TIMEOUT = LazySetting(
         name="LDAP_AUTH_CONNECT_TIMEOUT",
         default=None
@@ -161,5 +359,79 @@ class LazySettings(object):
         default=True
     )
 
+    LDAP_AUTH_GROUP_SEARCH_BASE = LazySetting(
+        name="LDAP_AUTH_GROUP_SEARCH_BASE",
+        default=None,
+    )
+
+    LDAP_AUTH_GROUP_OBJECT_CLASS = LazySetting(
+        name="LDAP_AUTH_GROUP_OBJECT_CLASS",
+        default="groupOfNames",
+    )
+
+    LDAP_AUTH_GROUP_MEMBER_ATTRIBUTE = LazySetting(
+        name="LDAP_AUTH_GROUP_MEMBER_ATTRIBUTE",
+        default="member",
+    )
+
+    LDAP_AUTH_NESTED_GROUPS_CACHE_TTL = LazySetting(
+        name="LDAP_AUTH_NESTED_GROUPS_CACHE_TTL",
+        default=300,
+    )
+
+    LDAP_AUTH_NESTED_GROUPS_RELOAD_INTERVAL = LazySetting(
+        name="LDAP_AUTH_NESTED_GROUPS_RELOAD_INTERVAL",
+        default=3600,
+    )
+
+    LDAP_AUTH_SYNC_SHARD_FILTERS = LazySetting(
+        name="LDAP_AUTH_SYNC_SHARD_FILTERS",
+        default=None,
+    )
+
+    LDAP_AUTH_DIRECTORIES = LazySetting(
+        name="LDAP_AUTH_DIRECTORIES",
+        default={},
+    )
+
+    LDAP_AUTH_DIRECTORY_ROUTER = LazySetting(
+        name="LDAP_AUTH_DIRECTORY_ROUTER",
+        default="django_python3_ldap.utils.route_directory_by_realm",
+    )
+
+    LDAP_AUTH_DIRECTORY_REALMS = LazySetting(
+        name="LDAP_AUTH_DIRECTORY_REALMS",
+        default={},
+    )
+
 
 settings = LazySettings(settings)
+
+
+def get_directory():
+    """
+    Returns the name of the directory in use, or None for the default directory.
+    """
+    directory = _directory.get()
+    return directory[0] if directory is not None else None
+
+
+@contextmanager
+def use_directory(name):
+    """
+    Uses the settings of the named directory in LDAP_AUTH_DIRECTORIES within the block.
+
+    A name of None uses the default directory, configured by the top-level settings.
+    """
+    if name is None:
+        directory = None
+    else:
+        try:
+            directory = (name, settings.LDAP_AUTH_DIRECTORIES[name])
+        except KeyError:
+            raise ImproperlyConfigured("Unknown LDAP directory {name!r}".format(name=name))
+    token = _directory.set(directory)
+    try:
+        yield
+    finally:
+        _directory.reset(token)
@@ -0,0 +1,220 @@
+"""
+Nested LDAP group resolution.
+
+These helpers are designed to be called from a custom
+LDAP_AUTH_SYNC_USER_RELATIONS function, using the `connection`
+and `dn` keyword arguments it is given.
+"""
+
+import logging
+import threading
+import time
+
+import ldap3
+from ldap3.utils.conv import escape_filter_chars
+
+from django_python3_ldap import slowlog
+from django_python3_ldap.conf import settings
+from django_python3_ldap.ldap import disable_auto_range, iter_attribute_values
+from django_python3_ldap.utils import format_generalized_time, get_search_bases
+
+
+logger = logging.getLogger(__name__)
+
+
+# The Active Directory LDAP_MATCHING_RULE_IN_CHAIN extensible match rule.
+MATCHING_RULE_IN_CHAIN = "1.2.840.113556.1.4.1941"
+
+
+def _get_group_search_base():
+    return settings.LDAP_AUTH_GROUP_SEARCH_BASE or get_search_bases()[0][0]
+
+
+def _normalize_dn(dn):
+    return dn.strip().lower()
+
+
+def get_nested_groups_in_chain(connection, dn):
+    """
+    Returns the set of group DNs that the given DN is a direct or
+    transitive member of.
+
+    This uses the Active Directory LDAP_MATCHING_RULE_IN_CHAIN, so the
+    directory resolves the nesting in a single search.
+    """
+    search_filter = "(&(objectClass={object_class})({member_attribute}:{rule}:={dn}))".format(
+        object_class=settings.LDAP_AUTH_GROUP_OBJECT_CLASS,
+        member_attribute=settings.LDAP_AUTH_GROUP_MEMBER_ATTRIBUTE,
+        rule=MATCHING_RULE_IN_CHAIN,
+        dn=escape_filter_chars(dn),
+    )
+    paged_entries = slowlog.iter_timed_pages(
+        connection,
+        connection.extend.standard.paged_search(
+            search_base=_get_group_search_base(),
+            search_filter=search_filter,
+            search_scope=ldap3.SUBTREE,
+            attributes=[],
+            paged_size=100,
+        ),
+        paged_size=100,
+        search_filter=search_filter,
+    )
+    return {
+        entry["dn"]
+        for entry
+        in paged_entries
+        if entry["type"] == "searchResEntry"
+    }
+
+
+class GroupGraph(object):
+
+    """
+    A cached transitive closure of the LDAP group membership graph.
+
+    The whole graph is loaded once, then refreshed incrementally by
+    searching for groups modified since the last refresh. Incremental
+    refreshes cannot see deleted groups, so the graph is reloaded in
+    full every LDAP_AUTH_NESTED_GROUPS_RELOAD_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Discards the cached graph, forcing a full reload on next use.
+        """
+        self._group_dns = {}  # Normalized group DN -> group DN.
+        self._members = {}  # Normalized group DN -> frozenset of normalized member DNs.
+        self._parents = {}  # Normalized member DN -> set of normalized group DNs.
+        self._ancestors = {}  # Normalized group DN -> frozenset of normalized group DNs.
+        self._modified_since = None
+        self._loaded_at = None
+        self._refreshed_at = None
+
+    def _search_groups(self, connection, search_filter):
+        member_attribute = settings.LDAP_AUTH_GROUP_MEMBER_ATTRIBUTE
+        search_filter = "(&(objectClass={object_class}){search_filter})".format(
+            object_class=settings.LDAP_AUTH_GROUP_OBJECT_CLASS,
+            search_filter=search_filter,
+        )
+        paged_entries = slowlog.iter_timed_pages(
+            connection,
+            connection.extend.standard.paged_search(
+                search_base=_get_group_search_base(),
+                search_filter=search_filter,
+                search_scope=ldap3.SUBTREE,
+                attributes=[member_attribute, "modifyTimestamp"],
+                paged_size=100,
+            ),
+            paged_size=100,
+            search_filter=search_filter,
+        )
+        # Large groups are truncated by Active Directory, so stream in any remaining members,
+        # rather than letting ldap3 fetch them all with each page.
+        with disable_auto_range(connection):
+            for entry in paged_entries:
+                if entry["type"] != "searchResEntry":
+                    continue
+                attributes = entry.get("attributes", {})
+                members = iter_attribute_values(connection, entry["dn"], member_attribute, attributes)
+                yield entry["dn"], members, format_generalized_time(attributes.get("modifyTimestamp"))
+
+    def _update_groups(self, groups):
+        for dn, members, modified in groups:
+            group_key = _normalize_dn(dn)
+            for member_key in self._members.get(group_key, ()):
+                self._parents[member_key].discard(group_key)
+            self._group_dns[group_key] = dn
+            self._members[group_key] = frozenset(_normalize_dn(member) for member in members)
+            for member_key in self._members[group_key]:
+                self._parents.setdefault(member_key, set()).add(group_key)
+            if modified and (self._modified_since is None or modified > self._modified_since):
+                self._modified_since = modified
+
+    def _update_ancestors(self):
+        ancestors = {}
+        for group_key in self._members:
+            # Walk up the graph iteratively, tolerating membership cycles.
+            seen = set()
+            stack = list(self._parents.get(group_key, ()))
+            while stack:
+                parent_key = stack.pop()
+                if parent_key in seen:
+                    continue
+                seen.add(parent_key)
+                if parent_key in ancestors:
+                    seen.update(ancestors[parent_key])
+                else:
+                    stack.extend(self._parents.get(parent_key, ()))
+            seen.discard(group_key)
+            ancestors[group_key] = frozenset(seen)
+        self._ancestors = ancestors
+
+    def _load(self, connection):
+        self.invalidate()
+        self._update_groups(self._search_groups(connection, ""))
+        self._update_ancestors()
+        self._loaded_at = self._refreshed_at = time.monotonic()
+        logger.info("LDAP group graph loaded {count} groups".format(count=len(self._members)))
+
+    def _refresh(self, connection):
+        if self._modified_since is None:
+            self._load(connection)
+            return
+        groups = list(self._search_groups(connection, "(modifyTimestamp>={modified_since})".format(
+            modified_since=escape_filter_chars(self._modified_since),
+        )))
+        if groups:
+            self._update_groups(groups)
+            self._update_ancestors()
+        self._refreshed_at = time.monotonic()
+        logger.info("LDAP group graph refreshed {count} groups".format(count=len(groups)))
+
+    def get_groups(self, connection, dn):
+        """
+        Returns the set of group DNs that the given DN is a direct or
+        transitive member of.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._loaded_at is None or now - self._loaded_at >= settings.LDAP_AUTH_NESTED_GROUPS_RELOAD_INTERVAL:
+                self._load(connection)
+            elif now - self._refreshed_at >= settings.LDAP_AUTH_NESTED_GROUPS_CACHE_TTL:
+                self._refresh(connection)
+            group_keys = set()
+            for parent_key in self._parents.get(_normalize_dn(dn), ()):
+                group_keys.add(parent_key)
+                group_keys.update(self._ancestors.get(parent_key, ()))
+            return {self._group_dns[group_key] for group_key in group_keys}
+
+
+_group_graphs = {}
+_group_graphs_lock = threading.Lock()
+
+
+def get_group_graph():
+    """
+    Returns the shared GroupGraph for the current group settings.
+    """
+    key = (
+        _get_group_search_base(),
+        settings.LDAP_AUTH_GROUP_OBJECT_CLASS,
+        settings.LDAP_AUTH_GROUP_MEMBER_ATTRIBUTE,
+    )
+    with _group_graphs_lock:
+        return _group_graphs.setdefault(key, GroupGraph())
+
+
+def get_nested_groups_cached(connection, dn):
+    """
+    Returns the set of group DNs that the given DN is a direct or
+    transitive member of.
+
+    This works with any LDAP server, resolving the nesting against a
+    cached copy of the group graph.
+    """
+    return get_group_graph().get_groups(connection, dn)
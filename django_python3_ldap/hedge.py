@@ -0,0 +1,150 @@
+"""
+Hedged LDAP searches, to cut tail latency across replicas.
+"""
+
+import contextvars
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django_python3_ldap.conf import settings
+from django_python3_ldap.utils import percentile
+
+
+# The number of primary search latencies needed before searches are hedged.
+MIN_SAMPLES = 20
+
+# The number of recent primary search latencies the hedge delay is computed from.
+WINDOW_SIZE = 1000
+
+# The maximum number of hedges that can be saved up by a quiet period.
+MAX_BUDGET = 10
+
+
+class HedgeStats(object):
+
+    """
+    Thread-safe search latencies, hedge budget and counts.
+
+    Each search adds LDAP_AUTH_HEDGE_BUDGET to the budget, and each hedge
+    spends one, so hedges are limited to that fraction of searches.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=WINDOW_SIZE)
+        self._budget = 0.0
+        self._counts = Counter()
+
+    def add_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def get_delay(self):
+        """
+        Returns the number of seconds to wait before hedging a search, or None if
+        there are too few latencies to tell.
+        """
+        with self._lock:
+            latencies = list(self._latencies)
+        if len(latencies) < MIN_SAMPLES:
+            return None
+        return max(
+            settings.LDAP_AUTH_HEDGE_MIN_DELAY,
+            percentile(latencies, settings.LDAP_AUTH_HEDGE_PERCENTILE),
+        )
+
+    def deposit(self):
+        with self._lock:
+            self._counts["searches"] += 1
+            self._budget = min(MAX_BUDGET, self._budget + settings.LDAP_AUTH_HEDGE_BUDGET)
+
+    def withdraw(self):
+        """
+        Spends one hedge from the budget, returning False if it is exhausted.
+        """
+        with self._lock:
+            if self._budget < 1:
+                self._counts["budget_exhausted"] += 1
+                return False
+            self._budget -= 1
+            self._counts["hedged"] += 1
+            return True
+
+    def count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def get_metrics(self):
+        delay = self.get_delay()
+        with self._lock:
+            return {
+                "searches": self._counts["searches"],
+                "hedged": self._counts["hedged"],
+                "hedge_wins": self._counts["hedge_wins"],
+                "budget_exhausted": self._counts["budget_exhausted"],
+                "budget": self._budget,
+                "delay": delay,
+            }
+
+
+_stats = HedgeStats()
+
+
+def get_metrics():
+    return _stats.get_metrics()
+
+
+def call(primary, secondary, discard_primary, discard_secondary):
+    """
+    Calls primary(), and also secondary() if the primary call hasn't returned
+    within the hedge delay and the hedge budget allows.
+
+    Returns a tuple of (result, hedged), where hedged is True if the result came
+    from the secondary call. A secondary call that doesn't provide the result,
+    and a primary call that loses to the secondary call, are left to finish in
+    the background, then their discard function is called. If both calls fail,
+    the first exception is re-raised.
+    """
+    _stats.deposit()
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="django_python3_ldap.hedge")
+
+    def run_primary():
+        start = time.perf_counter()
+        try:
+            return primary()
+        finally:
+            _stats.add_latency(time.perf_counter() - start)
+
+    futures = {}
+    winner = None
+    try:
+        primary_future = executor.submit(contextvars.copy_context().run, run_primary)
+        futures[primary_future] = discard_primary
+        delay = _stats.get_delay()
+        if delay is not None:
+            done, _ = wait([primary_future], timeout=delay)
+            if not done and _stats.withdraw():
+                futures[executor.submit(contextvars.copy_context().run, secondary)] = discard_secondary
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as ex:
+                    error = error or ex
+                    continue
+                winner = future
+                hedged = future is not primary_future
+                if hedged:
+                    _stats.count("hedge_wins")
+                return result, hedged
+        raise error
+    finally:
+        for future, discard in futures.items():
+            if future is not winner and (winner is not None or future is not primary_future):
+                future.add_done_callback(lambda future, discard=discard: discard())
+        executor.shutdown(wait=False)
@@ -3,25 +3,293 @@ Low-level LDAP hooks.
 """
 
 import ldap3
-from ldap3.core.exceptions import LDAPException
+from ldap3.core.exceptions import LDAPException, LDAPInvalidCredentialsResult
+from ldap3.utils.ciDict import CaseInsensitiveDict
+import copy
+import hashlib
+import hmac
+import itertools
 import logging
+import os
+import random
+import re
+import socket
+import threading
+from functools import partial
 from inspect import getfullargspec
 from contextlib import contextmanager
 from django.contrib.auth import get_user_model
-from django_python3_ldap.conf import settings
-from django_python3_ldap.utils import import_func, format_search_filter
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
+from django_python3_ldap import hedge, referrals, refresh, schema, slowlog, throttle
+from django_python3_ldap.cache import TieredCache
+from django_python3_ldap.conf import get_directory, settings, use_directory
+from django_python3_ldap.tls import ResumableTls
+from django_python3_ldap.utils import (
+    SingleFlight, first_result, format_generalized_time, format_search_filter, get_search_bases,
+    get_user_search_attributes, import_func, race,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
+_RANGE_OPTION_RE = re.compile(r"^(?P<name>[^;]+);range=(?P<start>\d+)-(?P<end>\d+|\*)$", re.IGNORECASE)
+
+
+@contextmanager
+def disable_auto_range(connection):
+    """
+    Turns off ldap3's auto_range on the connection for the duration of the block.
+
+    With auto_range, ldap3 fetches every remaining range of a truncated attribute
+    within the first search, loading the whole attribute into memory.
+    """
+    auto_range = connection.auto_range
+    connection.auto_range = False
+    try:
+        yield
+    finally:
+        connection.auto_range = auto_range
+
+
+def iter_attribute_values(connection, dn, attribute, attributes=None):
+    """
+    Yields the values of a multi-valued attribute on the given DN.
+
+    Active Directory truncates very large attributes (e.g. the `member` attribute
+    of a big group), returning them as `member;range=0-1499`. The remaining values
+    are fetched in further ranged chunks, so only one chunk is held in memory at a time.
+
+    If `attributes` is given, it should be the attributes of a search result for the DN,
+    made with auto_range disabled, and is used as the first chunk.
+    """
+    start = 0
+    while True:
+        if attributes is None:
+            with disable_auto_range(connection), slowlog.timed("search", connection, "(objectClass=*)"):
+                connection.search(
+                    search_base=dn,
+                    search_filter="(objectClass=*)",
+                    search_scope=ldap3.BASE,
+                    attributes=["{attribute};range={start}-*".format(attribute=attribute, start=start)],
+                )
+            if not connection.response:
+                return
+            attributes = connection.response[0].get("attributes") or {}
+        chunk, attributes = attributes, None
+        for key, values in chunk.items():
+            if not isinstance(values, (list, tuple)):
+                values = (values,)
+            # Handle an attribute small enough to be returned in full.
+            if key.lower() == attribute.lower():
+                yield from values
+                return
+            # Handle a ranged chunk of the attribute.
+            match = _RANGE_OPTION_RE.match(key)
+            if match and match.group("name").lower() == attribute.lower():
+                yield from values
+                if match.group("end") == "*":
+                    return
+                start = int(match.group("end")) + 1
+                break
+        else:
+            return
+
+
+# A cache of user lookups to DNs, for search-then-bind mode.
+_dn_cache = TieredCache(
+    key_prefix="django_python3_ldap.dn",
+    ttl_setting="LDAP_AUTH_DN_CACHE_TTL",
+    maxsize_setting="LDAP_AUTH_DN_CACHE_MAX_SIZE",
+    alias_setting="LDAP_AUTH_DN_CACHE_ALIAS",
+)
+
+
+# A cache of user lookups that matched no LDAP user.
+_negative_cache = TieredCache(
+    key_prefix="django_python3_ldap.negative",
+    ttl_setting="LDAP_AUTH_NEGATIVE_CACHE_TTL",
+    maxsize_setting="LDAP_AUTH_NEGATIVE_CACHE_MAX_SIZE",
+    alias_setting="LDAP_AUTH_NEGATIVE_CACHE_ALIAS",
+)
+
+
+class LazyAttribute(object):
+
+    """
+    A handle to an attribute of an LDAP entry that is fetched on first access.
+
+    Attributes named in LDAP_AUTH_LAZY_ATTRIBUTES, such as photos and certificates,
+    are left out of user searches, and passed to LDAP_AUTH_SYNC_USER_RELATIONS as
+    lazy attributes instead. The handle is only valid while its connection is open.
+    """
+
+    def __init__(self, connection, dn, name, modified=None):
+        self.connection = connection
+        self.dn = dn
+        self.name = name
+        # The modifyTimestamp of the entry, if known. The attribute can't have changed since then.
+        self.modified = format_generalized_time(modified)
+        self._values = None
+
+    def __repr__(self):
+        return "<LazyAttribute {name} of {dn}>".format(name=self.name, dn=self.dn)
+
+    def __iter__(self):
+        """
+        Yields the attribute values, fetching large multi-valued attributes in ranged chunks
+        without keeping them in memory.
+        """
+        if self._values is not None:
+            return iter(self._values)
+        with disable_auto_range(self.connection), slowlog.timed("search", self.connection, "(objectClass=*)"):
+            self.connection.search(
+                search_base=self.dn,
+                search_filter="(objectClass=*)",
+                search_scope=ldap3.BASE,
+                attributes=[self.name],
+            )
+        if not self.connection.response:
+            return iter(())
+        attributes = self.connection.response[0].get("attributes") or {}
+        return iter_attribute_values(self.connection, self.dn, self.name, attributes)
+
+    @property
+    def values(self):
+        """
+        The list of attribute values, fetched on first access.
+        """
+        if self._values is None:
+            self._values = list(self)
+        return self._values
+
+    @property
+    def value(self):
+        """
+        The first attribute value, or None.
+        """
+        return self.values[0] if self.values else None
+
+    def is_modified_since(self, modified):
+        """
+        Returns False if the entry is known not to have changed since the given
+        generalized time (e.g. a stored `modified` value), so the attribute needn't be fetched.
+        """
+        return modified is None or self.modified is None or self.modified > modified
+
+    def get_digest(self):
+        """
+        Returns a SHA-256 hex digest of the attribute values, for comparing with a stored copy.
+
+        The values are fetched once, and kept for later access to `value` or `values`.
+        """
+        digest = hashlib.sha256()
+        for value in self.values:
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+            digest.update(hashlib.sha256(value).digest())
+        return digest.hexdigest()
+
+
+# Lookup field values -> primary key of the user, for users whose attributes were synced recently.
+_synced_cache = TieredCache(
+    key_prefix="django_python3_ldap.synced",
+    ttl_setting="LDAP_AUTH_ATTRIBUTE_REFRESH_TTL",
+    maxsize_setting="LDAP_AUTH_ATTRIBUTE_REFRESH_MAX_SIZE",
+    alias_setting="LDAP_AUTH_ATTRIBUTE_REFRESH_ALIAS",
+)
+
+
+def _get_synced_user(user_lookup):
+    """
+    Returns the local user for the given lookup if its attributes were synced
+    within LDAP_AUTH_ATTRIBUTE_REFRESH_TTL, or None.
+    """
+    key = _get_lookup_cache_key(user_lookup)
+    pk = _synced_cache.get(key)
+    if pk is None:
+        return None
+    try:
+        return get_user_model()._default_manager.get(pk=pk)
+    except ObjectDoesNotExist:
+        _synced_cache.delete(key)
+        return None
+
+
+@slowlog.entry_point("refresh")
+def _refresh_user(user_lookup):
+    """
+    Syncs the local user for the given lookup from LDAP, connecting as the query user.
+    """
+    User = get_user_model()
+    with connection(**{
+        User.USERNAME_FIELD: settings.LDAP_AUTH_CONNECTION_USERNAME,
+        "password": settings.LDAP_AUTH_CONNECTION_PASSWORD,
+    }) as c:
+        if c is None:
+            logger.warning("LDAP background refresh could not connect")
+            return
+        user = c.get_user(**user_lookup)
+    if user is not None:
+        _synced_cache.set(_get_lookup_cache_key(user_lookup), user.pk)
+
+
+def _get_lookup_cache_key(user_lookup):
+    key = tuple(sorted(user_lookup.items()))
+    # The same lookup can name different users in different directories.
+    directory = get_directory()
+    return key if directory is None else (directory, key)
+
+
+def route_directory(user_lookup):
+    """
+    Returns the name of the directory in LDAP_AUTH_DIRECTORIES to authenticate
+    the given user identifier against, or None for the default directory.
+    """
+    if not settings.LDAP_AUTH_DIRECTORIES:
+        return None
+    auth_user_lookup_fields = frozenset(settings.LDAP_AUTH_USER_LOOKUP_FIELDS)
+    return import_func(settings.LDAP_AUTH_DIRECTORY_ROUTER)({
+        key: value for (key, value) in user_lookup.items()
+        if key in auth_user_lookup_fields
+    })
+
+
+# The OID of the paged results control.
+_PAGED_RESULTS_OID = "1.2.840.113556.1.4.319"
+
+
+class UserRecord(object):
+
+    """
+    A compact LDAP user entry, holding only its DN and the attributes needed to sync it.
+
+    Records can be used in place of ldap3 search result entries when syncing users.
+    """
+
+    __slots__ = ("dn", "attributes")
+
+    def __init__(self, dn, attributes):
+        self.dn = dn
+        self.attributes = attributes
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+
 class Connection(object):
 
     """
     A connection to an LDAP server.
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, hedge=True, negative_cache=True):
         """
         Creates the LDAP connection.
 
@@ -29,6 +297,34 @@ class Connection(object):
         manager handles initialization.
         """
         self._connection = connection
+        self._hedge = hedge
+        self._use_negative_cache = negative_cache
+
+    def iter_attribute_values(self, dn, attribute):
+        """
+        Yields the values of a multi-valued attribute on the given DN,
+        fetching very large attributes in ranged chunks.
+        """
+        return iter_attribute_values(self._connection, dn, attribute)
+
+    def _get_user_fields(self, attributes):
+        """
+        Returns a dict of clean Django user model fields for the
+        given LDAP user attributes.
+        """
+        user_fields = {
+            field_name: (
+                attributes[attribute_name].value
+                if isinstance(attributes[attribute_name], LazyAttribute) else
+                attributes[attribute_name][0]
+                if isinstance(attributes[attribute_name], (list, tuple)) else
+                attributes[attribute_name]
+            )
+            for field_name, attribute_name
+            in settings.LDAP_AUTH_USER_FIELDS.items()
+            if attribute_name in attributes
+        }
+        return import_func(settings.LDAP_AUTH_CLEAN_USER_DATA)(user_fields)
 
     def _get_or_create_user(self, user_data):
         """
@@ -45,17 +341,7 @@ class Connection(object):
         User = get_user_model()
 
         # Create the user data.
-        user_fields = {
-            field_name: (
-                attributes[attribute_name][0]
-                if isinstance(attributes[attribute_name], (list, tuple)) else
-                attributes[attribute_name]
-            )
-            for field_name, attribute_name
-            in settings.LDAP_AUTH_USER_FIELDS.items()
-            if attribute_name in attributes
-        }
-        user_fields = import_func(settings.LDAP_AUTH_CLEAN_USER_DATA)(user_fields)
+        user_fields = self._get_user_fields(attributes)
         # Create the user lookup.
         user_lookup = {
             field_name: user_fields.pop(field_name, "")
@@ -69,9 +355,19 @@ class Connection(object):
         )
         # If the user was created, set them an unusable password.
         if created:
+            _negative_cache.delete(_get_lookup_cache_key(user_lookup))
             user.set_unusable_password()
             user.save()
         # Update relations
+        self._sync_user_relations(user, user_data)
+        # All done!
+        logger.info("LDAP user lookup succeeded")
+        return user
+
+    def _sync_user_relations(self, user, user_data):
+        """
+        Calls LDAP_AUTH_SYNC_USER_RELATIONS for the given Django user and LDAP user data.
+        """
         sync_user_relations_func = import_func(settings.LDAP_AUTH_SYNC_USER_RELATIONS)
         sync_user_relations_arginfo = getfullargspec(sync_user_relations_func)
         args = {}  # additional keyword arguments
@@ -82,32 +378,211 @@ class Connection(object):
                 args["dn"] = user_data.get("dn")
             else:
                 raise TypeError(f"Unknown kw argument {argname} in signature for LDAP_AUTH_SYNC_USER_RELATIONS")
+        # Pass attributes left out of the search as lazy handles. Without a connection, such as when
+        # syncing from an LDIF file, they can't be fetched, so only the attributes given are passed.
+        attributes = user_data["attributes"]
+        for name in settings.LDAP_AUTH_LAZY_ATTRIBUTES if self._connection is not None else ():
+            if name not in attributes and user_data.get("dn"):
+                attributes[name] = LazyAttribute(
+                    self._connection,
+                    user_data["dn"],
+                    name,
+                    attributes.get("modifyTimestamp"),
+                )
         # call sync_user_relations_func() with original args plus supported named extras
         sync_user_relations_func(user, attributes, **args)
+
+    def _get_or_create_users(self, user_datas):
+        """
+        Returns a list of Django users for the given batch of LDAP user data.
+
+        Users that do not exist will be created. Database writes are batched, so
+        post_save signals are not sent for the users.
+        """
+        User = get_user_model()
+        lookup_fields = settings.LDAP_AUTH_USER_LOOKUP_FIELDS
+        # Create the user data and lookups, keeping the last entry for duplicate lookups.
+        batch = {}
+        for user_data in user_datas:
+            attributes = user_data.get("attributes")
+            if attributes is None:
+                logger.warning("LDAP user attributes empty")
+                continue
+            user_fields = self._get_user_fields(attributes)
+            user_lookup = {
+                field_name: user_fields.pop(field_name, "")
+                for field_name
+                in lookup_fields
+            }
+            batch[tuple(user_lookup.values())] = (user_data, user_lookup, user_fields)
+        if not batch:
+            return []
+        # Load the existing users in a single query.
+        query = Q()
+        for _, user_lookup, _ in batch.values():
+            query |= Q(**user_lookup)
+        existing_users = {
+            tuple(getattr(user, field_name) for field_name in lookup_fields): user
+            for user
+            in User.objects.filter(query)
+        }
+        # Update or create the users.
+        users = []
+        updated_users = []
+        updated_fields = set()
+        created_users = []
+        for key, (user_data, user_lookup, user_fields) in batch.items():
+            user = existing_users.get(key)
+            if user is None:
+                user = User(**user_lookup, **user_fields)
+                user.set_unusable_password()
+                created_users.append(user)
+            else:
+                for field_name, value in user_fields.items():
+                    setattr(user, field_name, value)
+                updated_users.append(user)
+                updated_fields.update(user_fields)
+            users.append((user, user_data))
+        if updated_users and updated_fields:
+            User.objects.bulk_update(updated_users, updated_fields)
+        if created_users:
+            User.objects.bulk_create(created_users)
+            _negative_cache.delete_many(
+                _get_lookup_cache_key({field_name: getattr(user, field_name) for field_name in lookup_fields})
+                for user
+                in created_users
+            )
+            # Not all databases return primary keys from a bulk insert.
+            for user in created_users:
+                if user.pk is None:
+                    user.pk = User.objects.get(**{
+                        field_name: getattr(user, field_name)
+                        for field_name
+                        in lookup_fields
+                    }).pk
+        # Update relations
+        for user, user_data in users:
+            self._sync_user_relations(user, user_data)
         # All done!
-        logger.info("LDAP user lookup succeeded")
-        return user
+        logger.info("LDAP user batch sync succeeded for {count} users".format(count=len(users)))
+        return [user for user, _ in users]
+
+    def _iter_user_entries(self, search_filter=None):
+        """
+        Returns an iterator of LDAP search result entries for
+        users in the LDAP database.
+
+        If given, the search filter is AND'd with the user search filter,
+        allowing the users to be enumerated in shards.
+        """
+        user_search_filter = format_search_filter({})
+        if search_filter:
+            user_search_filter = "(&{user_search_filter}{search_filter})".format(
+                user_search_filter=user_search_filter,
+                search_filter=search_filter,
+            )
+        return itertools.chain.from_iterable(
+            (
+                entry
+                for entry
+                in slowlog.iter_timed_pages(
+                    self._connection,
+                    self._connection.extend.standard.paged_search(
+                        search_base=search_base,
+                        search_filter=user_search_filter,
+                        search_scope=search_scope,
+                        attributes=get_user_search_attributes(),
+                        get_operational_attributes=True,
+                        paged_size=30,
+                    ),
+                    paged_size=30,
+                    search_filter=user_search_filter,
+                )
+                if entry["type"] == "searchResEntry"
+            )
+            for search_base, search_scope
+            in get_search_bases()
+        )
+
+    def iter_user_records(self, get_page_size):
+        """
+        Yields a compact UserRecord for each user in the LDAP database.
+
+        The same attributes are fetched as by iter_users, so the records can be synced the
+        same way. Pages are requested one at a time, with the size returned by `get_page_size()`,
+        and the raw response is dropped as soon as each page has been converted.
+        """
+        attributes = get_user_search_attributes()
+        search_filter = format_search_filter({})
+        for search_base, search_scope in get_search_bases():
+            cookie = None
+            while True:
+                with slowlog.timed("search", self._connection, search_filter):
+                    self._connection.search(
+                        search_base=search_base,
+                        search_filter=search_filter,
+                        search_scope=search_scope,
+                        attributes=attributes,
+                        get_operational_attributes=True,
+                        paged_size=get_page_size(),
+                        paged_cookie=cookie,
+                    )
+                # Attributes stay case-insensitive, as in the entries synced by iter_users.
+                records = [
+                    UserRecord(entry["dn"], CaseInsensitiveDict(entry["attributes"]))
+                    for entry
+                    in self._connection.response
+                    if entry["type"] == "searchResEntry" and entry.get("attributes") is not None
+                ]
+                cookie = (self._connection.result or {}).get("controls", {}).get(
+                    _PAGED_RESULTS_OID, {},
+                ).get("value", {}).get("cookie")
+                self._connection.response = None
+                yield from records
+                del records
+                if not cookie:
+                    break
 
     def iter_users(self):
         """
         Returns an iterator of Django users that correspond to
         users in the LDAP database.
         """
-        paged_entries = self._connection.extend.standard.paged_search(
-            search_base=settings.LDAP_AUTH_SEARCH_BASE,
-            search_filter=format_search_filter({}),
-            search_scope=ldap3.SUBTREE,
-            attributes=ldap3.ALL_ATTRIBUTES,
-            get_operational_attributes=True,
-            paged_size=30,
-        )
         return filter(None, (
             self._get_or_create_user(entry)
             for entry
-            in paged_entries
-            if entry["type"] == "searchResEntry"
+            in self._iter_user_entries()
         ))
 
+    def iter_user_data(self):
+        """
+        Returns an iterator of user model field dicts that correspond
+        to users in the LDAP database.
+
+        Entries are mapped through LDAP_AUTH_USER_FIELDS and LDAP_AUTH_CLEAN_USER_DATA
+        as they are streamed from the paged search, without touching the database.
+        """
+        return (
+            self._get_user_fields(entry["attributes"])
+            for entry
+            in self._iter_user_entries()
+            if entry.get("attributes") is not None
+        )
+
+    def get_user_data(self, **kwargs):
+        """
+        Returns the user model field dict for the user with the given identifier,
+        without touching the database.
+
+        The user identifier should be keyword arguments matching the fields
+        in settings.LDAP_AUTH_USER_LOOKUP_FIELDS.
+        """
+        user_data = self._search_user(**kwargs)
+        if user_data is not None:
+            return self._get_user_fields(user_data["attributes"])
+        logger.warning("LDAP user lookup failed")
+        return None
+
     def get_user(self, **kwargs):
         """
         Returns the user with the given identifier.
@@ -116,8 +591,9 @@ class Connection(object):
         in settings.LDAP_AUTH_USER_LOOKUP_FIELDS.
         """
         # Search the LDAP database.
-        if self.has_user(**kwargs):
-            return self._get_or_create_user(self._connection.response[0])
+        user_data = self._search_user(**kwargs)
+        if user_data is not None:
+            return self._get_or_create_user(user_data)
         logger.warning("LDAP user lookup failed")
         return None
 
@@ -128,25 +604,340 @@ class Connection(object):
         The user identifier should be keyword arguments matching the fields
         in settings.LDAP_AUTH_USER_LOOKUP_FIELDS.
         """
-        # Search the LDAP database.
-        self._connection.search(
-            search_base=settings.LDAP_AUTH_SEARCH_BASE,
-            search_filter=format_search_filter(kwargs),
-            search_scope=ldap3.SUBTREE,
-            attributes=ldap3.ALL_ATTRIBUTES,
-            get_operational_attributes=True,
-            size_limit=1,
+        return self._search_user(**kwargs) is not None
+
+    def _open_connection(self, server=None):
+        """
+        Opens a new LDAP connection to the same servers (or the given server),
+        bound with the same credentials.
+        """
+        c = referrals.configure(ldap3.Connection(
+            server or self._connection.server_pool or self._connection.server,
+            user=self._connection.user,
+            password=self._connection.password,
+            auto_bind=False,
+            raise_exceptions=True,
+            receive_timeout=settings.LDAP_AUTH_RECEIVE_TIMEOUT,
+        ))
+        try:
+            if settings.LDAP_AUTH_USE_TLS:
+                with slowlog.timed("start_tls", c):
+                    c.start_tls(read_server_info=False)
+            with slowlog.timed("bind", c):
+                c.bind(read_server_info=False)
+        except LDAPException:
+            c.unbind()
+            raise
+        return c
+
+    def _search_user_base(self, connection, search_base, search_scope, search_filter):
+        """
+        Returns the LDAP search result entry for the first user matching
+        the search filter in the given search base, or None.
+        """
+        with slowlog.timed("search", connection, search_filter):
+            connection.search(
+                search_base=search_base,
+                search_filter=search_filter,
+                search_scope=search_scope,
+                attributes=get_user_search_attributes(),
+                get_operational_attributes=True,
+                size_limit=1,
+            )
+        if len(connection.response) > 0 and connection.response[0].get("attributes"):
+            return connection.response[0]
+        return None
+
+    def _search_user_base_concurrently(self, opened, stopped, search_base, search_scope, search_filter):
+        c = self._open_connection()
+        opened.append(c)
+        if stopped.is_set():
+            # Another search finished while this connection was binding, too late to stop it.
+            c.unbind()
+            return None
+        try:
+            return self._search_user_base(c, search_base, search_scope, search_filter)
+        finally:
+            try:
+                c.unbind()
+            except LDAPException:
+                # The search was stopped by _search_user, so the unbind request can't be sent.
+                c.strategy.close()
+
+    def _search_user_base_hedged(self, search_base, search_scope, search_filter):
+        """
+        Returns the LDAP search result entry for the first user matching the search filter
+        in the given search base, or None.
+
+        If this connection's server hasn't answered within the hedge delay, the search
+        is sent to another server in LDAP_AUTH_URL too, and the first answer is used. If
+        the other server wins, this connection moves to it for later operations.
+        """
+        primary = self._connection
+        servers = [
+            server
+            for server
+            in _get_server_pool().servers
+            if server.name != primary.server.name
+        ]
+        if not servers:
+            return self._search_user_base(primary, search_base, search_scope, search_filter)
+        opened = []
+
+        def search_secondary():
+            c = self._open_connection(random.choice(servers))
+            opened.append(c)
+            return self._search_user_base(c, search_base, search_scope, search_filter)
+
+        def discard_secondary():
+            for c in opened:
+                c.unbind()
+
+        user_data, hedged = hedge.call(
+            partial(self._search_user_base, primary, search_base, search_scope, search_filter),
+            search_secondary,
+            primary.unbind,
+            discard_secondary,
         )
-        return bool(len(self._connection.response) > 0 and self._connection.response[0].get("attributes"))
+        if hedged:
+            self._connection = opened[0]
+        return user_data
+
+    def _search_user(self, **kwargs):
+        """
+        Returns the LDAP search result entry for the user with the given identifier, or None.
+
+        If there are several search bases and LDAP_AUTH_SEARCH_BASES_CONCURRENT is enabled,
+        they are searched concurrently on separate connections, the first match is returned,
+        and the searches still running are stopped. Otherwise, the search is hedged if
+        LDAP_AUTH_HEDGE_SEARCHES is enabled.
+
+        Lookups that match no user are cached for LDAP_AUTH_NEGATIVE_CACHE_TTL seconds,
+        unless the connection was opened with negative_cache=False.
+        """
+        negative_cache_key = _get_lookup_cache_key(kwargs)
+        if self._use_negative_cache and _negative_cache.get(negative_cache_key):
+            return None
+        search_filter = format_search_filter(kwargs)
+        search_bases = get_search_bases()
+        if len(search_bases) == 1 or not settings.LDAP_AUTH_SEARCH_BASES_CONCURRENT:
+            for search_base, search_scope in search_bases:
+                if self._hedge and settings.LDAP_AUTH_HEDGE_SEARCHES:
+                    user_data = self._search_user_base_hedged(search_base, search_scope, search_filter)
+                else:
+                    user_data = self._search_user_base(self._connection, search_base, search_scope, search_filter)
+                if user_data is not None:
+                    break
+        else:
+            opened = []
+            stopped = threading.Event()
+            try:
+                user_data = first_result([
+                    partial(
+                        self._search_user_base_concurrently, opened, stopped, search_base, search_scope, search_filter,
+                    )
+                    for search_base, search_scope
+                    in search_bases
+                ])
+            finally:
+                # Connections opened after this are unbound before searching.
+                stopped.set()
+                for c in list(opened):
+                    _stop_connection(c)
+        if user_data is None:
+            _negative_cache.set(negative_cache_key, True)
+        return user_data
+
+
+def _stop_connection(c):
+    """
+    Stops the operation running on an ldap3 connection in another thread.
+
+    ldap3 holds the connection lock for the whole of a synchronous operation, so it can't
+    be abandoned or unbound until it finishes. Shutting down the socket makes the pending
+    receive fail at once, and ldap3 then closes the connection.
+    """
+    try:
+        c.socket.shutdown(socket.SHUT_RDWR)
+    except (AttributeError, OSError):
+        # The connection has already been closed.
+        pass
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def _get_server(url, mode=None):
+    """
+    Returns the shared ldap3.Server for the given URL and the current settings,
+    optionally restricted to an ldap3 address mode, such as ldap3.IP_V6_ONLY.
+
+    Servers are shared between connections, so their resolved addresses and
+    TLS sessions are reused.
+    """
+    server_args = {
+        "allowed_referral_hosts": referrals.get_allowed_referral_hosts(),
+        "get_info": ldap3.NONE,
+        "connect_timeout": settings.LDAP_AUTH_CONNECT_TIMEOUT,
+        "use_ssl": settings.LDAP_AUTH_CONNECT_USE_SSL,
+        **settings.LDAP_AUTH_CONNECT_ARGS
+    }
+    if mode is not None:
+        server_args["mode"] = mode
+    tls_args = None
+    # Include SSL / TLS, if requested.
+    if settings.LDAP_AUTH_USE_TLS:
+        tls_args = {
+            "ciphers": settings.LDAP_AUTH_TLS_CIPHERS,
+            "version": settings.LDAP_AUTH_TLS_VERSION,
+            **settings.LDAP_AUTH_TLS_ARGS
+        }
+    elif server_args["use_ssl"] and "tls" not in server_args:
+        tls_args = {}
+    key = (url, repr(sorted(server_args.items())), repr(sorted((tls_args or {}).items())), tls_args is None)
+    with _servers_lock:
+        server = _servers.get(key)
+    if server is None:
+        if tls_args is not None:
+            server_args["tls"] = ResumableTls(**tls_args)
+        server = ldap3.Server(url, **server_args)
+        # Attach any cached schema before the server is shared, so its attribute values are typed.
+        # A missing or stale schema is fetched in the background, off the login path.
+        if settings.LDAP_AUTH_SCHEMA_CACHE_DIR:
+            schema.attach(server, open_query_connection)
+        with _servers_lock:
+            server = _servers.setdefault(key, server)
+    return server
+
+
+def _get_server_pool():
+    auth_url = settings.LDAP_AUTH_URL
+    if not isinstance(auth_url, list):
+        auth_url = [auth_url]
+    server_pool = ldap3.ServerPool(
+        None, ldap3.RANDOM,
+        active=settings.LDAP_AUTH_POOL_ACTIVE,
+        exhaust=5
+    )
+    for url in auth_url:
+        server_pool.add(_get_server(url))
+    return server_pool
+
+
+def _get_race_servers():
+    """
+    Returns the servers to race connection attempts to, in the order they are tried.
+
+    The URLs in LDAP_AUTH_URL are shuffled, and each is tried over IPv6, then IPv4,
+    unless LDAP_AUTH_CONNECT_ARGS sets an address mode.
+    """
+    auth_url = settings.LDAP_AUTH_URL
+    if not isinstance(auth_url, list):
+        auth_url = [auth_url]
+    auth_url = random.sample(auth_url, len(auth_url))
+    if "mode" in settings.LDAP_AUTH_CONNECT_ARGS:
+        return [_get_server(url) for url in auth_url]
+    return [
+        _get_server(url, mode)
+        for url
+        in auth_url
+        for mode
+        in (ldap3.IP_V6_ONLY, ldap3.IP_V4_ONLY)
+    ]
+
+
+def _open_racing_connection(**kwargs):
+    """
+    Opens an ldap3 connection to the first server in LDAP_AUTH_URL to accept it.
+
+    Connection attempts are started LDAP_AUTH_CONNECT_RACE_DELAY seconds apart, or as
+    soon as the previous attempts have failed. The first open connection is kept, and
+    the others are closed. Any keyword arguments are passed to ldap3.Connection.
+    """
+    def open_connection(server):
+        c = referrals.configure(ldap3.Connection(server, **kwargs))
+        with slowlog.timed("open", c):
+            c.open(read_server_info=False)
+        return c
+
+    return race(
+        [partial(open_connection, server) for server in _get_race_servers()],
+        settings.LDAP_AUTH_CONNECT_RACE_DELAY,
+        lambda c: c.unbind(),
+    )
+
+
+def _get_query_user():
+    """
+    Returns the DN (or other bind name) of the query user, or None to bind anonymously.
+    """
+    if not settings.LDAP_AUTH_CONNECTION_USERNAME:
+        return None
+    format_username = import_func(settings.LDAP_AUTH_FORMAT_USERNAME)
+    return format_username({get_user_model().USERNAME_FIELD: settings.LDAP_AUTH_CONNECTION_USERNAME})
+
+
+def open_query_connection(server, **kwargs):
+    """
+    Opens an ldap3 connection to the given server or server pool, bound as the query user
+    (or anonymously).
+
+    Any keyword arguments, such as `client_strategy`, are passed to ldap3.Connection.
+    """
+    c = referrals.configure(ldap3.Connection(
+        server,
+        user=_get_query_user(),
+        password=settings.LDAP_AUTH_CONNECTION_PASSWORD,
+        auto_bind=False,
+        raise_exceptions=True,
+        receive_timeout=settings.LDAP_AUTH_RECEIVE_TIMEOUT,
+        **kwargs
+    ))
+    try:
+        if settings.LDAP_AUTH_USE_TLS:
+            with slowlog.timed("start_tls", c):
+                c.start_tls(read_server_info=False)
+        with slowlog.timed("bind", c):
+            c.bind(read_server_info=False)
+    except LDAPException:
+        c.unbind()
+        raise
+    return c
+
+
+def warm_up():
+    """
+    Connects to each server in LDAP_AUTH_URL, and in each directory in LDAP_AUTH_DIRECTORIES,
+    so the first logins don't pay for DNS resolution and a full TLS handshake.
+
+    Connections are bound as the query user (or anonymously), then closed.
+    """
+    for directory in [None, *settings.LDAP_AUTH_DIRECTORIES]:
+        with use_directory(directory):
+            auth_url = settings.LDAP_AUTH_URL
+            if not isinstance(auth_url, list):
+                auth_url = [auth_url]
+            for url in auth_url:
+                try:
+                    open_query_connection(_get_server(url)).unbind()
+                    logger.info("LDAP warm-up succeeded for {url}".format(url=url))
+                except LDAPException as ex:
+                    logger.warning("LDAP warm-up failed for {url}: {ex}".format(url=url, ex=ex))
 
 
 @contextmanager
-def connection(**kwargs):
+def connection(*, rebind=True, negative_cache=True, **kwargs):
     """
     Creates and returns a connection to the LDAP server.
 
     The user identifier, if given, should be keyword arguments matching the fields
     in settings.LDAP_AUTH_USER_LOOKUP_FIELDS, plus a `password` argument.
+
+    The connection is rebound as LDAP_AUTH_CONNECTION_USERNAME after the user's bind,
+    unless `rebind` is False, in which case it is left bound as the user. If `negative_cache`
+    is False, user searches on the connection don't trust cached misses, so management
+    commands always see the current directory.
     """
     # Format the DN for the username.
     format_username = import_func(settings.LDAP_AUTH_FORMAT_USERNAME)
@@ -156,54 +947,44 @@ def connection(**kwargs):
         in kwargs.items()
         if value
     }
+    User = get_user_model()
     username = None
     password = None
+    dn_cache_key = None
     if kwargs:
         password = kwargs.pop("password")
-        username = format_username(kwargs)
-    # Build server pool
-    server_pool = ldap3.ServerPool(
-        None, ldap3.RANDOM,
-        active=settings.LDAP_AUTH_POOL_ACTIVE,
-        exhaust=5
-    )
-    auth_url = settings.LDAP_AUTH_URL
-    if not isinstance(auth_url, list):
-        auth_url = [auth_url]
-    for u in auth_url:
-        # Include SSL / TLS, if requested.
-        server_args = {
-            "allowed_referral_hosts": [("*", True)],
-            "get_info": ldap3.NONE,
-            "connect_timeout": settings.LDAP_AUTH_CONNECT_TIMEOUT,
-            "use_ssl": settings.LDAP_AUTH_CONNECT_USE_SSL,
-            **settings.LDAP_AUTH_CONNECT_ARGS
-        }
-        if settings.LDAP_AUTH_USE_TLS:
-            server_args["tls"] = ldap3.Tls(
-                ciphers=settings.LDAP_AUTH_TLS_CIPHERS,
-                version=settings.LDAP_AUTH_TLS_VERSION,
-                **settings.LDAP_AUTH_TLS_ARGS
-            )
-        server_pool.add(
-            ldap3.Server(
-                u,
-                **server_args,
-            )
-        )
+        # In search-then-bind mode, the user's DN is looked up, unless this is the query user.
+        if settings.LDAP_AUTH_SEARCH_BIND and (
+            kwargs != {User.USERNAME_FIELD: settings.LDAP_AUTH_CONNECTION_USERNAME}
+            or password != settings.LDAP_AUTH_CONNECTION_PASSWORD
+        ):
+            dn_cache_key = _get_lookup_cache_key(kwargs)
+            username = _dn_cache.get(dn_cache_key)
+        else:
+            username = format_username(kwargs)
+    # If the settings specify an alternative username and password for querying, rebind as that.
+    settings_username = _get_query_user()
+    settings_password = settings.LDAP_AUTH_CONNECTION_PASSWORD
+    # Search for an uncached DN as the query user (or anonymously), before binding as the user.
+    search_bind = dn_cache_key is not None and username is None
+    server_pool = _get_server_pool()
+    wrapper = None
     # Connect.
     try:
         connection_args = {
-            "user": username,
-            "password": password,
+            "user": settings_username if search_bind else username,
+            "password": settings_password if search_bind else password,
             "auto_bind": False,
             "raise_exceptions": True,
             "receive_timeout": settings.LDAP_AUTH_RECEIVE_TIMEOUT,
         }
-        c = ldap3.Connection(
-            server_pool,
-            **connection_args,
-        )
+        if settings.LDAP_AUTH_CONNECT_RACE:
+            c = _open_racing_connection(**connection_args)
+        else:
+            c = referrals.configure(ldap3.Connection(
+                server_pool,
+                **connection_args,
+            ))
     except LDAPException as ex:
         logger.warning("LDAP connect failed: {ex}".format(ex=ex))
         yield None
@@ -212,34 +993,88 @@ def connection(**kwargs):
     try:
         # Start TLS, if requested.
         if settings.LDAP_AUTH_USE_TLS:
-            c.start_tls(read_server_info=False)
+            with slowlog.timed("start_tls", c):
+                c.start_tls(read_server_info=False)
         # Perform initial authentication bind.
-        c.bind(read_server_info=True)
-        User = get_user_model()
-        # If the settings specify an alternative username and password for querying, rebind as that.
-        settings_username = (
-            format_username(
-                {User.USERNAME_FIELD: settings.LDAP_AUTH_CONNECTION_USERNAME}
-            )
-            if settings.LDAP_AUTH_CONNECTION_USERNAME
-            else None
-        )
-        settings_password = settings.LDAP_AUTH_CONNECTION_PASSWORD
-        if (settings_username or settings_password) and (
+        with slowlog.timed("bind", c):
+            c.bind(read_server_info=True)
+        # Look up the user's DN, then bind as the user.
+        if search_bind:
+            user_data = Connection(c, hedge=False)._search_user(**kwargs)
+            if user_data is None:
+                logger.warning("LDAP user DN lookup failed")
+                yield None
+                return
+            username = user_data["dn"]
+            _dn_cache.set(dn_cache_key, username)
+            with slowlog.timed("bind", c):
+                c.rebind(
+                    user=username,
+                    password=password,
+                )
+            # The rebind leaves the connection bound as the user.
+            search_bind = False
+        if rebind and (settings_username or settings_password) and (
             settings_username != username or settings_password != password
         ):
-            c.rebind(
-                user=settings_username,
-                password=settings_password,
-            )
+            with slowlog.timed("bind", c):
+                c.rebind(
+                    user=settings_username,
+                    password=settings_password,
+                )
         # Return the connection.
         logger.info("LDAP connect succeeded")
-        yield Connection(c)
+        wrapper = Connection(c, negative_cache=negative_cache)
+        yield wrapper
     except LDAPException as ex:
         logger.warning("LDAP bind failed: {ex}".format(ex=ex))
+        # A cached DN may be stale, so look it up again next time.
+        if dn_cache_key is not None:
+            _dn_cache.delete(dn_cache_key)
+        # Active Directory reports binds for unknown users with a 525 error code.
+        if kwargs and isinstance(ex, LDAPInvalidCredentialsResult) and "data 525," in str(ex):
+            _negative_cache.set(_get_lookup_cache_key(kwargs), True)
         yield None
     finally:
-        c.unbind()
+        # A hedged search may have moved the connection to another server, leaving
+        # the original connection to be closed once its search finishes.
+        if wrapper is None or wrapper._connection is c:
+            c.unbind()
+        else:
+            wrapper._connection.unbind()
+
+
+# A random key for hashing passwords in authentication coalescing keys.
+_authentication_key_secret = os.urandom(32)
+
+_authentication_flights = SingleFlight()
+
+
+def get_authentication_key(**kwargs):
+    """
+    Returns a key identifying the authentication attempt for the given
+    user identifier and password, or None if the login data is invalid.
+
+    The password is included as a keyed digest, so the key can be held
+    in memory without exposing the password.
+    """
+    with use_directory(route_directory(kwargs)):
+        return _get_authentication_key(**kwargs)
+
+
+def _get_authentication_key(**kwargs):
+    password = kwargs.pop("password", None)
+    auth_user_lookup_fields = frozenset(settings.LDAP_AUTH_USER_LOOKUP_FIELDS)
+    ldap_kwargs = {
+        key: value for (key, value) in kwargs.items()
+        if key in auth_user_lookup_fields
+    }
+    if not password or frozenset(ldap_kwargs.keys()) != auth_user_lookup_fields:
+        return None
+    return (
+        _get_lookup_cache_key(ldap_kwargs),
+        hmac.new(_authentication_key_secret, password.encode("utf-8"), hashlib.sha256).digest(),
+    )
 
 
 def authenticate(*args, **kwargs):
@@ -249,7 +1084,25 @@ def authenticate(*args, **kwargs):
 
     The user identifier should be keyword arguments matching the fields
     in settings.LDAP_AUTH_USER_LOOKUP_FIELDS, plus a `password` argument.
+
+    If LDAP_AUTH_DIRECTORIES is set, the user is authenticated against the
+    directory chosen by LDAP_AUTH_DIRECTORY_ROUTER.
+
+    If LDAP_AUTH_COALESCE_AUTHENTICATION is enabled, concurrent identical
+    authentication attempts share a single LDAP round trip.
     """
+    with use_directory(route_directory(kwargs)):
+        if settings.LDAP_AUTH_COALESCE_AUTHENTICATION:
+            key = _get_authentication_key(**kwargs)
+            if key is not None:
+                user, shared = _authentication_flights.call(key, partial(_authenticate, *args, **kwargs))
+                # Give each caller its own user instance.
+                return copy.copy(user) if shared else user
+        return _authenticate(*args, **kwargs)
+
+
+@slowlog.entry_point("authenticate")
+def _authenticate(*args, **kwargs):
     password = kwargs.pop("password", None)
     auth_user_lookup_fields = frozenset(settings.LDAP_AUTH_USER_LOOKUP_FIELDS)
     ldap_kwargs = {
@@ -261,8 +1114,36 @@ def authenticate(*args, **kwargs):
     if not password or frozenset(ldap_kwargs.keys()) != auth_user_lookup_fields:
         return None
 
-    # Connect to LDAP.
-    with connection(password=password, **ldap_kwargs) as c:
-        if c is None:
-            return None
-        return c.get_user(**ldap_kwargs)
+    # Skip the LDAP server for recently unknown users.
+    if _negative_cache.get(_get_lookup_cache_key(ldap_kwargs)):
+        logger.info("LDAP user lookup skipped for unknown user")
+        return None
+
+    # Throttle failed attempts by user and by client, before connecting.
+    request = args[0] if args else None
+    throttle_keys = throttle.acquire(request, ldap_kwargs)
+    if throttle_keys is None:
+        logger.warning("LDAP authentication throttled")
+        return None
+
+    # Trust a recently synced local user, so the login costs a single bind.
+    local_user = _get_synced_user(ldap_kwargs)
+    # Return a stale local user at once, and refresh it in the background.
+    stale = local_user is None and settings.LDAP_AUTH_ATTRIBUTE_REFRESH_BACKGROUND
+    if stale:
+        local_user = get_user_model()._default_manager.filter(**ldap_kwargs).first()
+
+    # Connect to LDAP. A local user only needs the user's own bind, so the query user isn't rebound.
+    user = None
+    with connection(password=password, rebind=local_user is None, **ldap_kwargs) as c:
+        if c is not None:
+            user = local_user
+            if user is not None and stale:
+                refresh.submit(_get_lookup_cache_key(ldap_kwargs), partial(_refresh_user, ldap_kwargs))
+            if user is None:
+                user = c.get_user(**ldap_kwargs)
+                if user is not None:
+                    _synced_cache.set(_get_lookup_cache_key(ldap_kwargs), user.pk)
+    if user is not None:
+        throttle.release(throttle_keys)
+    return user
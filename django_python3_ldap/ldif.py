@@ -0,0 +1,99 @@
+"""
+A streaming LDIF parser.
+"""
+
+import base64
+import logging
+
+from ldap3.utils.ciDict import CaseInsensitiveDict
+
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_ldif_lines(lines):
+    """
+    Yields logical LDIF lines, unfolding continuation lines and skipping comments.
+
+    Record separators are yielded as empty strings.
+    """
+    line = None
+    for physical_line in lines:
+        physical_line = physical_line.rstrip("\r\n")
+        if physical_line.startswith(" "):
+            # Fold a continuation line into the current line.
+            if line is not None:
+                line += physical_line[1:]
+            continue
+        if line is not None and not line.startswith("#"):
+            yield line
+        line = physical_line
+        if not line:
+            yield line
+            line = None
+    if line is not None and not line.startswith("#"):
+        yield line
+
+
+def _parse_ldif_line(line):
+    """
+    Parses a logical LDIF line into an attribute description and value.
+    """
+    name, sep, value = line.partition(":")
+    if not sep:
+        raise ValueError("Invalid LDIF line: {line!r}".format(line=line))
+    if value.startswith(":"):
+        # Decode a base64 value, falling back to bytes for binary values.
+        value = base64.b64decode(value[1:].strip())
+        try:
+            value = value.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+    elif value.startswith("<"):
+        raise ValueError("LDIF URL values are not supported: {line!r}".format(line=line))
+    else:
+        value = value.lstrip(" ")
+    return name, value
+
+
+def iter_ldif_entries(lines):
+    """
+    Yields LDAP entries parsed from an iterable of LDIF lines (e.g. an open file).
+
+    Entries are parsed incrementally, so only one entry is held in memory at a time.
+    Each entry is a dict in the same form as an LDAP search result entry. Change
+    records other than `changetype: add` are skipped.
+    """
+    dn = None
+    attributes = CaseInsensitiveDict()
+    changetype = None
+    for line in _iter_ldif_lines(lines):
+        if not line:
+            # End of record.
+            if dn is not None:
+                if changetype in (None, "add"):
+                    yield {"type": "searchResEntry", "dn": dn, "attributes": attributes}
+                else:
+                    logger.warning("Skipping LDIF {changetype} record for {dn}".format(changetype=changetype, dn=dn))
+            dn = None
+            attributes = CaseInsensitiveDict()
+            changetype = None
+            continue
+        if changetype not in (None, "add"):
+            # Skip the rest of a change record unparsed, as it can contain "-" separator lines.
+            continue
+        name, value = _parse_ldif_line(line)
+        if dn is None:
+            if name.lower() == "dn":
+                dn = value
+            elif name.lower() != "version":
+                raise ValueError("LDIF record does not start with a dn: {line!r}".format(line=line))
+        elif name.lower() == "changetype":
+            changetype = value.lower()
+        elif name.lower() != "control":
+            attributes.setdefault(name, []).append(value)
+    if dn is not None:
+        if changetype in (None, "add"):
+            yield {"type": "searchResEntry", "dn": dn, "attributes": attributes}
+        else:
+            logger.warning("Skipping LDIF {changetype} record for {dn}".format(changetype=changetype, dn=dn))
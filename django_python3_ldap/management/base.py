@@ -0,0 +1,25 @@
+"""
+Helpers for the LDAP management commands.
+"""
+
+from django_python3_ldap.conf import use_directory
+
+
+class DirectoryCommandMixin(object):
+
+    """
+    A management command mixin adding a --directory option, which runs the command
+    with the settings of the named directory in LDAP_AUTH_DIRECTORIES.
+    """
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super(DirectoryCommandMixin, self).create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument(
+            '--directory',
+            help='The name of a directory in LDAP_AUTH_DIRECTORIES to use instead of the default directory.'
+        )
+        return parser
+
+    def execute(self, *args, **options):
+        with use_directory(options.get('directory')):
+            return super(DirectoryCommandMixin, self).execute(*args, **options)
@@ -0,0 +1,266 @@
+import asyncio
+import contextvars
+import json
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from django_python3_ldap import ldap, slowlog
+from django_python3_ldap.auth import run_authentication_async
+from django_python3_ldap.conf import settings
+from django_python3_ldap.management.base import DirectoryCommandMixin
+from django_python3_ldap.utils import group_lookup_args, percentile
+
+
+OPERATIONS = ("authenticate", "has_user", "get_user")
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class BenchResults(object):
+
+    """
+    Thread-safe latencies and outcomes of benchmarked operations.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.outcomes = Counter()
+
+    def add(self, latency, outcome):
+        with self._lock:
+            self.latencies.append(latency)
+            self.outcomes[outcome] += 1
+
+    def get_histogram(self):
+        histogram = Counter()
+        for latency in self.latencies:
+            histogram[next((bucket for bucket in HISTOGRAM_BUCKETS if latency <= bucket), None)] += 1
+        return [
+            {"le": bucket, "count": histogram[bucket]}
+            for bucket
+            in HISTOGRAM_BUCKETS + (None,)
+        ]
+
+    def get_report(self, elapsed):
+        latencies = self.latencies
+        return {
+            "operations": len(latencies),
+            "seconds": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed else 0,
+            "outcomes": dict(self.outcomes),
+            "latency": {
+                "min": min(latencies, default=None),
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies, default=None),
+            },
+            "histogram": self.get_histogram(),
+        }
+
+
+class Command(DirectoryCommandMixin, BaseCommand):
+
+    help = "Measures LDAP authentication throughput and latency, using the same settings as the app."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'lookups',
+            nargs='+',
+            type=str,
+            help='A list of lookup values, matching the fields specified in LDAP_AUTH_USER_LOOKUP_FIELDS. '
+                 'Operations cycle through the given users.'
+        )
+        parser.add_argument(
+            '--operation',
+            choices=OPERATIONS,
+            default='authenticate',
+            help='The operation to benchmark.'
+        )
+        parser.add_argument(
+            '--password',
+            help='The password of the given users, for the authenticate operation.'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=1,
+            help='The number of concurrent threads or asyncio tasks.'
+        )
+        parser.add_argument(
+            '--asyncio',
+            action='store_true',
+            help='Run operations from asyncio tasks instead of threads. The authenticate operation then '
+                 'uses the same async wrapper as the authentication backend.'
+        )
+        parser.add_argument(
+            '--duration',
+            type=float,
+            default=10.0,
+            help='The number of seconds to run for.'
+        )
+        parser.add_argument(
+            '--operations',
+            type=int,
+            help='The total number of operations to run, instead of running for --duration seconds.'
+        )
+        parser.add_argument(
+            '--no-db',
+            action='store_true',
+            help='Map LDAP user data without reading or writing the database, to isolate directory cost.'
+        )
+        parser.add_argument(
+            '--format',
+            choices=('table', 'json'),
+            default='table',
+            help='The output format.'
+        )
+
+    @contextmanager
+    def _open_session(self, operation, password, no_db):
+        """
+        Yields a function that runs the operation for a user lookup, returning True on success.
+
+        Each session has its own LDAP connection, as connections can't be shared between threads.
+        """
+        if operation == 'authenticate':
+            if no_db:
+                def run(lookup):
+                    with ldap.connection(password=password, **lookup) as c:
+                        return c is not None and c.get_user_data(**lookup) is not None
+            else:
+                def run(lookup):
+                    return ldap.authenticate(password=password, **lookup) is not None
+            yield run
+            return
+        User = get_user_model()
+        with ldap.connection(**{
+            User.USERNAME_FIELD: settings.LDAP_AUTH_CONNECTION_USERNAME,
+            'password': settings.LDAP_AUTH_CONNECTION_PASSWORD,
+        }) as c:
+            if c is None:
+                raise CommandError("Could not connect to LDAP server")
+            if operation == 'has_user':
+                yield lambda lookup: c.has_user(**lookup)
+            elif no_db:
+                yield lambda lookup: c.get_user_data(**lookup) is not None
+            else:
+                yield lambda lookup: c.get_user(**lookup) is not None
+
+    @staticmethod
+    def _get_outcome(func, *args):
+        """
+        Runs the function, returning its latency in milliseconds and an outcome name.
+        """
+        start = time.perf_counter()
+        try:
+            outcome = "ok" if func(*args) else "rejected"
+        except Exception as ex:
+            outcome = ex.__class__.__name__
+        return (time.perf_counter() - start) * 1000, outcome
+
+    def _run_threads(self, sessions, next_lookup, results):
+        def worker(run):
+            try:
+                for lookup in iter(next_lookup, None):
+                    results.add(*self._get_outcome(run, lookup))
+            finally:
+                connections.close_all()
+        # Run each worker in a copy of this context, so it uses the same directory.
+        threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(worker, run))
+            for run
+            in sessions
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    async def _run_asyncio(self, sessions, next_lookup, results, operation, password, no_db):
+        async def task(run):
+            if operation == 'authenticate' and not no_db:
+                async def run_async(lookup):
+                    return await run_authentication_async(password=password, **lookup) is not None
+            else:
+                run_async = sync_to_async(run, thread_sensitive=False)
+            for lookup in iter(next_lookup, None):
+                start = time.perf_counter()
+                try:
+                    outcome = "ok" if await run_async(lookup) else "rejected"
+                except Exception as ex:
+                    outcome = ex.__class__.__name__
+                results.add((time.perf_counter() - start) * 1000, outcome)
+        await asyncio.gather(*(task(run) for run in sessions))
+
+    def _write_table(self, report):
+        self.stdout.write("operations: {operations} in {seconds:.1f}s ({throughput:.1f} ops/s)".format(**report))
+        self.stdout.write("outcomes: {outcomes}".format(outcomes=", ".join(
+            "{outcome} {count}".format(outcome=outcome, count=count)
+            for outcome, count
+            in sorted(report["outcomes"].items())
+        ) or "-"))
+        if report["operations"]:
+            self.stdout.write(
+                "latency ms: min {min:.1f}, p50 {p50:.1f}, p90 {p90:.1f}, p99 {p99:.1f}, max {max:.1f}".format(
+                    **report["latency"]
+                )
+            )
+        self.stdout.write("histogram:")
+        for bucket in report["histogram"]:
+            self.stdout.write("    {le:>10} {count:>9}".format(
+                le="<= {le} ms".format(le=bucket["le"]) if bucket["le"] is not None else "> {le} ms".format(
+                    le=HISTOGRAM_BUCKETS[-1],
+                ),
+                count=bucket["count"],
+            ))
+
+    @slowlog.entry_point("ldap_bench")
+    def handle(self, *args, **kwargs):
+        lookups = list(group_lookup_args(*kwargs['lookups']))
+        operation = kwargs['operation']
+        password = kwargs.get('password')
+        no_db = kwargs.get('no_db', False)
+        if operation == 'authenticate' and not password:
+            raise CommandError("--password is required for the authenticate operation")
+        # Hand out operations from a shared counter, until the duration or number of operations is reached.
+        lock = threading.Lock()
+        count = 0
+        operations = kwargs.get('operations')
+        deadline = None if operations else time.monotonic() + kwargs['duration']
+
+        def next_lookup():
+            nonlocal count
+            with lock:
+                if (operations is not None and count >= operations) or (
+                    deadline is not None and time.monotonic() >= deadline
+                ):
+                    return None
+                count += 1
+                return lookups[(count - 1) % len(lookups)]
+        results = BenchResults()
+        with ExitStack() as stack:
+            sessions = [
+                stack.enter_context(self._open_session(operation, password, no_db))
+                for _ in range(kwargs['concurrency'])
+            ]
+            start = time.monotonic()
+            if kwargs.get('asyncio'):
+                asyncio.run(self._run_asyncio(sessions, next_lookup, results, operation, password, no_db))
+            else:
+                self._run_threads(sessions, next_lookup, results)
+            elapsed = time.monotonic() - start
+        report = results.get_report(elapsed)
+        if kwargs.get('format') == 'json':
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+        else:
+            self._write_table(report)
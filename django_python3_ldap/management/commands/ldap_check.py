@@ -0,0 +1,194 @@
+import json
+import socket
+import time
+
+import ldap3
+from ldap3.core.exceptions import LDAPException
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from django_python3_ldap import ldap, referrals
+from django_python3_ldap.conf import settings
+from django_python3_ldap.management.base import DirectoryCommandMixin
+from django_python3_ldap.utils import format_search_filter, get_search_bases, group_lookup_args, percentile
+
+
+PHASES = ("dns", "tcp", "connect", "start_tls", "bind", "search")
+
+# Controls and extensions reported from the root DSE, by OID.
+CAPABILITIES = (
+    ("paged_results", "supportedControl", "1.2.840.113556.1.4.319"),
+    ("server_side_sort", "supportedControl", "1.2.840.113556.1.4.473"),
+    ("vlv", "supportedControl", "2.16.840.1.113730.3.4.9"),
+    ("persistent_search", "supportedControl", "2.16.840.1.113730.3.4.3"),
+    ("ad_notification", "supportedControl", "1.2.840.113556.1.4.528"),
+    ("dirsync", "supportedControl", "1.2.840.113556.1.4.841"),
+    ("syncrepl", "supportedControl", "1.3.6.1.4.1.4203.1.9.1.1"),
+    ("start_tls", "supportedExtension", "1.3.6.1.4.1.1466.20037"),
+    ("who_am_i", "supportedExtension", "1.3.6.1.4.1.4203.1.11.3"),
+)
+
+
+class Command(DirectoryCommandMixin, BaseCommand):
+
+    help = "Measures the latency of each LDAP server in LDAP_AUTH_URL, and reports its supported controls."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'lookups',
+            nargs='*',
+            type=str,
+            help='Lookup values for the sample user search, matching the fields specified in '
+                 'LDAP_AUTH_USER_LOOKUP_FIELDS. If this is not provided then the query user is searched for.'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=5,
+            help='The number of times to connect to each server.'
+        )
+        parser.add_argument(
+            '--format',
+            choices=('table', 'json'),
+            default='table',
+            help='The output format.'
+        )
+
+    @staticmethod
+    def _get_lookup(lookups):
+        if lookups:
+            lookup = list(group_lookup_args(*lookups))
+            if len(lookup) != 1:
+                raise CommandError("Give the lookup values of a single user")
+            return lookup[0]
+        return {get_user_model().USERNAME_FIELD: settings.LDAP_AUTH_CONNECTION_USERNAME or "ldap_check"}
+
+    @staticmethod
+    def _time(timings, phase, func):
+        start = time.perf_counter()
+        result = func()
+        timings.setdefault(phase, []).append((time.perf_counter() - start) * 1000)
+        return result
+
+    def _check_once(self, server, lookup, timings):
+        """
+        Times each phase of connecting to the server and searching for a user, on a new connection.
+        """
+        self._time(timings, "dns", lambda: socket.getaddrinfo(server.host, server.port, 0, socket.SOCK_STREAM))
+        self._time(timings, "tcp", lambda: socket.create_connection(
+            (server.host, server.port),
+            timeout=settings.LDAP_AUTH_CONNECT_TIMEOUT,
+        ).close())
+        # Follow referrals as logins do, so the search timings match theirs.
+        c = referrals.configure(ldap3.Connection(
+            server,
+            user=ldap._get_query_user(),
+            password=settings.LDAP_AUTH_CONNECTION_PASSWORD,
+            auto_bind=False,
+            raise_exceptions=True,
+            receive_timeout=settings.LDAP_AUTH_RECEIVE_TIMEOUT,
+        ))
+        try:
+            self._time(timings, "connect", c.open)
+            if settings.LDAP_AUTH_USE_TLS:
+                self._time(timings, "start_tls", lambda: c.start_tls(read_server_info=False))
+            self._time(timings, "bind", lambda: c.bind(read_server_info=False))
+            search_filter = format_search_filter(lookup)
+            self._time(timings, "search", lambda: any(
+                ldap.Connection(c)._search_user_base(c, search_base, search_scope, search_filter)
+                for search_base, search_scope
+                in get_search_bases()
+            ))
+        finally:
+            c.unbind()
+
+    @staticmethod
+    def _get_capabilities(server):
+        c = ldap.open_query_connection(server)
+        try:
+            c.search(
+                search_base="",
+                search_filter="(objectClass=*)",
+                search_scope=ldap3.BASE,
+                attributes=["supportedControl", "supportedExtension", "vendorName", "vendorVersion"],
+            )
+            attributes = c.response[0]["attributes"] if c.response else {}
+        finally:
+            c.unbind()
+        capabilities = {
+            name: oid in attributes.get(attribute, ())
+            for name, attribute, oid
+            in CAPABILITIES
+        }
+        for attribute in ("vendorName", "vendorVersion"):
+            value = attributes.get(attribute)
+            capabilities[attribute] = (value[0] if isinstance(value, list) and value else value) or None
+        return capabilities
+
+    def _check(self, url, lookup, iterations):
+        server = ldap._get_server(url)
+        timings = {}
+        errors = []
+        for _ in range(iterations):
+            try:
+                self._check_once(server, lookup, timings)
+            except (LDAPException, OSError) as ex:
+                errors.append(str(ex))
+        try:
+            capabilities = self._get_capabilities(server)
+        except (LDAPException, OSError) as ex:
+            capabilities = None
+            errors.append(str(ex))
+        return {
+            "url": url,
+            "timings": {
+                phase: {
+                    "min": min(timings[phase]),
+                    "p50": percentile(timings[phase], 50),
+                    "p99": percentile(timings[phase], 99),
+                }
+                for phase
+                in PHASES
+                if phase in timings
+            },
+            "capabilities": capabilities,
+            "errors": errors,
+        }
+
+    def _write_table(self, results):
+        for result in results:
+            self.stdout.write(result["url"])
+            self.stdout.write("    {phase:<10} {min:>9} {p50:>9} {p99:>9}".format(
+                phase="phase", min="min ms", p50="p50 ms", p99="p99 ms",
+            ))
+            for phase, stats in result["timings"].items():
+                self.stdout.write("    {phase:<10} {min:>9.1f} {p50:>9.1f} {p99:>9.1f}".format(phase=phase, **stats))
+            if result["capabilities"] is not None:
+                self.stdout.write("    supports: {supported}".format(
+                    supported=", ".join(
+                        name
+                        for name, _, _
+                        in CAPABILITIES
+                        if result["capabilities"][name]
+                    ) or "-",
+                ))
+            for error in result["errors"]:
+                self.stdout.write("    error: {error}".format(error=error))
+
+    def handle(self, *args, **kwargs):
+        lookup = self._get_lookup(kwargs.get('lookups', []))
+        iterations = kwargs.get('iterations', 5)
+        auth_url = settings.LDAP_AUTH_URL
+        if not isinstance(auth_url, list):
+            auth_url = [auth_url]
+        results = [self._check(url, lookup, iterations) for url in auth_url]
+        if kwargs.get('format') == 'json':
+            self.stdout.write(json.dumps({"servers": results}, indent=2, sort_keys=True))
+        else:
+            self._write_table(results)
+        failed = sum(1 for result in results if result["errors"])
+        if failed:
+            raise CommandError("{failed} of {total} LDAP servers reported errors".format(
+                failed=failed,
+                total=len(results),
+            ))
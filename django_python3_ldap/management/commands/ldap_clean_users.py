@@ -3,12 +3,13 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 from django.db.models import ProtectedError
 
-from django_python3_ldap import ldap
-from django_python3_ldap.conf import settings
+from django_python3_ldap import ldap, slowlog
+from django_python3_ldap.conf import get_directory, settings
+from django_python3_ldap.management.base import DirectoryCommandMixin
 from django_python3_ldap.utils import group_lookup_args
 
 
-class Command(BaseCommand):
+class Command(DirectoryCommandMixin, BaseCommand):
 
     help = "Remove local user models for users not find anymore in the remote LDAP authentication server."
 
@@ -80,6 +81,7 @@ class Command(BaseCommand):
             user.save()
 
     @transaction.atomic()
+    @slowlog.entry_point("ldap_clean_users")
     def handle(self, *args, **kwargs):
         verbosity = int(kwargs.get("verbosity", 1))
         purge = kwargs.get('purge', False)
@@ -91,7 +93,7 @@ class Command(BaseCommand):
             User.USERNAME_FIELD: settings.LDAP_AUTH_CONNECTION_USERNAME,
             'password': settings.LDAP_AUTH_CONNECTION_PASSWORD
         }
-        with ldap.connection(**auth_kwargs) as connection:
+        with ldap.connection(negative_cache=False, **auth_kwargs) as connection:
             if connection is None:
                 raise CommandError("Could not connect to LDAP server")
             for user in self._iter_local_users(User, lookups, superuser, staff):
@@ -100,6 +102,9 @@ class Command(BaseCommand):
                 user_kwargs = {
                     User.USERNAME_FIELD: getattr(user, User.USERNAME_FIELD)
                 }
+                # Leave users that belong to another directory.
+                if ldap.route_directory(user_kwargs) != get_directory():
+                    continue
                 if connection.has_user(**user_kwargs):
                     # User still exists on LDAP side
                     continue
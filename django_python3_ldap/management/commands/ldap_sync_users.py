@@ -1,13 +1,73 @@
+import base64
+import csv
+import json
+import queue
+from contextlib import closing, contextmanager
+from datetime import date, datetime
+
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
-from django_python3_ldap import ldap
+from django_python3_ldap import ldap, slowlog
 from django_python3_ldap.conf import settings
-from django_python3_ldap.utils import group_lookup_args
+from django_python3_ldap.management.base import DirectoryCommandMixin
+from django_python3_ldap.ldif import iter_ldif_entries
+from django_python3_ldap.utils import (
+    format_sync_shard_filters,
+    get_memory_usage,
+    get_peak_memory_usage,
+    group_lookup_args,
+    iter_batches,
+    iter_threaded,
+)
+
+
+EXPORT_FORMATS = ("jsonl", "csv")
+
+# The smallest page and batch size a memory-bounded sync shrinks to.
+MIN_COMPACT_BATCH_SIZE = 10
+
+
+def _format_export_value(value):
+    """
+    Formats an LDAP attribute value for export.
+    """
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [_format_export_value(item) for item in value]
+    return value
+
+
+class MemoryBudget(object):
 
+    """
+    The page and batch size of a compact sync.
 
-class Command(BaseCommand):
+    The size is halved while the resident memory of the process is above the limit,
+    and doubled back towards the initial size while it is below half the limit.
+    """
+
+    def __init__(self, size, limit=None):
+        self.max_size = self.size = size
+        self.limit = limit
+
+    def adjust(self):
+        if self.limit is None:
+            return
+        usage = get_memory_usage()
+        if usage is None:
+            return
+        if usage > self.limit:
+            self.size = max(MIN_COMPACT_BATCH_SIZE, self.size // 2)
+        elif usage < self.limit / 2:
+            self.size = min(self.max_size, self.size * 2)
+
+
+class Command(DirectoryCommandMixin, BaseCommand):
 
     help = "Creates local user models for users found in the remote LDAP authentication server."
 
@@ -19,6 +79,51 @@ class Command(BaseCommand):
             help='A list of lookup values, matching the fields specified in LDAP_AUTH_USER_LOOKUP_FIELDS. '
                  'If this is not provided then ALL users are synced.'
         )
+        parser.add_argument(
+            '--export',
+            choices=EXPORT_FORMATS,
+            help='Stream the mapped user data in the given format instead of saving local user models.'
+        )
+        parser.add_argument(
+            '--output',
+            default='-',
+            help='The file to write exported user data to (by default, stdout).'
+        )
+        parser.add_argument(
+            '--from-ldif',
+            metavar='PATH',
+            help='Sync users from an LDIF file instead of the remote LDAP authentication server.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='The number of users to write to the database at once when syncing from an LDIF file '
+                 'or with --pipeline, --workers or --compact.'
+        )
+        parser.add_argument(
+            '--pipeline',
+            action='store_true',
+            help='Fetch ALL users from LDAP in a background thread, while writing them to the database in batches.'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='The number of LDAP connections used to enumerate ALL users in parallel shards.'
+        )
+        parser.add_argument(
+            '--compact',
+            action='store_true',
+            help='Fetch ALL users from LDAP one page at a time, keeping only LDAP_AUTH_SEARCH_ATTRIBUTES.'
+        )
+        parser.add_argument(
+            '--memory-limit',
+            type=int,
+            metavar='MB',
+            help='Shrink the page and batch size of a --compact sync while the process uses more memory than this. '
+                 'Implies --compact.'
+        )
 
     @staticmethod
     def _iter_synced_users(connection, lookups):
@@ -33,20 +138,197 @@ class Command(BaseCommand):
             for lookup in group_lookup_args(*lookups):
                 yield connection.get_user(**lookup)
 
-    @transaction.atomic()
+    @staticmethod
+    def _iter_pipelined_users(connection, auth_kwargs, search_filters, workers, batch_size):
+        """
+        Iterates over ALL synced users. The users are fetched by LDAP connections in background threads,
+        one shard per search filter, while the previous batch of users is written to the database.
+        The given connection is used for syncing user relations.
+        """
+        shard_filters = queue.SimpleQueue()
+        for search_filter in search_filters:
+            shard_filters.put(search_filter)
+
+        def iter_worker_entries():
+            with ldap.connection(**auth_kwargs) as worker_connection:
+                if worker_connection is None:
+                    raise CommandError("Could not connect to LDAP server")
+                while True:
+                    try:
+                        search_filter = shard_filters.get_nowait()
+                    except queue.Empty:
+                        return
+                    yield from worker_connection._iter_user_entries(search_filter)
+
+        # Fetch at most one batch ahead per worker, so memory use stays bounded.
+        entries = iter_threaded([iter_worker_entries] * workers, maxsize=max(workers, 2) * batch_size)
+        with closing(entries):
+            for batch in iter_batches(entries, batch_size):
+                yield from connection._get_or_create_users(batch)
+
+    @staticmethod
+    def _iter_compact_users(connection, budget):
+        """
+        Iterates over ALL synced users. The users are fetched as compact records, one page at a time,
+        and written to the database in batches, with the page and batch size set by the memory budget.
+        """
+        batch = []
+        for record in connection.iter_user_records(lambda: budget.size):
+            batch.append(record)
+            if len(batch) >= budget.size:
+                yield from connection._get_or_create_users(batch)
+                batch = []
+                budget.adjust()
+        if batch:
+            yield from connection._get_or_create_users(batch)
+
+    @staticmethod
+    def _iter_user_data(connection, lookups):
+        """
+        Iterates over mapped user data. If the list of lookups is empty, then all users are mapped using
+        iter_user_data. However, if lookups are provided, get_user_data is used to map each user found using
+        the lookups.
+        """
+        if len(lookups) < 1:
+            for user_data in connection.iter_user_data():
+                yield user_data
+        else:
+            for lookup in group_lookup_args(*lookups):
+                user_data = connection.get_user_data(**lookup)
+                if user_data is not None:
+                    yield user_data
+
+    @staticmethod
+    def _iter_ldif_users(ldif_file, batch_size):
+        """
+        Iterates over users synced from an LDIF file, writing them to the database in batches.
+        """
+        object_class = settings.LDAP_AUTH_OBJECT_CLASS.lower()
+        entries = (
+            entry
+            for entry
+            in iter_ldif_entries(ldif_file)
+            if object_class in (value.lower() for value in entry["attributes"].get("objectClass", ()))
+        )
+        # There is no LDAP server, so LDAP_AUTH_SYNC_USER_RELATIONS is given connection=None.
+        connection = ldap.Connection(None)
+        for batch in iter_batches(entries, batch_size):
+            yield from connection._get_or_create_users(batch)
+
+    @contextmanager
+    def _open_output(self, output):
+        if output == '-':
+            yield self.stdout
+        else:
+            with open(output, 'w', newline='', encoding='utf-8') as output_file:
+                yield output_file
+
+    def _export(self, connection, lookups, export_format, output):
+        """
+        Streams mapped user data to the output, one record at a time.
+        """
+        count = 0
+        with self._open_output(output) as output_file:
+            writer = None
+            for user_data in self._iter_user_data(connection, lookups):
+                record = {
+                    field_name: _format_export_value(value)
+                    for field_name, value
+                    in user_data.items()
+                }
+                if export_format == 'csv':
+                    if writer is None:
+                        fieldnames = list(record)
+                        fieldnames.extend(
+                            field_name
+                            for field_name
+                            in settings.LDAP_AUTH_USER_FIELDS
+                            if field_name not in record
+                        )
+                        writer = csv.DictWriter(output_file, fieldnames, lineterminator='\n')
+                        writer.writeheader()
+                    # The header has already been written, so fields added by LDAP_AUTH_CLEAN_USER_DATA
+                    # to later users can't be exported as CSV.
+                    extra_fields = sorted(set(record).difference(writer.fieldnames))
+                    if extra_fields:
+                        raise CommandError(
+                            "Cannot export fields {fields} as CSV, as they are missing from the first user. "
+                            "Use --export=jsonl instead.".format(fields=", ".join(extra_fields))
+                        )
+                    writer.writerow(record)
+                else:
+                    output_file.write(json.dumps(record, sort_keys=True) + '\n')
+                count += 1
+        return count
+
+    def _handle_ldif(self, path, batch_size, verbosity):
+        with open(path, 'r', encoding='utf-8') as ldif_file:
+            with transaction.atomic():
+                for user in self._iter_ldif_users(ldif_file, batch_size):
+                    if verbosity >= 1:
+                        self.stdout.write("Synced {user}".format(
+                            user=user,
+                        ))
+
+    @slowlog.entry_point("ldap_sync_users")
     def handle(self, *args, **kwargs):
         verbosity = int(kwargs.get("verbosity", 1))
         lookups = kwargs.get('lookups', [])
+        export_format = kwargs.get('export')
+        from_ldif = kwargs.get('from_ldif')
+        batch_size = kwargs.get('batch_size', 500)
+        pipeline = kwargs.get('pipeline', False)
+        workers = kwargs.get('workers', 1)
+        memory_limit = kwargs.get('memory_limit')
+        compact = kwargs.get('compact', False) or memory_limit is not None
+        if compact:
+            if workers > 1:
+                raise CommandError("--compact and --memory-limit cannot be combined with --workers")
+            if settings.LDAP_AUTH_SEARCH_ATTRIBUTES is None:
+                raise CommandError(
+                    "--compact requires LDAP_AUTH_SEARCH_ATTRIBUTES to list the attributes to sync, including any "
+                    "used by LDAP_AUTH_SYNC_USER_RELATIONS and LDAP_AUTH_CLEAN_USER_DATA"
+                )
+        if from_ldif:
+            if lookups or export_format:
+                raise CommandError("--from-ldif cannot be combined with lookups or --export")
+            self._handle_ldif(from_ldif, batch_size, verbosity)
+            return
         User = get_user_model()
         auth_kwargs = {
             User.USERNAME_FIELD: settings.LDAP_AUTH_CONNECTION_USERNAME,
             'password': settings.LDAP_AUTH_CONNECTION_PASSWORD
         }
-        with ldap.connection(**auth_kwargs) as connection:
+        with ldap.connection(negative_cache=False, **auth_kwargs) as connection:
             if connection is None:
                 raise CommandError("Could not connect to LDAP server")
-            for user in self._iter_synced_users(connection, lookups):
+            if export_format:
+                count = self._export(connection, lookups, export_format, kwargs.get('output', '-'))
                 if verbosity >= 1:
-                    self.stdout.write("Synced {user}".format(
-                        user=user,
+                    self.stderr.write("Exported {count} users".format(
+                        count=count,
+                    ))
+                return
+            if workers > 1 and not lookups:
+                users = self._iter_pipelined_users(
+                    connection, auth_kwargs, format_sync_shard_filters(), workers, batch_size,
+                )
+            elif compact and not lookups:
+                budget = MemoryBudget(batch_size, memory_limit and memory_limit * 1024 * 1024)
+                users = self._iter_compact_users(connection, budget)
+            elif pipeline and not lookups:
+                users = self._iter_pipelined_users(connection, auth_kwargs, [None], 1, batch_size)
+            else:
+                users = self._iter_synced_users(connection, lookups)
+            with transaction.atomic(), closing(users):
+                for user in users:
+                    if verbosity >= 1:
+                        self.stdout.write("Synced {user}".format(
+                            user=user,
+                        ))
+            if compact and verbosity >= 1:
+                peak_memory = get_peak_memory_usage()
+                if peak_memory is not None:
+                    self.stderr.write("Peak memory: {peak_memory:.1f} MB".format(
+                        peak_memory=peak_memory / (1024 * 1024),
                     ))
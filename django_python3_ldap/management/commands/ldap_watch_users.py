@@ -0,0 +1,319 @@
+import base64
+import json
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+
+import ldap3
+from ldap3.core.exceptions import LDAPException, LDAPSessionTerminatedByServerError
+from ldap3.utils.conv import escape_filter_chars
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from django_python3_ldap import ldap, slowlog
+from django_python3_ldap.conf import settings
+from django_python3_ldap.management.base import DirectoryCommandMixin
+from django_python3_ldap.utils import (
+    format_generalized_time, format_search_filter, get_search_bases, get_user_search_attributes, is_in_search_base,
+    iter_batches,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+WATCH_MODES = ("psearch", "ad-notify", "dirsync")
+
+MAX_RECONNECT_DELAY = 60
+
+# The <GUID=...>;<SID=...>; prefix of DNs returned with the Active Directory extended DN control.
+_EXTENDED_DN_PREFIX_RE = re.compile(r"^(<[^>]*>;)*")
+
+
+def _get_naming_context(dn):
+    """
+    Returns the domain naming context containing the given DN.
+    """
+    return ",".join(
+        rdn.strip()
+        for rdn
+        in dn.split(",")
+        if rdn.strip().lower().startswith("dc=")
+    )
+
+
+class Command(DirectoryCommandMixin, BaseCommand):
+
+    help = "Keeps local user models in sync with the remote LDAP authentication server as users change."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--mode',
+            choices=WATCH_MODES,
+            default='psearch',
+            help='How to receive changes: a persistent search (most LDAP servers), the Active Directory change '
+                 'notification control, or polling Active Directory DirSync.'
+        )
+        parser.add_argument(
+            '--state',
+            metavar='PATH',
+            help='A file to store the sync position in, so a restarted watch resumes where it stopped.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='The maximum number of changed users to write to the database at once.'
+        )
+        parser.add_argument(
+            '--batch-interval',
+            type=float,
+            default=1.0,
+            help='The number of seconds to wait for more changes before writing a batch.'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=30.0,
+            help='The number of seconds between DirSync polls.'
+        )
+        parser.add_argument(
+            '--reconnect-delay',
+            type=float,
+            default=5.0,
+            help='The number of seconds to wait before reconnecting after an error. '
+                 'The delay doubles after each failed attempt, up to {max_delay} seconds.'.format(
+                     max_delay=MAX_RECONNECT_DELAY,
+                 )
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Apply changes made since the stored sync position, then exit.'
+        )
+
+    @staticmethod
+    def _load_state(path, mode):
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as state_file:
+                state = json.load(state_file)
+            if state.get('mode') == mode:
+                return state
+            logger.warning("Ignoring LDAP watch state for {mode} mode".format(mode=state.get('mode')))
+        return {'mode': mode}
+
+    @staticmethod
+    def _save_state(path, state):
+        if path:
+            # Replace the state file atomically, so a crash can't leave it half written.
+            with open(path + '.tmp', 'w', encoding='utf-8') as state_file:
+                json.dump(state, state_file)
+            os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _is_user_entry(entry):
+        """
+        Returns True if a changed entry is a live user in one of the search bases.
+        """
+        if entry.get('type') != 'searchResEntry' or entry.get('changeType') == 'delete':
+            return False
+        attributes = entry.get('attributes', {})
+        if attributes.get('isDeleted') in (True, [True], 'TRUE', ['TRUE']):
+            return False
+        object_class = settings.LDAP_AUTH_OBJECT_CLASS.lower()
+        if object_class not in (value.lower() for value in attributes.get('objectClass', ())):
+            return False
+        return any(
+            is_in_search_base(entry['dn'], search_base, search_scope)
+            for search_base, search_scope
+            in get_search_bases()
+        )
+
+    def _apply(self, connection, entries, state, state_path, verbosity):
+        """
+        Writes a batch of changed user entries to the database, then stores the sync position.
+        """
+        # Keep only the latest change to each user.
+        entries = list({entry['dn'].lower(): entry for entry in entries}.values())
+        with transaction.atomic():
+            users = list(connection._get_or_create_users(entries))
+        for entry in entries:
+            modified = format_generalized_time(entry['attributes'].get('modifyTimestamp'))
+            if modified and modified > state.get('modified_since', ''):
+                state['modified_since'] = modified
+        self._save_state(state_path, state)
+        if verbosity >= 1:
+            for user in users:
+                self.stdout.write("Synced {user}".format(
+                    user=user,
+                ))
+
+    @contextmanager
+    def _listen(self, mode):
+        """
+        Starts a persistent search on each search base, on its own connection.
+        """
+        searches = []
+        try:
+            for search_base, search_scope in get_search_bases():
+                c = ldap.open_query_connection(ldap._get_server_pool(), client_strategy=ldap3.ASYNC_STREAM)
+                attributes = [*get_user_search_attributes(), ldap3.ALL_OPERATIONAL_ATTRIBUTES]
+                try:
+                    if mode == 'ad-notify':
+                        # The Active Directory notification control only allows an (objectClass=*) filter.
+                        search = c.extend.microsoft.persistent_search(
+                            search_base=search_base,
+                            search_scope=search_scope,
+                            attributes=attributes,
+                            streaming=False,
+                        )
+                    else:
+                        search = c.extend.standard.persistent_search(
+                            search_base=search_base,
+                            search_filter=format_search_filter({}),
+                            search_scope=search_scope,
+                            attributes=attributes,
+                            streaming=False,
+                        )
+                except LDAPException:
+                    c.unbind()
+                    raise
+                searches.append(search)
+            yield searches
+        finally:
+            for search in searches:
+                try:
+                    search.stop()
+                except LDAPException:
+                    pass
+
+    def _next_batch(self, searches, batch_size, batch_interval):
+        """
+        Waits for changed entries, then collects more for up to batch_interval seconds.
+        """
+        entries = []
+        deadline = None
+        while len(entries) < batch_size:
+            received = False
+            for search in searches:
+                event = search.next()
+                if event is None:
+                    if search.connection.closed:
+                        raise LDAPSessionTerminatedByServerError("LDAP connection closed")
+                    continue
+                if event['type'] not in ('searchResEntry', 'searchResRef'):
+                    raise LDAPSessionTerminatedByServerError("LDAP persistent search ended")
+                received = True
+                if self._is_user_entry(event):
+                    entries.append(event)
+                    if deadline is None:
+                        deadline = time.monotonic() + batch_interval
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if not received:
+                time.sleep(0.1)
+        return entries
+
+    def _catch_up(self, connection, state, options):
+        """
+        Applies changes made since the stored sync position, or syncs all users if there is none.
+        """
+        search_filter = None
+        if state.get('modified_since'):
+            search_filter = "(modifyTimestamp>={modified_since})".format(
+                modified_since=escape_filter_chars(state['modified_since']),
+            )
+        for batch in iter_batches(connection._iter_user_entries(search_filter), options['batch_size']):
+            self._apply(connection, batch, state, options['state'], options['verbosity'])
+
+    def _watch_notifications(self, connection, mode, state, options):
+        if options['once']:
+            self._catch_up(connection, state, options)
+            return
+        with self._listen(mode) as searches:
+            # The persistent searches are started before catching up, so no change is missed.
+            self._catch_up(connection, state, options)
+            while True:
+                batch = self._next_batch(searches, options['batch_size'], options['batch_interval'])
+                self._apply(connection, batch, state, options['state'], options['verbosity'])
+
+    def _watch_dirsync(self, connection, state, options):
+        search_filter = format_search_filter({})
+        # DirSync returns only changed attributes, so changed users are read in full before being saved.
+        search_bases = get_search_bases()
+        naming_contexts = sorted({_get_naming_context(search_base) for search_base, _ in search_bases})
+        cookies = state.setdefault('cookies', {})
+        while True:
+            more_results = False
+            for naming_context in naming_contexts:
+                cookie = cookies.get(naming_context)
+                dir_sync = connection._connection.extend.microsoft.dir_sync(
+                    sync_base=naming_context,
+                    sync_filter=search_filter,
+                    attributes=['objectClass'],
+                    cookie=base64.b64decode(cookie) if cookie else None,
+                )
+                changed_dns = {
+                    _EXTENDED_DN_PREFIX_RE.sub("", entry['dn'])
+                    for entry
+                    in dir_sync.loop()
+                    if entry['type'] == 'searchResEntry'
+                }
+                entries = []
+                for dn in changed_dns:
+                    if any(
+                        is_in_search_base(dn, search_base, search_scope)
+                        for search_base, search_scope
+                        in search_bases
+                    ):
+                        entry = connection._search_user_base(connection._connection, dn, ldap3.BASE, search_filter)
+                        if entry is not None:
+                            entries.append(entry)
+                cookies[naming_context] = base64.b64encode(dir_sync.cookie).decode('ascii')
+                if entries:
+                    for batch in iter_batches(entries, options['batch_size']):
+                        self._apply(connection, batch, state, options['state'], options['verbosity'])
+                else:
+                    self._save_state(options['state'], state)
+                more_results = more_results or dir_sync.more_results
+            if not more_results:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+
+    def _watch(self, mode, state, options):
+        User = get_user_model()
+        auth_kwargs = {
+            User.USERNAME_FIELD: settings.LDAP_AUTH_CONNECTION_USERNAME,
+            'password': settings.LDAP_AUTH_CONNECTION_PASSWORD
+        }
+        with ldap.connection(**auth_kwargs) as connection:
+            if connection is None:
+                raise LDAPException("Could not connect to LDAP server")
+            if mode == 'dirsync':
+                self._watch_dirsync(connection, state, options)
+            else:
+                self._watch_notifications(connection, mode, state, options)
+
+    @slowlog.entry_point("ldap_watch_users")
+    def handle(self, *args, **options):
+        mode = options['mode']
+        state = self._load_state(options['state'], mode)
+        delay = options['reconnect_delay']
+        while True:
+            started = time.monotonic()
+            try:
+                self._watch(mode, state, options)
+                return
+            except LDAPException as ex:
+                if options['once']:
+                    raise CommandError("LDAP watch failed: {ex}".format(ex=ex))
+                # Start backing off again after a connection that stayed up.
+                if time.monotonic() - started > MAX_RECONNECT_DELAY:
+                    delay = options['reconnect_delay']
+                logger.warning("LDAP watch failed: {ex}, reconnecting in {delay} seconds".format(ex=ex, delay=delay))
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
@@ -0,0 +1,155 @@
+"""
+Referral policy for LDAP connections.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from collections import Counter
+
+from ldap3.core.exceptions import LDAPException
+from django.core.exceptions import ImproperlyConfigured
+
+from django_python3_ldap import slowlog
+from django_python3_ldap.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+REFERRAL_POLICIES = ("follow", "allowlist", "ignore")
+
+# The number of referrals being followed, and the time the first was followed, in the current thread.
+_hops = contextvars.ContextVar("django_python3_ldap.referrals.hops", default=0)
+_started = contextvars.ContextVar("django_python3_ldap.referrals.started", default=None)
+
+_lock = threading.Lock()
+_counts = Counter()
+
+
+def _count(name):
+    with _lock:
+        _counts[name] += 1
+
+
+def get_metrics():
+    """
+    Returns counts of referrals followed, failed and skipped, and of referral
+    connections opened and reused.
+    """
+    with _lock:
+        return {
+            name: _counts[name]
+            for name
+            in ("followed", "failed", "hop_limited", "time_limited", "connections", "reused")
+        }
+
+
+def get_allowed_referral_hosts():
+    """
+    Returns the ldap3 allowed_referral_hosts for LDAP_AUTH_REFERRALS.
+    """
+    if settings.LDAP_AUTH_REFERRALS == "allowlist":
+        return [(host, True) for host in settings.LDAP_AUTH_REFERRAL_HOSTS]
+    return [("*", True)]
+
+
+def _set_receive_timeout(connection, timeout):
+    """
+    Limits the time an open ldap3 connection waits for each response.
+    """
+    if connection.receive_timeout is not None:
+        timeout = min(connection.receive_timeout, timeout)
+    if connection.socket is not None:
+        connection.socket.settimeout(timeout)
+
+
+def configure(connection):
+    """
+    Applies LDAP_AUTH_REFERRALS to an ldap3 connection, and to the referral connections it opens.
+
+    Referral connections are kept open and reused by later operations on the same connection
+    only, and are closed with it. Referrals beyond LDAP_AUTH_REFERRAL_HOP_LIMIT hops, or more
+    than LDAP_AUTH_REFERRAL_TIME_LIMIT seconds after the first referral was followed, are
+    ignored, and each hop may only wait for the server for the time that remains.
+    """
+    if settings.LDAP_AUTH_REFERRALS not in REFERRAL_POLICIES:
+        raise ImproperlyConfigured("LDAP_AUTH_REFERRALS must be one of {policies}".format(
+            policies=", ".join(REFERRAL_POLICIES),
+        ))
+    if settings.LDAP_AUTH_REFERRALS == "ignore":
+        connection.auto_referrals = False
+        return connection
+    connection.auto_referrals = True
+    connection.use_referral_cache = True
+    strategy = connection.strategy
+    create_referral_connection = strategy.create_referral_connection
+    do_operation_on_referral = strategy.do_operation_on_referral
+    target = {}
+
+    def create(referrals):
+        cached = list(strategy.referral_cache.values())
+        timeout = target.get("timeout")
+        receive_timeout = connection.receive_timeout
+        # ldap3 opens and binds a new referral connection with this connection's receive timeout.
+        if timeout is not None:
+            connection.receive_timeout = timeout if receive_timeout is None else min(receive_timeout, timeout)
+        try:
+            selected_referral, referral_connection, cachekey = create_referral_connection(referrals)
+        finally:
+            connection.receive_timeout = receive_timeout
+        if referral_connection is not None:
+            if any(referral_connection is c for c in cached):
+                _count("reused")
+            else:
+                _count("connections")
+                referral_connection.receive_timeout = receive_timeout
+                configure(referral_connection)
+            if timeout is not None:
+                _set_receive_timeout(referral_connection, timeout)
+            target["connection"] = referral_connection
+        return selected_referral, referral_connection, cachekey
+
+    def follow(request, referrals):
+        hops = _hops.get() + 1
+        hop_limit = settings.LDAP_AUTH_REFERRAL_HOP_LIMIT
+        if hop_limit is not None and hops > hop_limit:
+            _count("hop_limited")
+            logger.warning("LDAP referral ignored after {hop_limit} hops".format(hop_limit=hop_limit))
+            return None, None
+        now = time.perf_counter()
+        started = _started.get()
+        time_limit = settings.LDAP_AUTH_REFERRAL_TIME_LIMIT
+        if started is not None and time_limit is not None and now - started > time_limit:
+            _count("time_limited")
+            logger.warning("LDAP referral ignored after {time_limit} seconds".format(time_limit=time_limit))
+            return None, None
+        hops_token = _hops.set(hops)
+        started_token = _started.set(started if started is not None else now)
+        target.clear()
+        if time_limit is not None:
+            target["timeout"] = max(time_limit - (now - (started if started is not None else now)), 0.001)
+        try:
+            result = do_operation_on_referral(request, referrals)
+        except LDAPException as ex:
+            _count("failed")
+            logger.warning("LDAP referral failed: {ex}".format(ex=ex))
+            raise
+        finally:
+            _started.reset(started_token)
+            _hops.reset(hops_token)
+        duration = time.perf_counter() - now
+        _count("followed")
+        referral_connection = target.get("connection")
+        logger.info("LDAP followed referral to {server} in {duration:.3f}s (hop {hops})".format(
+            server=getattr(getattr(referral_connection, "server", None), "name", None),
+            duration=duration,
+            hops=hops,
+        ))
+        slowlog.record("referral", referral_connection, duration, request.get("filter"))
+        return result
+
+    strategy.create_referral_connection = create
+    strategy.do_operation_on_referral = follow
+    return connection
@@ -0,0 +1,130 @@
+"""
+Background refresh of local user attributes.
+"""
+
+import contextvars
+import logging
+import queue
+import threading
+from collections import Counter
+
+from django.db import close_old_connections
+
+from django_python3_ldap.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshPool(object):
+
+    """
+    A bounded pool of daemon threads that run refresh jobs in the background.
+
+    At most one job per key is queued or running at a time, and jobs submitted
+    while the queue is full are dropped. Worker threads are started on first use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+        self._pending = set()
+        self._running = 0
+        self._counts = Counter()
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = queue.Queue(maxsize=settings.LDAP_AUTH_ATTRIBUTE_REFRESH_QUEUE_SIZE)
+        while len(self._threads) < settings.LDAP_AUTH_ATTRIBUTE_REFRESH_WORKERS:
+            thread = threading.Thread(
+                target=self._run,
+                name="django_python3_ldap.refresh-{number}".format(number=len(self._threads)),
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, func):
+        """
+        Queues the function to be called in the background, unless a job with the
+        same key is already queued or running.
+
+        Returns True if the job was queued.
+        """
+        with self._lock:
+            if key in self._pending:
+                self._counts["deduplicated"] += 1
+                return False
+            self._start()
+            try:
+                self._queue.put_nowait((key, contextvars.copy_context(), func))
+            except queue.Full:
+                self._counts["dropped"] += 1
+                logger.warning("LDAP background refresh queue is full")
+                return False
+            self._pending.add(key)
+            self._counts["submitted"] += 1
+            return True
+
+    def _run(self):
+        while True:
+            key, context, func = self._queue.get()
+            with self._lock:
+                self._running += 1
+            outcome = "failed"
+            try:
+                context.run(func)
+                outcome = "completed"
+            except Exception:
+                logger.exception("LDAP background refresh failed")
+            finally:
+                close_old_connections()
+                with self._lock:
+                    self._running -= 1
+                    self._pending.discard(key)
+                    self._counts[outcome] += 1
+                self._queue.task_done()
+
+    def join(self):
+        """
+        Waits until all queued jobs have finished.
+        """
+        if self._queue is not None:
+            self._queue.join()
+
+    def get_metrics(self):
+        """
+        Returns a dict of queue metrics.
+        """
+        with self._lock:
+            return {
+                "workers": len(self._threads),
+                "queued": self._queue.qsize() if self._queue is not None else 0,
+                "running": self._running,
+                "submitted": self._counts["submitted"],
+                "completed": self._counts["completed"],
+                "failed": self._counts["failed"],
+                "deduplicated": self._counts["deduplicated"],
+                "dropped": self._counts["dropped"],
+            }
+
+
+_pool = RefreshPool()
+
+
+def submit(key, func):
+    """
+    Queues a background refresh job in the shared pool.
+    """
+    return _pool.submit(key, func)
+
+
+def get_metrics():
+    """
+    Returns a dict of metrics for the shared background refresh pool.
+
+    The counts of submitted, completed, failed, deduplicated and dropped jobs
+    are totals since the process started.
+    """
+    return _pool.get_metrics()
@@ -0,0 +1,143 @@
+"""
+A persisted cache of LDAP server schemas, for typed attribute decoding.
+"""
+
+import contextvars
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import ldap3
+from ldap3.core.exceptions import LDAPException
+from ldap3.protocol.rfc4512 import DsaInfo, SchemaInfo
+
+from django_python3_ldap.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_paths(server):
+    """
+    Returns the paths of the cached (DSA info, schema) files for the given server.
+    """
+    name = re.sub(r"[^A-Za-z0-9.-]", "_", "{host}-{port}".format(host=server.host, port=server.port))
+    return (
+        os.path.join(settings.LDAP_AUTH_SCHEMA_CACHE_DIR, name + ".info.json"),
+        os.path.join(settings.LDAP_AUTH_SCHEMA_CACHE_DIR, name + ".schema.json"),
+    )
+
+
+def _write_json(path, info):
+    # Replace the file atomically, so other processes never read it half written. Each writer
+    # uses its own temporary file, so concurrent writers never interleave.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as cache_file:
+            cache_file.write(info.to_json(indent=None))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _attach(server, info, schema_info):
+    server.attach_dsa_info(info)
+    server.attach_schema_info(schema_info)
+
+
+def load(server):
+    """
+    Attaches the cached DSA info and schema to the given server, if they can be read,
+    returning False if they are missing, unreadable or older than LDAP_AUTH_SCHEMA_CACHE_TTL seconds.
+
+    A stale schema is still attached, as it's better than no schema until it's refreshed.
+    """
+    info_path, schema_path = get_cache_paths(server)
+    try:
+        modified = min(os.path.getmtime(info_path), os.path.getmtime(schema_path))
+        info = DsaInfo.from_file(info_path)
+        schema_info = SchemaInfo.from_file(schema_path)
+    except (OSError, ValueError, LookupError, TypeError, LDAPException) as ex:
+        # A corrupt cache is treated as missing, and replaced by the next fetch.
+        if not isinstance(ex, FileNotFoundError):
+            logger.warning("LDAP schema cache for {server} is unreadable: {ex}".format(server=server.name, ex=ex))
+        return False
+    _attach(server, info, schema_info)
+    ttl = settings.LDAP_AUTH_SCHEMA_CACHE_TTL
+    return ttl is None or time.time() - modified <= ttl
+
+
+def fetch(server, connect):
+    """
+    Reads the DSA info and schema from the given server, attaches them, and writes them to the cache.
+
+    `connect` should open a bound ldap3 connection to the server.
+    """
+    c = connect(server)
+    get_info = server.get_info
+    try:
+        server.get_info = ldap3.ALL
+        server.get_info_from_server(c)
+    finally:
+        server.get_info = get_info
+        c.unbind()
+    if server.info is None or server.schema is None:
+        raise LDAPException("LDAP server {server} returned no schema".format(server=server.name))
+    os.makedirs(settings.LDAP_AUTH_SCHEMA_CACHE_DIR, exist_ok=True)
+    info_path, schema_path = get_cache_paths(server)
+    _write_json(info_path, server.info)
+    _write_json(schema_path, server.schema)
+
+
+_fetches = {}  # cache paths -> servers waiting for the fetched schema
+_fetches_lock = threading.Lock()
+
+
+def _fetch_in_background(key, server, connect):
+    try:
+        fetch(server, connect)
+        logger.info("LDAP schema cached for {server}".format(server=server.name))
+    except (LDAPException, OSError) as ex:
+        logger.warning("LDAP schema fetch failed for {server}: {ex}".format(server=server.name, ex=ex))
+    finally:
+        with _fetches_lock:
+            waiting = _fetches.pop(key)
+    if server.schema is not None:
+        for other in waiting:
+            if other is not server:
+                _attach(other, server.info, server.schema)
+
+
+def attach(server, connect):
+    """
+    Attaches the schema of the given server from the cache in LDAP_AUTH_SCHEMA_CACHE_DIR,
+    fetching it in a background thread if the cache is missing or stale.
+
+    Reading the cache never touches the network, so the first connection isn't held up by the
+    fetch. Servers for the same host and port share one fetch, and each gets the schema once
+    it arrives. Until then, a stale cached schema is used, if there is one.
+
+    Returns the thread fetching the schema, or None if the cached schema is fresh or
+    another thread is already fetching it.
+    """
+    if load(server):
+        return None
+    key = get_cache_paths(server)
+    with _fetches_lock:
+        waiting = _fetches.get(key)
+        if waiting is not None:
+            waiting.append(server)
+            return None
+        _fetches[key] = [server]
+    thread = threading.Thread(
+        target=contextvars.copy_context().run,
+        args=(_fetch_in_background, key, server, connect),
+        name="django_python3_ldap.schema",
+        daemon=True,
+    )
+    thread.start()
+    return thread
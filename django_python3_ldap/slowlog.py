@@ -0,0 +1,166 @@
+"""
+Logging of slow LDAP operations.
+"""
+
+import contextvars
+import logging
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from django_python3_ldap.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+_entry_point = contextvars.ContextVar("django_python3_ldap.slowlog.entry_point", default=None)
+
+# The value of each filter item, up to its closing parenthesis. Escaped parentheses are part of the value.
+_FILTER_VALUE_RE = re.compile(r"(~=|>=|<=|:=|=)((?:[^()\\]|\\.)*)\)")
+
+
+def get_filter_fingerprint(search_filter):
+    """
+    Returns the search filter with its values redacted, so similar searches
+    share a fingerprint and no user data is logged. Presence filters are kept.
+    """
+    if search_filter is None:
+        return None
+    return _FILTER_VALUE_RE.sub(
+        lambda match: match.group(0) if match.group(2) == "*" else match.group(1) + "?)",
+        search_filter,
+    )
+
+
+@contextmanager
+def entry_point(name):
+    """
+    Names the entry point of LDAP operations within the block, for the slow operation log.
+
+    This can also be used as a function decorator.
+    """
+    token = _entry_point.set(name)
+    try:
+        yield
+    finally:
+        _entry_point.reset(token)
+
+
+class RateLimiter(object):
+
+    """
+    A thread-safe token bucket, counting the calls it rejects.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._updated = None
+        self._suppressed = 0
+
+    def acquire(self, capacity, period):
+        """
+        Returns a tuple of (allowed, suppressed), where suppressed is the number of
+        calls rejected since the last allowed call.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._tokens is None:
+                self._tokens = capacity
+            else:
+                self._tokens = min(capacity, self._tokens + (now - self._updated) * capacity / period)
+            self._updated = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False, 0
+            self._tokens -= 1
+            suppressed, self._suppressed = self._suppressed, 0
+            return True, suppressed
+
+
+_rate_limiter = RateLimiter()
+
+
+def record(operation, connection, duration, search_filter=None, size=None):
+    """
+    Logs an LDAP operation if it took at least LDAP_AUTH_SLOW_OPERATION_THRESHOLD seconds,
+    subject to sampling and rate limiting.
+    """
+    threshold = settings.LDAP_AUTH_SLOW_OPERATION_THRESHOLD
+    if threshold is None or duration < threshold:
+        return
+    if random.random() >= settings.LDAP_AUTH_SLOW_OPERATION_SAMPLE_RATE:
+        return
+    allowed, suppressed = _rate_limiter.acquire(*settings.LDAP_AUTH_SLOW_OPERATION_RATE_LIMIT)
+    if not allowed:
+        return
+    server = getattr(getattr(connection, "server", None), "name", None)
+    fingerprint = get_filter_fingerprint(search_filter)
+    details = {
+        "ldap_operation": operation,
+        "ldap_server": server,
+        "ldap_filter": fingerprint,
+        "ldap_size": size,
+        "ldap_duration": duration,
+        "ldap_entry_point": _entry_point.get(),
+        "ldap_suppressed": suppressed,
+    }
+    logger.warning(
+        "LDAP slow {operation} on {server} took {duration:.3f}s "
+        "(filter {fingerprint}, size {size}, entry point {entry_point}, {suppressed} suppressed)".format(
+            operation=operation,
+            server=server,
+            duration=duration,
+            fingerprint=fingerprint,
+            size=size,
+            entry_point=details["ldap_entry_point"],
+            suppressed=suppressed,
+        ),
+        extra=details,
+    )
+
+
+@contextmanager
+def timed(operation, connection, search_filter=None):
+    """
+    Records the duration of the LDAP operation run within the block.
+
+    The size of a search is read from the connection response.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        size = None
+        if operation == "search" and isinstance(getattr(connection, "response", None), list):
+            size = len(connection.response)
+        record(operation, connection, duration, search_filter, size)
+
+
+def iter_timed_pages(connection, entries, paged_size, search_filter):
+    """
+    Yields the entries of a paged search, recording the time taken to fetch each page.
+    """
+    iterator = iter(entries)
+    duration = 0
+    count = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            entry = next(iterator)
+        except StopIteration:
+            duration += time.perf_counter() - start
+            if count:
+                record("paged_search", connection, duration, search_filter, count)
+            return
+        duration += time.perf_counter() - start
+        count += 1
+        yield entry
+        if count == paged_size:
+            record("paged_search", connection, duration, search_filter, count)
+            duration = 0
+            count = 0
@@ -1,20 +1,128 @@
 # encoding=utf-8
 from __future__ import unicode_literals
 
+import asyncio
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
 from unittest import skipUnless, skip, mock
 from io import StringIO
 
+import ldap3
 from asgiref.sync import async_to_sync
-from django.test import TestCase, override_settings
+from ldap3.core.exceptions import LDAPInvalidCredentialsResult, LDAPSocketOpenError
+from ldap3.protocol.rfc4512 import DsaInfo, SchemaInfo
+from ldap3.protocol.schemas.slapd24 import slapd_2_4_dsa_info, slapd_2_4_schema
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
 from django.conf import settings as django_settings
-from django.core.management import call_command, CommandError
+from django.core.management import call_command, load_command_class, CommandError
 
 from django_python3_ldap.auth import run_authentication_async
-from django_python3_ldap.conf import settings
-from django_python3_ldap.ldap import connection
-from django_python3_ldap.utils import clean_ldap_name, import_func
+from django_python3_ldap.cache import TTLCache
+from django_python3_ldap.conf import get_directory, settings, use_directory
+from django_python3_ldap.groups import GroupGraph
+from django_python3_ldap.ldif import iter_ldif_entries
+from django_python3_ldap.management.commands.ldap_sync_users import MemoryBudget
+from django_python3_ldap.refresh import RefreshPool
+from django_python3_ldap.tls import ResumableTls
+from django_python3_ldap import hedge, ldap, referrals, schema, slowlog, throttle
+from django_python3_ldap.ldap import Connection, connection, iter_attribute_values
+from django_python3_ldap.utils import (
+    clean_ldap_name, format_sync_shard_filters, get_memory_usage, get_search_bases, get_user_search_attributes,
+    import_func, is_in_search_base, iter_threaded, percentile, race,
+)
+
+
+def make_entries(entries):
+    """
+    Returns LDAP search result entries for the given (dn, attributes) tuples.
+    """
+    return [
+        {"type": "searchResEntry", "dn": dn, "attributes": attributes}
+        for dn, attributes
+        in entries
+    ]
+
+
+def mock_search(*entries):
+    """
+    Returns a mock LDAP connection whose searches return the given entries, keyed by search base.
+    """
+    c = mock.Mock()
+
+    def search(**kwargs):
+        c.response = make_entries(
+            (dn, attributes)
+            for dn, attributes
+            in entries
+            if dn.endswith(kwargs["search_base"])
+        )
+    c.search.side_effect = search
+    return c
+
+
+def mock_attribute_search(*attributes):
+    """
+    Returns a mock LDAP connection whose base searches return each of the given attribute dicts
+    in turn, repeating the last one.
+    """
+    c = mock.Mock()
+    c.auto_range = True
+    c.auto_ranges = []
+    remaining = list(attributes)
+
+    def search(**kwargs):
+        c.auto_ranges.append(c.auto_range)
+        chunk = remaining.pop(0) if len(remaining) > 1 else remaining[0]
+        c.response = [{"dn": kwargs["search_base"], "attributes": chunk}]
+    c.search.side_effect = search
+    return c
+
+
+def mock_paged_search(*entries):
+    """
+    Returns a mock LDAP connection whose paged searches yield the given entries.
+    """
+    c = mock.Mock()
+    c.extend.standard.paged_search.side_effect = lambda **kwargs: iter(make_entries(entries))
+    return c
+
+
+def mock_paged_pages(*pages):
+    """
+    Returns a mock LDAP connection whose manual paged searches return the given pages of entries.
+    """
+    c = mock.Mock()
+    c.page_sizes = []
+
+    def search(**kwargs):
+        c.page_sizes.append(kwargs["paged_size"])
+        index = int(kwargs["paged_cookie"] or 0)
+        c.response = make_entries(pages[index])
+        cookie = str(index + 1).encode() if index + 1 < len(pages) else b""
+        c.result = {"controls": {ldap._PAGED_RESULTS_OID: {"value": {"cookie": cookie}}}}
+    c.search.side_effect = search
+    return c
+
+
+def patch_connection(c):
+    """
+    Patches the `connection()` context manager to yield a Connection wrapping the given mock LDAP connection.
+    """
+    ldap_connection = mock.MagicMock()
+    ldap_connection.__enter__.return_value = Connection(c)
+    return mock.patch("django_python3_ldap.ldap.connection", return_value=ldap_connection)
 
 
 @skipUnless(settings.LDAP_AUTH_TEST_USER_USERNAME, "No settings.LDAP_AUTH_TEST_USER_USERNAME supplied.")
@@ -208,6 +316,13 @@ class TestLdap(TestCase):
         user_count_2 = User.objects.count()
         self.assertEqual(user_count_1, user_count_2)
 
+    def testSyncUsersExportDoesntCreateUsers(self):
+        out = StringIO()
+        call_command("ldap_sync_users", export="jsonl", verbosity=0, stdout=out)
+        rows = [json.loads(row) for row in out.getvalue().splitlines()]
+        self.assertIn(settings.LDAP_AUTH_TEST_USER_USERNAME, [row["username"] for row in rows])
+        self.assertEqual(User.objects.count(), 0)
+
     # User promotion.
 
     def testPromoteUser(self):
@@ -436,3 +551,1455 @@ class TestLdap(TestCase):
         call_command("ldap_clean_users", verbosity=0, purge=True)
         user_count_2 = User.objects.count()
         self.assertEqual(user_count_1, user_count_2)
+
+
+class TestNestedGroups(SimpleTestCase):
+
+    def testGroupGraphResolvesNestedGroups(self):
+        c = mock_paged_search(
+            ("cn=a,dc=example,dc=com", {"member": ["uid=tesla,dc=example,dc=com"]}),
+            ("cn=b,dc=example,dc=com", {"member": ["CN=A,dc=example,dc=com"]}),
+            ("cn=c,dc=example,dc=com", {"member": ["cn=b,dc=example,dc=com", "cn=c,dc=example,dc=com"]}),
+            ("cn=d,dc=example,dc=com", {"member": ["uid=euler,dc=example,dc=com"]}),
+        )
+        groups = GroupGraph().get_groups(c, "uid=tesla,dc=example,dc=com")
+        self.assertEqual(groups, {"cn=a,dc=example,dc=com", "cn=b,dc=example,dc=com", "cn=c,dc=example,dc=com"})
+
+    def testGroupGraphIsCached(self):
+        c = mock_paged_search(
+            ("cn=a,dc=example,dc=com", {"member": ["uid=tesla,dc=example,dc=com"]}),
+        )
+        graph = GroupGraph()
+        graph.get_groups(c, "uid=tesla,dc=example,dc=com")
+        graph.get_groups(c, "uid=tesla,dc=example,dc=com")
+        self.assertEqual(c.extend.standard.paged_search.call_count, 1)
+
+    def testGroupGraphDisablesAutoRange(self):
+        c = mock.Mock()
+        c.auto_range = True
+        auto_ranges = []
+
+        def paged_search(**kwargs):
+            # ldap3 runs each page's search as the results are iterated.
+            auto_ranges.append(c.auto_range)
+            yield from make_entries([
+                ("cn=a,dc=example,dc=com", {"member;range=0-0": ["uid=tesla,dc=example,dc=com"]}),
+            ])
+        c.extend.standard.paged_search.side_effect = paged_search
+
+        def search(**kwargs):
+            auto_ranges.append(c.auto_range)
+            c.response = [{
+                "dn": kwargs["search_base"],
+                "attributes": {"member;range=1-*": ["uid=euler,dc=example,dc=com"]},
+            }]
+        c.search.side_effect = search
+        groups = GroupGraph().get_groups(c, "uid=euler,dc=example,dc=com")
+        self.assertEqual(groups, {"cn=a,dc=example,dc=com"})
+        self.assertEqual(auto_ranges, [False, False])
+        self.assertTrue(c.auto_range)
+
+
+class TestRangedAttributes(SimpleTestCase):
+
+    def testIterAttributeValuesFetchesRanges(self):
+        c = mock_attribute_search(
+            {"member;range=0-1": ["cn=a", "cn=b"]},
+            {"member;range=2-3": ["cn=c", "cn=d"]},
+            {"member;range=4-*": ["cn=e"]},
+        )
+        values = list(iter_attribute_values(c, "cn=group", "member"))
+        self.assertEqual(values, ["cn=a", "cn=b", "cn=c", "cn=d", "cn=e"])
+        self.assertEqual(c.search.call_args.kwargs["attributes"], ["member;range=4-*"])
+        # ldap3 would otherwise fetch every range within the first search.
+        self.assertEqual(c.auto_ranges, [False, False, False])
+        self.assertTrue(c.auto_range)
+
+    def testIterAttributeValuesUsesGivenAttributes(self):
+        c = mock.Mock()
+        values = list(iter_attribute_values(c, "cn=group", "member", {"member": ["cn=a"], "cn": ["group"]}))
+        self.assertEqual(values, ["cn=a"])
+        c.search.assert_not_called()
+
+
+class TestSyncUsersExport(TestCase):
+
+    entries = (
+        ("uid=tesla,dc=example,dc=com", {"uid": ["tesla"], "mail": ["tesla@example.com"], "jpegPhoto": [b"\xff"]}),
+        ("uid=euler,dc=example,dc=com", {"uid": ["euler"], "sn": ["Euler"]}),
+    )
+
+    def testExportJsonl(self):
+        out = StringIO()
+        with patch_connection(mock_paged_search(*self.entries)):
+            call_command("ldap_sync_users", export="jsonl", verbosity=0, stdout=out)
+        rows = [json.loads(row) for row in out.getvalue().splitlines()]
+        self.assertEqual(rows, [
+            {"username": "tesla", "email": "tesla@example.com"},
+            {"username": "euler", "last_name": "Euler"},
+        ])
+        self.assertEqual(User.objects.count(), 0)
+
+    def testExportCsv(self):
+        out = StringIO()
+        with patch_connection(mock_paged_search(*self.entries)):
+            call_command("ldap_sync_users", export="csv", verbosity=0, stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            "username,email,first_name,last_name",
+            "tesla,tesla@example.com,,",
+            "euler,,,Euler",
+        ])
+
+    def testExportCsvRejectsLateFields(self):
+        def clean_user_data(user_fields):
+            if user_fields["username"] == "euler":
+                user_fields["department"] = "Maths"
+            return user_fields
+
+        with patch_connection(mock_paged_search(*self.entries)), \
+                mock.patch("django_python3_ldap.utils.clean_user_data", new=clean_user_data):
+            with self.assertRaisesMessage(CommandError, "department"):
+                call_command("ldap_sync_users", export="csv", verbosity=0, stdout=StringIO())
+
+
+LDIF = """version: 1
+
+# A user.
+dn: uid=tesla,dc=example,dc=com
+objectClass: inetOrgPerson
+uid: tesla
+mail: tesla@example.com
+cn: Nikola
+  Tesla
+sn:: VGVzbGE=
+jpegPhoto:: /w==
+
+dn: ou=people,dc=example,dc=com
+objectClass: organizationalUnit
+
+dn: uid=euler,dc=example,dc=com
+changetype: delete
+
+dn: uid=euler,dc=example,dc=com
+objectClass: inetOrgPerson
+uid: euler
+"""
+
+
+class TestLdif(TestCase):
+
+    def testIterLdifEntries(self):
+        entries = list(iter_ldif_entries(LDIF.splitlines(True)))
+        self.assertEqual([entry["dn"] for entry in entries], [
+            "uid=tesla,dc=example,dc=com",
+            "ou=people,dc=example,dc=com",
+            "uid=euler,dc=example,dc=com",
+        ])
+        attributes = entries[0]["attributes"]
+        self.assertEqual(attributes["cn"], ["Nikola Tesla"])
+        self.assertEqual(attributes["SN"], ["Tesla"])
+        self.assertEqual(attributes["jpegPhoto"], [b"\xff"])
+
+    def testSkipsModifyRecords(self):
+        ldif = (
+            "dn: uid=tesla,dc=example,dc=com\n"
+            "uid: tesla\n"
+            "\n"
+            "dn: uid=gauss,dc=example,dc=com\n"
+            "changetype: modify\n"
+            "replace: mail\n"
+            "mail: gauss@example.com\n"
+            "-\n"
+            "add: description\n"
+            "description: Mathematician\n"
+            "-\n"
+            "delete: telephoneNumber\n"
+            "-\n"
+            "\n"
+            "dn: uid=euler,dc=example,dc=com\n"
+            "uid: euler\n"
+        )
+        with self.assertLogs("django_python3_ldap.ldif", "WARNING"):
+            entries = list(iter_ldif_entries(ldif.splitlines(True)))
+        self.assertEqual([entry["dn"] for entry in entries], [
+            "uid=tesla,dc=example,dc=com",
+            "uid=euler,dc=example,dc=com",
+        ])
+        self.assertEqual(dict(entries[1]["attributes"]), {"uid": ["euler"]})
+
+    def testSyncUsersFromLdif(self):
+        User.objects.create(username="euler", last_name="Old")
+        with tempfile.NamedTemporaryFile("w", suffix=".ldif", delete=False) as ldif_file:
+            ldif_file.write(LDIF)
+        self.addCleanup(os.unlink, ldif_file.name)
+        call_command("ldap_sync_users", from_ldif=ldif_file.name, batch_size=1, verbosity=0)
+        self.assertEqual(sorted(User.objects.values_list("username", "last_name")), [
+            ("euler", "Old"),
+            ("tesla", "Tesla"),
+        ])
+        self.assertFalse(User.objects.get(username="tesla").has_usable_password())
+
+    @override_settings(LDAP_AUTH_LAZY_ATTRIBUTES=["thumbnailPhoto"])
+    def testSyncUsersFromLdifWithLazyAttributes(self):
+        synced = []
+
+        def sync_user_relations(user, ldap_attributes):
+            synced.append(ldap_attributes.get("thumbnailPhoto"))
+
+        with tempfile.NamedTemporaryFile("w", suffix=".ldif", delete=False) as ldif_file:
+            ldif_file.write(LDIF)
+        self.addCleanup(os.unlink, ldif_file.name)
+        with mock.patch("django_python3_ldap.utils.sync_user_relations", new=sync_user_relations):
+            call_command("ldap_sync_users", from_ldif=ldif_file.name, verbosity=0)
+        self.assertEqual(synced, [None, None])
+
+
+class TestParallelSync(TestCase):
+
+    def testFormatSyncShardFilters(self):
+        search_filters = format_sync_shard_filters()
+        self.assertEqual(len(search_filters), 37)
+        self.assertEqual(search_filters[0], "(uid=a*)")
+        self.assertTrue(search_filters[-1].startswith("(!(|(uid=a*)(uid=b*)"))
+        with self.settings(LDAP_AUTH_SYNC_SHARD_FILTERS=["(ou=a)", "(ou=b)"]):
+            self.assertEqual(format_sync_shard_filters(), ["(ou=a)", "(ou=b)"])
+
+    def testIterThreaded(self):
+        items = iter_threaded([lambda: range(1, 50), lambda: range(50, 100)], maxsize=2)
+        self.assertEqual(sorted(items), list(range(1, 100)))
+
+    def testIterThreadedPropagatesErrors(self):
+        def iter_items():
+            yield 1
+            raise ValueError("Boom")
+        with self.assertRaises(ValueError):
+            list(iter_threaded([iter_items]))
+
+    @override_settings(LDAP_AUTH_SYNC_SHARD_FILTERS=["(uid=t*)", "(!(uid=t*))"])
+    def testSyncUsersWithWorkers(self):
+        def paged_search(**kwargs):
+            usernames = ["euler", "gauss"] if "(!(uid=t*))" in kwargs["search_filter"] else ["tesla"]
+            return iter(make_entries(
+                ("uid={0},dc=example,dc=com".format(username), {"uid": [username]})
+                for username
+                in usernames
+            ))
+        c = mock_paged_search()
+        c.extend.standard.paged_search.side_effect = paged_search
+        with patch_connection(c):
+            call_command("ldap_sync_users", workers=2, batch_size=2, verbosity=0)
+        self.assertEqual(sorted(User.objects.values_list("username", flat=True)), ["euler", "gauss", "tesla"])
+
+    def testSyncUsersWithPipeline(self):
+        c = mock_paged_search(
+            ("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]}),
+            ("uid=euler,dc=example,dc=com", {"uid": ["euler"]}),
+            ("uid=gauss,dc=example,dc=com", {"uid": ["gauss"]}),
+        )
+        with patch_connection(c):
+            call_command("ldap_sync_users", pipeline=True, batch_size=2, verbosity=0)
+        self.assertEqual(sorted(User.objects.values_list("username", flat=True)), ["euler", "gauss", "tesla"])
+
+    def testSyncUsersWithPipelinePropagatesErrors(self):
+        c = mock_paged_search()
+        c.extend.standard.paged_search.side_effect = ValueError("Boom")
+        with patch_connection(c):
+            with self.assertRaises(ValueError):
+                call_command("ldap_sync_users", pipeline=True, verbosity=0)
+
+
+class TestSearchBases(SimpleTestCase):
+
+    def testGetSearchBases(self):
+        self.assertEqual(get_search_bases(), [("dc=example,dc=com", "SUBTREE")])
+        with self.settings(LDAP_AUTH_SEARCH_BASE=["ou=a,dc=example,dc=com", ("ou=b,dc=example,dc=com", "LEVEL")]):
+            self.assertEqual(get_search_bases(), [
+                ("ou=a,dc=example,dc=com", "SUBTREE"),
+                ("ou=b,dc=example,dc=com", "LEVEL"),
+            ])
+
+    def testIsInSearchBase(self):
+        self.assertTrue(is_in_search_base("uid=tesla,ou=a,dc=example,dc=com", "OU=A,DC=example,DC=com", "SUBTREE"))
+        self.assertTrue(is_in_search_base("uid=tesla,ou=x,ou=a,dc=example,dc=com", "ou=a,dc=example,dc=com", "SUBTREE"))
+        self.assertFalse(is_in_search_base("uid=tesla,ou=xa,dc=example,dc=com", "ou=a,dc=example,dc=com", "SUBTREE"))
+        self.assertFalse(is_in_search_base("uid=tesla,ou=x,ou=a,dc=example,dc=com", "ou=a,dc=example,dc=com", "LEVEL"))
+        self.assertTrue(is_in_search_base("cn=a+sn=b,ou=a,dc=example,dc=com", "ou=a,dc=example,dc=com", "LEVEL"))
+        self.assertTrue(is_in_search_base("ou=a,dc=example,dc=com", "ou=a,dc=example,dc=com", "BASE"))
+        self.assertFalse(is_in_search_base("dc=example,dc=com", "ou=a,dc=example,dc=com", "SUBTREE"))
+
+    @override_settings(
+        LDAP_AUTH_SEARCH_BASE=["ou=a,dc=example,dc=com", "ou=b,dc=example,dc=com"],
+        LDAP_AUTH_SEARCH_BASES_CONCURRENT=True,
+    )
+    def testHasUserSearchesBasesConcurrently(self):
+        connections = []
+
+        def open_connection():
+            connections.append(mock_search(("uid=tesla,ou=b,dc=example,dc=com", {"uid": ["tesla"]})))
+            return connections[-1]
+        with mock.patch.object(Connection, "_open_connection", side_effect=open_connection):
+            self.assertTrue(Connection(mock.Mock()).has_user(username="tesla"))
+        self.assertEqual(len(connections), 2)
+
+    @override_settings(
+        LDAP_AUTH_SEARCH_BASE=["ou=a,dc=example,dc=com", "ou=b,dc=example,dc=com"],
+        LDAP_AUTH_SEARCH_BASES_CONCURRENT=True,
+    )
+    def testHasUserStopsSlowerSearches(self):
+        connections = []
+
+        def open_connection():
+            c = mock_search(("uid=tesla,ou=b,dc=example,dc=com", {"uid": ["tesla"]}))
+            stopped = threading.Event()
+            search = c.search.side_effect
+
+            def slow_search(**kwargs):
+                # The search in the first base only ends when its socket is shut down.
+                if kwargs["search_base"].startswith("ou=a,"):
+                    stopped.wait(5)
+                search(**kwargs)
+            c.search.side_effect = slow_search
+            c.socket.shutdown.side_effect = lambda how: stopped.set()
+            connections.append(c)
+            return c
+        with mock.patch.object(Connection, "_open_connection", side_effect=open_connection):
+            start = time.perf_counter()
+            self.assertTrue(Connection(mock.Mock()).has_user(username="tesla"))
+        self.assertLess(time.perf_counter() - start, 1)
+        for c in connections:
+            c.socket.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+
+    @override_settings(
+        LDAP_AUTH_SEARCH_BASE=["ou=a,dc=example,dc=com", "ou=b,dc=example,dc=com"],
+        LDAP_AUTH_SEARCH_BASES_CONCURRENT=True,
+    )
+    def testHasUserUnbindsSlowerConnections(self):
+        connections = []
+        connections_lock = threading.Lock()
+        binding = threading.Event()
+        release = threading.Event()
+        unbound = threading.Event()
+
+        def open_connection():
+            c = mock_search(
+                ("uid=tesla,ou=a,dc=example,dc=com", {"uid": ["tesla"]}),
+                ("uid=tesla,ou=b,dc=example,dc=com", {"uid": ["tesla"]}),
+            )
+            with connections_lock:
+                connections.append(c)
+                slow = len(connections) > 1
+            # The second connection is still binding when the first search finishes.
+            if slow:
+                c.unbind.side_effect = unbound.set
+                binding.set()
+                release.wait(5)
+            else:
+                binding.wait(5)
+            return c
+        with mock.patch.object(Connection, "_open_connection", side_effect=open_connection):
+            self.assertTrue(Connection(mock.Mock()).has_user(username="tesla"))
+            release.set()
+            self.assertTrue(unbound.wait(5))
+        self.assertEqual(len(connections), 2)
+        connections[1].search.assert_not_called()
+
+    @override_settings(
+        LDAP_AUTH_SEARCH_BASE=["ou=a,dc=example,dc=com", "ou=b,dc=example,dc=com"],
+        LDAP_AUTH_SEARCH_BASES_CONCURRENT=False,
+    )
+    def testHasUserSearchesBasesSequentially(self):
+        c = mock_search(("uid=tesla,ou=b,dc=example,dc=com", {"uid": ["tesla"]}))
+        self.assertTrue(Connection(c).has_user(username="tesla"))
+        self.assertEqual(c.search.call_count, 2)
+
+
+class TestSearchBind(SimpleTestCase):
+
+    def setUp(self):
+        super(TestSearchBind, self).setUp()
+        ldap._dn_cache.clear()
+
+    def testTTLCache(self):
+        cache = TTLCache()
+        cache.set("a", 1, ttl=60, maxsize=2)
+        cache.set("b", 2, ttl=60, maxsize=2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3, ttl=60, maxsize=2)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("d", 4, ttl=0, maxsize=2)
+        self.assertEqual(cache.get("d"), None)
+
+    @override_settings(LDAP_AUTH_SEARCH_BIND=True)
+    def testSearchBindCachesDn(self):
+        c = mock_search(("uid=tesla,ou=people,dc=example,dc=com", {"uid": ["tesla"]}))
+        with mock.patch("ldap3.Connection", return_value=c) as ldap_connection:
+            with connection(username="tesla", password="password") as c1:
+                self.assertIsNotNone(c1)
+            c.rebind.assert_called_once_with(user="uid=tesla,ou=people,dc=example,dc=com", password="password")
+            with connection(username="tesla", password="password") as c2:
+                self.assertIsNotNone(c2)
+            self.assertEqual(ldap_connection.call_args.kwargs["user"], "uid=tesla,ou=people,dc=example,dc=com")
+        self.assertEqual(c.search.call_count, 1)
+        self.assertEqual(c.rebind.call_count, 1)
+
+    @override_settings(LDAP_AUTH_SEARCH_BIND=True)
+    def testSearchBindUnknownUser(self):
+        c = mock_search()
+        with mock.patch("ldap3.Connection", return_value=c):
+            with connection(username="tesla", password="password") as c1:
+                self.assertIsNone(c1)
+        c.rebind.assert_not_called()
+
+
+@override_settings(LDAP_AUTH_NEGATIVE_CACHE_TTL=60)
+class TestNegativeCache(TestCase):
+
+    def setUp(self):
+        super(TestNegativeCache, self).setUp()
+        ldap._negative_cache.clear()
+
+    def testHasUserCachesUnknownUsers(self):
+        c = mock_search()
+        self.assertFalse(Connection(c).has_user(username="tesla"))
+        self.assertFalse(Connection(c).has_user(username="tesla"))
+        self.assertEqual(c.search.call_count, 1)
+
+    def testAuthenticateSkipsUnknownUsers(self):
+        self.assertFalse(Connection(mock_search()).has_user(username="tesla"))
+        with mock.patch("ldap3.Connection") as ldap_connection:
+            self.assertIsNone(ldap.authenticate(username="tesla", password="password"))
+        ldap_connection.assert_not_called()
+
+    def testSyncInvalidatesUnknownUsers(self):
+        c = mock_search()
+        self.assertFalse(Connection(c).has_user(username="tesla"))
+        Connection(c)._get_or_create_user({"dn": "uid=tesla,dc=example,dc=com", "attributes": {"uid": ["tesla"]}})
+        self.assertFalse(Connection(c).has_user(username="tesla"))
+        self.assertEqual(c.search.call_count, 2)
+
+    def testBatchSyncOnlyInvalidatesCreatedUsers(self):
+        User.objects.create_user(username="euler")
+        with mock.patch.object(ldap._negative_cache, "delete_many") as delete_many, \
+                mock.patch.object(ldap._negative_cache, "delete") as delete:
+            Connection(mock_search())._get_or_create_users([
+                {"dn": "uid=tesla,dc=example,dc=com", "attributes": {"uid": ["tesla"]}},
+                {"dn": "uid=euler,dc=example,dc=com", "attributes": {"uid": ["euler"]}},
+            ])
+        delete.assert_not_called()
+        delete_many.assert_called_once()
+        self.assertEqual(list(delete_many.call_args.args[0]), [(("username", "tesla"),)])
+
+    def testCleanUsersIgnoresCachedMisses(self):
+        User.objects.create_user(username="tesla")
+        self.assertFalse(Connection(mock_search()).has_user(username="tesla"))
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]}))
+        with mock.patch("ldap3.Connection", return_value=c):
+            call_command("ldap_clean_users", verbosity=0)
+        self.assertTrue(User.objects.get(username="tesla").is_active)
+
+
+@override_settings(LDAP_AUTH_THROTTLE_USER_RATE=(2, 60), LDAP_AUTH_THROTTLE_CLIENT_RATE=(3, 60))
+class TestThrottle(SimpleTestCase):
+
+    def setUp(self):
+        super(TestThrottle, self).setUp()
+        cache.clear()
+
+    def authenticate(self, username, remote_addr="127.0.0.1"):
+        request = RequestFactory().post("/", REMOTE_ADDR=remote_addr)
+        return ldap.authenticate(request, username=username, password="password")
+
+    def testThrottlesFailedAttemptsByUser(self):
+        with mock.patch("ldap3.Connection") as ldap_connection:
+            ldap_connection.return_value.bind.side_effect = LDAPInvalidCredentialsResult()
+            self.assertIsNone(self.authenticate("tesla"))
+            self.assertIsNone(self.authenticate("tesla", "127.0.0.2"))
+            self.assertIsNone(self.authenticate("tesla", "127.0.0.3"))
+        self.assertEqual(ldap_connection.call_count, 2)
+
+    def testThrottlesFailedAttemptsByClient(self):
+        with mock.patch("ldap3.Connection") as ldap_connection:
+            ldap_connection.return_value.bind.side_effect = LDAPInvalidCredentialsResult()
+            for username in ("tesla", "euler", "gauss", "newton"):
+                self.assertIsNone(self.authenticate(username))
+        self.assertEqual(ldap_connection.call_count, 3)
+
+    def testDoesntThrottleSuccessfulAttempts(self):
+        with mock.patch("django_python3_ldap.ldap.Connection.get_user", return_value=mock.Mock()):
+            with mock.patch("ldap3.Connection"):
+                for _ in range(5):
+                    self.assertIsNotNone(self.authenticate("tesla"))
+
+    def testBoundsConcurrentAttempts(self):
+        barrier = threading.Barrier(20)
+        results = []
+
+        def attempt(index):
+            request = RequestFactory().post("/", REMOTE_ADDR="127.0.0.{index}".format(index=index))
+            barrier.wait()
+            results.append(throttle.acquire(request, {"username": "tesla"}))
+        threads = [threading.Thread(target=attempt, args=(index,)) for index in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(result is not None for result in results), 2)
+
+    def testFixedWindowBurst(self):
+        # A whole capacity can be taken at each side of a window boundary.
+        with mock.patch("django_python3_ldap.throttle.time.time", return_value=59.9):
+            self.assertIsNotNone(throttle.acquire(None, {"username": "tesla"}))
+            self.assertIsNotNone(throttle.acquire(None, {"username": "tesla"}))
+            self.assertIsNone(throttle.acquire(None, {"username": "tesla"}))
+        with mock.patch("django_python3_ldap.throttle.time.time", return_value=60.0):
+            self.assertIsNotNone(throttle.acquire(None, {"username": "tesla"}))
+            self.assertIsNotNone(throttle.acquire(None, {"username": "tesla"}))
+            self.assertIsNone(throttle.acquire(None, {"username": "tesla"}))
+
+    def testReleaseReturnsAttempt(self):
+        self.assertIsNotNone(throttle.acquire(None, {"username": "tesla"}))
+        throttle.release(throttle.acquire(None, {"username": "tesla"}))
+        self.assertIsNotNone(throttle.acquire(None, {"username": "tesla"}))
+        self.assertIsNone(throttle.acquire(None, {"username": "tesla"}))
+
+
+@override_settings(LDAP_AUTH_COALESCE_AUTHENTICATION=True)
+class TestCoalescing(SimpleTestCase):
+
+    def mock_authenticate(self):
+        calls = []
+        released = threading.Event()
+
+        def authenticate(*args, **kwargs):
+            calls.append(kwargs)
+            released.wait(5)
+            return {"username": kwargs["username"]}
+
+        return calls, released, authenticate
+
+    def testCoalescesConcurrentAuthentications(self):
+        calls, released, authenticate = self.mock_authenticate()
+        users = []
+        with mock.patch("django_python3_ldap.ldap._authenticate", side_effect=authenticate):
+            threads = [
+                threading.Thread(target=lambda: users.append(ldap.authenticate(username="tesla", password="password")))
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            released.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(users, [{"username": "tesla"}] * 5)
+        # Each caller gets its own copy of the user.
+        self.assertEqual(len({id(user) for user in users}), 5)
+
+    def testDoesntCoalesceDifferentPasswords(self):
+        calls, released, authenticate = self.mock_authenticate()
+        released.set()
+        with mock.patch("django_python3_ldap.ldap._authenticate", side_effect=authenticate):
+            threads = [
+                threading.Thread(target=ldap.authenticate, kwargs={"username": "tesla", "password": password})
+                for password in ("password", "wrong")
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 2)
+
+    def testCoalescesConcurrentAsyncAuthentications(self):
+        calls, released, authenticate = self.mock_authenticate()
+        released.set()
+
+        async def run():
+            return await asyncio.gather(*(
+                run_authentication_async(username="tesla", password="password")
+                for _ in range(3)
+            ))
+
+        with mock.patch("django_python3_ldap.ldap.authenticate", side_effect=authenticate):
+            users = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(users, [{"username": "tesla"}] * 3)
+
+
+@skipUnless(shutil.which("openssl"), "No openssl command for creating a test certificate.")
+class TestResumableTls(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestResumableTls, cls).setUpClass()
+        cls.cert_dir = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(cls.cert_dir.cleanup)
+        cert_file = os.path.join(cls.cert_dir.name, "cert.pem")
+        key_file = os.path.join(cls.cert_dir.name, "key.pem")
+        subprocess.run([
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+            "-keyout", key_file, "-out", cert_file,
+        ], check=True, capture_output=True)
+        cls.server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        cls.server_context.load_cert_chain(cert_file, key_file)
+
+    def serve(self, listener, count):
+        for _ in range(count):
+            sock, _ = listener.accept()
+            try:
+                with self.server_context.wrap_socket(sock, server_side=True) as server_socket:
+                    server_socket.recv(4)
+                    server_socket.sendall(b"pong")
+                    server_socket.recv(4)
+            except (OSError, ssl.SSLError):
+                pass
+
+    def connect(self, tls, port):
+        c = mock.Mock()
+        c.server.host = "localhost"
+        c.server.port = port
+        c.socket = socket.create_connection(("127.0.0.1", port))
+
+        def close_socket():
+            c.socket.close()
+            c.socket = None
+        c.strategy._close_socket = close_socket
+        tls.wrap_socket(c, do_handshake=True)
+        # Exchange a request and response, as the first LDAP operation on the connection would.
+        c.socket.sendall(b"ping")
+        c.socket.recv(4)
+        version, session_reused = c.socket.version(), c.socket.session_reused
+        c.strategy._close_socket()
+        return version, session_reused
+
+    def testResumesTls13Session(self):
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+            server_thread = threading.Thread(target=self.serve, args=(listener, 2))
+            server_thread.start()
+            tls = ResumableTls(validate=ssl.CERT_NONE)
+            port = listener.getsockname()[1]
+            self.assertEqual(self.connect(tls, port), ("TLSv1.3", False))
+            self.assertEqual(self.connect(tls, port), ("TLSv1.3", True))
+            server_thread.join(5)
+
+
+class TestWarmUp(SimpleTestCase):
+
+    def testSharesServersBetweenConnections(self):
+        self.assertIs(ldap._get_server_pool().servers[0], ldap._get_server_pool().servers[0])
+
+    @override_settings(LDAP_AUTH_USE_TLS=True)
+    def testUsesResumableTls(self):
+        server = ldap._get_server_pool().servers[0]
+        self.assertIsInstance(server.tls, ResumableTls)
+
+    @override_settings(LDAP_AUTH_URL=["ldap://ldap1.example.com", "ldap://ldap2.example.com"])
+    def testWarmUpConnectsToEachServer(self):
+        with mock.patch("ldap3.Connection") as ldap_connection:
+            ldap.warm_up()
+        self.assertEqual(
+            [call.args[0].host for call in ldap_connection.call_args_list],
+            ["ldap1.example.com", "ldap2.example.com"],
+        )
+        self.assertEqual(ldap_connection.return_value.bind.call_count, 2)
+        self.assertEqual(ldap_connection.return_value.unbind.call_count, 2)
+
+
+@override_settings(LDAP_AUTH_ATTRIBUTE_REFRESH_TTL=60)
+class TestAttributeRefresh(TestCase):
+
+    def setUp(self):
+        super(TestAttributeRefresh, self).setUp()
+        ldap._synced_cache.clear()
+
+    def testSkipsSearchForFreshUsers(self):
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"], "sn": ["Tesla"]}))
+        with mock.patch("ldap3.Connection", return_value=c):
+            user = ldap.authenticate(username="tesla", password="password")
+            User.objects.filter(pk=user.pk).update(last_name="Local")
+            self.assertEqual(ldap.authenticate(username="tesla", password="password").last_name, "Local")
+        self.assertEqual(c.search.call_count, 1)
+        self.assertEqual(c.bind.call_count, 2)
+
+    @override_settings(LDAP_AUTH_CONNECTION_USERNAME="admin", LDAP_AUTH_CONNECTION_PASSWORD="secret")
+    def testFreshLoginIsASingleBind(self):
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]}))
+        with mock.patch("ldap3.Connection", return_value=c):
+            ldap.authenticate(username="tesla", password="password")
+            self.assertEqual((c.bind.call_count, c.rebind.call_count), (1, 1))
+            self.assertIsNotNone(ldap.authenticate(username="tesla", password="password"))
+        self.assertEqual((c.bind.call_count, c.rebind.call_count), (2, 1))
+
+    @override_settings(
+        LDAP_AUTH_CONNECTION_USERNAME="admin",
+        LDAP_AUTH_CONNECTION_PASSWORD="secret",
+        LDAP_AUTH_SEARCH_BIND=True,
+    )
+    def testFreshSearchBindLoginIsASingleBind(self):
+        ldap._dn_cache.clear()
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]}))
+        with mock.patch("ldap3.Connection", return_value=c) as ldap_connection:
+            ldap.authenticate(username="tesla", password="password")
+            self.assertEqual((c.bind.call_count, c.rebind.call_count), (1, 2))
+            self.assertIsNotNone(ldap.authenticate(username="tesla", password="password"))
+        self.assertEqual((c.bind.call_count, c.rebind.call_count), (2, 2))
+        self.assertEqual(ldap_connection.call_args.kwargs["user"], "uid=tesla,dc=example,dc=com")
+
+    def testRefreshesDeletedUsers(self):
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]}))
+        with mock.patch("ldap3.Connection", return_value=c):
+            ldap.authenticate(username="tesla", password="password").delete()
+            self.assertIsNotNone(ldap.authenticate(username="tesla", password="password"))
+        self.assertEqual(c.search.call_count, 2)
+
+
+class TestBackgroundRefresh(TestCase):
+
+    def testRefreshPoolDeduplicatesJobs(self):
+        pool = RefreshPool()
+        released = threading.Event()
+        calls = []
+
+        def job():
+            calls.append(True)
+            released.wait(5)
+        self.assertTrue(pool.submit("tesla", job))
+        self.assertFalse(pool.submit("tesla", job))
+        released.set()
+        pool.join()
+        self.assertTrue(pool.submit("tesla", job))
+        pool.join()
+        self.assertEqual(len(calls), 2)
+        metrics = pool.get_metrics()
+        self.assertEqual(metrics["submitted"], 2)
+        self.assertEqual(metrics["completed"], 2)
+        self.assertEqual(metrics["deduplicated"], 1)
+        self.assertEqual(metrics["queued"], 0)
+
+    @override_settings(LDAP_AUTH_ATTRIBUTE_REFRESH_WORKERS=1, LDAP_AUTH_ATTRIBUTE_REFRESH_QUEUE_SIZE=1)
+    def testRefreshPoolDropsJobsWhenFull(self):
+        pool = RefreshPool()
+        released = threading.Event()
+        pool.submit("tesla", lambda: released.wait(5))
+        while not pool.get_metrics()["running"]:
+            time.sleep(0.01)
+        self.assertTrue(pool.submit("euler", lambda: None))
+        self.assertFalse(pool.submit("gauss", lambda: None))
+        released.set()
+        pool.join()
+        self.assertEqual(pool.get_metrics()["dropped"], 1)
+
+    @override_settings(LDAP_AUTH_ATTRIBUTE_REFRESH_BACKGROUND=True)
+    def testReturnsLocalUserAndRefreshesInBackground(self):
+        User.objects.create(username="tesla", last_name="Local")
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"], "sn": ["Tesla"]}))
+        with mock.patch("ldap3.Connection", return_value=c):
+            with mock.patch("django_python3_ldap.refresh.submit") as submit:
+                self.assertEqual(ldap.authenticate(username="tesla", password="password").last_name, "Local")
+            c.search.assert_not_called()
+            # Run the refresh job.
+            submit.call_args.args[1]()
+        self.assertEqual(User.objects.get(username="tesla").last_name, "Tesla")
+
+
+class TestWatchUsers(TestCase):
+
+    def setUp(self):
+        super(TestWatchUsers, self).setUp()
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.state_dir.name, "state.json")
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+        super(TestWatchUsers, self).tearDown()
+
+    def testDirSyncResumesFromCookie(self):
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"], "sn": ["Tesla"]}))
+        dir_sync = c.extend.microsoft.dir_sync.return_value
+        dir_sync.loop.return_value = [{"type": "searchResEntry", "dn": "<GUID=1>;uid=tesla,dc=example,dc=com"}]
+        dir_sync.cookie = b"cookie"
+        dir_sync.more_results = False
+        with mock.patch("ldap3.Connection", return_value=c):
+            call_command("ldap_watch_users", mode="dirsync", once=True, state=self.state_path, verbosity=0)
+            self.assertEqual(User.objects.get(username="tesla").last_name, "Tesla")
+            call_command("ldap_watch_users", mode="dirsync", once=True, state=self.state_path, verbosity=0)
+        self.assertEqual(c.extend.microsoft.dir_sync.call_args_list[0].kwargs["cookie"], None)
+        self.assertEqual(c.extend.microsoft.dir_sync.call_args_list[1].kwargs["cookie"], b"cookie")
+        self.assertEqual(c.extend.microsoft.dir_sync.call_args.kwargs["sync_base"], "dc=example,dc=com")
+
+    def testPersistentSearchCatchesUpFromLastChange(self):
+        c = mock_paged_search(
+            ("uid=tesla,dc=example,dc=com", {"uid": ["tesla"], "modifyTimestamp": ["20260101000000Z"]}),
+        )
+        with mock.patch("ldap3.Connection", return_value=c):
+            call_command("ldap_watch_users", once=True, state=self.state_path, verbosity=0)
+            call_command("ldap_watch_users", once=True, state=self.state_path, verbosity=0)
+        self.assertTrue(User.objects.filter(username="tesla").exists())
+        search_filters = [call.kwargs["search_filter"] for call in c.extend.standard.paged_search.call_args_list]
+        self.assertNotIn("modifyTimestamp", search_filters[0])
+        self.assertIn("(modifyTimestamp>=20260101000000Z)", search_filters[1])
+        c.extend.standard.persistent_search.assert_not_called()
+
+    def testNextBatchSkipsNonUserChanges(self):
+        command = load_command_class("django_python3_ldap", "ldap_watch_users")
+        search = mock.Mock()
+        search.next.side_effect = [
+            {"type": "searchResEntry", "dn": "cn=admins,dc=example,dc=com", "attributes": {"objectClass": ["group"]}},
+            {"type": "searchResEntry", "dn": "uid=tesla,dc=example,dc=com", "attributes": {
+                "objectClass": ["inetOrgPerson"], "uid": ["tesla"],
+            }},
+            {"type": "searchResEntry", "dn": "uid=euler,dc=example,dc=com", "changeType": "delete", "attributes": {
+                "objectClass": ["inetOrgPerson"], "uid": ["euler"],
+            }},
+            None,
+        ]
+        search.connection.closed = False
+        batch = command._next_batch([search], batch_size=10, batch_interval=0)
+        self.assertEqual([entry["dn"] for entry in batch], ["uid=tesla,dc=example,dc=com"])
+
+    @override_settings(LDAP_AUTH_SEARCH_BASE=[
+        "ou=sales,dc=example,dc=com",
+        ("ou=staff,dc=example,dc=com", "LEVEL"),
+    ])
+    def testNextBatchSkipsChangesOutsideSearchBases(self):
+        command = load_command_class("django_python3_ldap", "ldap_watch_users")
+        search = mock.Mock()
+        search.next.side_effect = [
+            {"type": "searchResEntry", "dn": dn, "attributes": {"objectClass": ["inetOrgPerson"], "uid": ["tesla"]}}
+            for dn in (
+                "uid=tesla,ou=xsales,dc=example,dc=com",
+                "uid=tesla,ou=eu,ou=staff,dc=example,dc=com",
+                "uid=tesla,OU=Sales, dc=example,dc=com",
+                "uid=tesla,ou=staff,dc=example,dc=com",
+            )
+        ]
+        batch = command._next_batch([search], batch_size=2, batch_interval=60)
+        self.assertEqual([entry["dn"] for entry in batch], [
+            "uid=tesla,OU=Sales, dc=example,dc=com",
+            "uid=tesla,ou=staff,dc=example,dc=com",
+        ])
+
+
+class TestCheck(SimpleTestCase):
+
+    def testPercentile(self):
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile([3, 1, 2, 4], 99), 4)
+        self.assertEqual(percentile([], 50), None)
+
+    @override_settings(LDAP_AUTH_URL=["ldap://ldap1.example.com", "ldap://ldap2.example.com"])
+    def testReportsTimingsAndCapabilities(self):
+        c = mock.Mock()
+        c.response = [{"attributes": {"supportedControl": ["1.2.840.113556.1.4.319"], "vendorName": ["Example"]}}]
+        stdout = StringIO()
+        with mock.patch("socket.getaddrinfo"), mock.patch("socket.create_connection"):
+            with mock.patch("ldap3.Connection", return_value=c):
+                call_command("ldap_check", "tesla", iterations=3, format="json", stdout=stdout)
+        servers = json.loads(stdout.getvalue())["servers"]
+        self.assertEqual(
+            [server["url"] for server in servers],
+            ["ldap://ldap1.example.com", "ldap://ldap2.example.com"],
+        )
+        self.assertEqual(set(servers[0]["timings"]), {"dns", "tcp", "connect", "bind", "search"})
+        self.assertTrue(servers[0]["capabilities"]["paged_results"])
+        self.assertFalse(servers[0]["capabilities"]["dirsync"])
+        self.assertEqual(servers[0]["capabilities"]["vendorName"], "Example")
+        self.assertEqual(c.bind.call_count, 8)
+
+    @override_settings(LDAP_AUTH_REFERRALS="ignore")
+    def testAppliesReferralSettings(self):
+        c = mock.Mock()
+        c.response = []
+        with mock.patch("socket.getaddrinfo"), mock.patch("socket.create_connection"), \
+                mock.patch("ldap3.Connection", return_value=c), \
+                mock.patch.object(referrals, "configure", wraps=referrals.configure) as configure:
+            call_command("ldap_check", "tesla", iterations=2, format="json", stdout=StringIO())
+        # Each probe, and the capabilities check, follows referrals as logins do.
+        self.assertEqual(configure.call_count, 3)
+        self.assertFalse(c.auto_referrals)
+
+    def testReportsErrors(self):
+        stdout = StringIO()
+        with mock.patch("socket.getaddrinfo", side_effect=OSError("Name or service not known")):
+            with mock.patch("ldap3.Connection"):
+                with self.assertRaises(CommandError):
+                    call_command("ldap_check", iterations=1, stdout=stdout)
+        self.assertIn("error: Name or service not known", stdout.getvalue())
+
+
+class TestBench(SimpleTestCase):
+
+    def bench(self, *args, **kwargs):
+        stdout = StringIO()
+        call_command("ldap_bench", *args, format="json", stdout=stdout, **kwargs)
+        return json.loads(stdout.getvalue())
+
+    def testBenchHasUser(self):
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]}))
+        with mock.patch("ldap3.Connection", return_value=c):
+            report = self.bench("tesla", operation="has_user", operations=10, concurrency=2)
+        self.assertEqual(report["operations"], 10)
+        self.assertEqual(report["outcomes"], {"ok": 10})
+        self.assertEqual(sum(bucket["count"] for bucket in report["histogram"]), 10)
+
+    def testBenchAuthenticateWithoutDatabase(self):
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]}))
+        c.bind.side_effect = [None, LDAPInvalidCredentialsResult()] * 3
+        with mock.patch("ldap3.Connection", return_value=c):
+            report = self.bench("tesla", password="password", operations=6, concurrency=3, asyncio=True, no_db=True)
+        self.assertEqual(report["outcomes"], {"ok": 3, "rejected": 3})
+
+    def testBenchAuthenticateRequiresPassword(self):
+        with self.assertRaises(CommandError):
+            self.bench("tesla", operations=1)
+
+
+class TestSlowLog(SimpleTestCase):
+
+    def testFilterFingerprint(self):
+        self.assertEqual(
+            slowlog.get_filter_fingerprint("(&(objectClass=*)(uid=te\\29sla)(mail=*@example.com)(cn>=a))"),
+            "(&(objectClass=*)(uid=?)(mail=?)(cn>=?))",
+        )
+
+    def testRateLimiter(self):
+        limiter = slowlog.RateLimiter()
+        self.assertEqual(limiter.acquire(2, 3600), (True, 0))
+        self.assertEqual(limiter.acquire(2, 3600), (True, 0))
+        self.assertEqual(limiter.acquire(2, 3600), (False, 0))
+        self.assertEqual(limiter.acquire(2, 3600), (False, 0))
+        with mock.patch("time.monotonic", return_value=time.monotonic() + 3600):
+            self.assertEqual(limiter.acquire(2, 3600), (True, 2))
+
+    @override_settings(LDAP_AUTH_SLOW_OPERATION_THRESHOLD=0)
+    def testLogsSlowSearches(self):
+        c = mock_search(("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]}))
+        c.server.name = "ldap://ldap.example.com:389"
+        with mock.patch.object(slowlog, "_rate_limiter", slowlog.RateLimiter()):
+            with self.assertLogs("django_python3_ldap.slowlog", "WARNING") as logs:
+                with slowlog.entry_point("test"):
+                    Connection(c).has_user(username="tesla")
+        record = logs.records[0]
+        self.assertEqual(record.ldap_operation, "search")
+        self.assertEqual(record.ldap_server, "ldap://ldap.example.com:389")
+        self.assertEqual(record.ldap_filter, "(&(uid=?)(objectClass=?))")
+        self.assertEqual(record.ldap_size, 1)
+        self.assertEqual(record.ldap_entry_point, "test")
+        self.assertNotIn("tesla", logs.output[0])
+
+    @override_settings(LDAP_AUTH_SLOW_OPERATION_THRESHOLD=0)
+    def testLogsSlowPages(self):
+        with mock.patch.object(slowlog, "_rate_limiter", slowlog.RateLimiter()):
+            with self.assertLogs("django_python3_ldap.slowlog", "WARNING") as logs:
+                self.assertEqual(list(slowlog.iter_timed_pages(mock.Mock(), range(5), 2, "(uid=*)")), list(range(5)))
+        self.assertEqual([record.ldap_size for record in logs.records], [2, 2, 1])
+
+    @override_settings(LDAP_AUTH_SLOW_OPERATION_THRESHOLD=0, LDAP_AUTH_SLOW_OPERATION_SAMPLE_RATE=0)
+    def testSamplesSlowOperations(self):
+        with mock.patch.object(slowlog.logger, "warning") as warning:
+            slowlog.record("bind", mock.Mock(), 1.0)
+        warning.assert_not_called()
+
+
+@override_settings(
+    LDAP_AUTH_DIRECTORIES={
+        "corp": {
+            "LDAP_AUTH_URL": ["ldap://corp.example.com"],
+            "LDAP_AUTH_SEARCH_BASE": "ou=people,dc=corp,dc=example,dc=com",
+        },
+    },
+    LDAP_AUTH_DIRECTORY_REALMS={"corp.example.com": "corp", "CORP": "corp"},
+)
+class TestDirectories(SimpleTestCase):
+
+    def testRoutesByRealm(self):
+        self.assertEqual(ldap.route_directory({"username": "tesla@CORP.example.com"}), "corp")
+        self.assertEqual(ldap.route_directory({"username": "corp\\tesla"}), "corp")
+        self.assertEqual(ldap.route_directory({"username": "tesla@example.com"}), None)
+        self.assertEqual(ldap.route_directory({"username": "tesla"}), None)
+
+    def testUsesDirectorySettings(self):
+        search_base = settings.LDAP_AUTH_SEARCH_BASE
+        object_class = settings.LDAP_AUTH_OBJECT_CLASS
+        with use_directory("corp"):
+            self.assertEqual(get_directory(), "corp")
+            self.assertEqual(settings.LDAP_AUTH_SEARCH_BASE, "ou=people,dc=corp,dc=example,dc=com")
+            # Settings not given for the directory fall back to the top-level settings.
+            self.assertEqual(settings.LDAP_AUTH_OBJECT_CLASS, object_class)
+        self.assertEqual(get_directory(), None)
+        self.assertEqual(settings.LDAP_AUTH_SEARCH_BASE, search_base)
+
+    def testRejectsUnknownDirectory(self):
+        with self.assertRaises(ImproperlyConfigured):
+            with use_directory("missing"):
+                pass
+
+    def testAuthenticatesAgainstRoutedDirectory(self):
+        hosts = []
+
+        def authenticate(*args, **kwargs):
+            hosts.append(ldap._get_server_pool().servers[0].host)
+
+        with mock.patch("django_python3_ldap.ldap._authenticate", side_effect=authenticate):
+            ldap.authenticate(username="tesla@corp.example.com", password="password")
+            ldap.authenticate(username="tesla", password="password")
+        self.assertEqual(hosts[0], "corp.example.com")
+        self.assertNotEqual(hosts[1], "corp.example.com")
+
+    def testSeparatesCacheKeysByDirectory(self):
+        with use_directory("corp"):
+            corp_key = ldap._get_lookup_cache_key({"username": "tesla"})
+        self.assertNotEqual(corp_key, ldap._get_lookup_cache_key({"username": "tesla"}))
+
+    def testCommandsUseDirectoryOption(self):
+        directories = []
+
+        def check(self, url, lookup, iterations):
+            directories.append((get_directory(), url))
+            return {"errors": []}
+        with mock.patch("django_python3_ldap.management.commands.ldap_check.Command._check", new=check):
+            call_command("ldap_check", directory="corp", format="json", stdout=StringIO())
+        self.assertEqual(directories, [("corp", "ldap://corp.example.com")])
+        with self.assertRaises(ImproperlyConfigured):
+            call_command("ldap_check", directory="missing", stdout=StringIO())
+
+    def testBenchUsesDirectoryOption(self):
+        directories = []
+
+        def has_user(self, **kwargs):
+            directories.append(get_directory())
+            return True
+        with mock.patch("ldap3.Connection"), mock.patch.object(Connection, "has_user", new=has_user):
+            call_command(
+                "ldap_bench", "tesla", operation="has_user", operations=4, concurrency=2, directory="corp",
+                format="json", stdout=StringIO(),
+            )
+        self.assertEqual(directories, ["corp"] * 4)
+
+
+@override_settings(LDAP_AUTH_HEDGE_SEARCHES=True, LDAP_AUTH_HEDGE_MIN_DELAY=0.01, LDAP_AUTH_HEDGE_BUDGET=1.0)
+class TestHedging(SimpleTestCase):
+
+    def setUp(self):
+        stats = hedge.HedgeStats()
+        for _ in range(hedge.MIN_SAMPLES):
+            stats.add_latency(0.001)
+        patcher = mock.patch("django_python3_ldap.hedge._stats", stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def slow(self, result):
+        def call():
+            time.sleep(0.2)
+            return result
+        return call
+
+    def testDoesntHedgeFastSearches(self):
+        secondary = mock.Mock()
+        self.assertEqual(hedge.call(lambda: "primary", secondary, mock.Mock(), mock.Mock()), ("primary", False))
+        secondary.assert_not_called()
+
+    def testHedgesSlowSearches(self):
+        discarded = threading.Event()
+        self.assertEqual(
+            hedge.call(self.slow("primary"), lambda: "secondary", discarded.set, mock.Mock()),
+            ("secondary", True),
+        )
+        # The losing primary search is discarded once it finishes.
+        self.assertTrue(discarded.wait(1))
+        self.assertEqual(hedge.get_metrics()["hedge_wins"], 1)
+
+    @override_settings(LDAP_AUTH_HEDGE_BUDGET=0.5)
+    def testLimitsHedgesToBudget(self):
+        self.assertEqual(hedge.call(self.slow("primary"), lambda: "secondary", mock.Mock(), mock.Mock()), (
+            "primary", False,
+        ))
+        self.assertEqual(hedge.get_metrics()["budget_exhausted"], 1)
+
+    @override_settings(LDAP_AUTH_URL=["ldap://ldap1.example.com", "ldap://ldap2.example.com"])
+    def testMovesConnectionToFasterServer(self):
+        primary = mock.Mock()
+        primary.server.name = "ldap://ldap1.example.com:389"
+        secondary = mock.Mock()
+
+        def search_user_base(connection, search_base, search_scope, search_filter):
+            if connection is primary:
+                time.sleep(0.2)
+            return {"dn": "uid=tesla", "attributes": {}}
+
+        c = Connection(primary)
+        with mock.patch.object(c, "_open_connection", return_value=secondary) as open_connection, \
+                mock.patch.object(c, "_search_user_base", side_effect=search_user_base):
+            self.assertEqual(c._search_user(username="tesla")["dn"], "uid=tesla")
+        # The hedged search goes to the other server in LDAP_AUTH_URL.
+        self.assertEqual(open_connection.call_args.args[0].name, "ldap://ldap2.example.com:389")
+        self.assertIs(c._connection, secondary)
+
+
+class TestConnectRace(SimpleTestCase):
+
+    def slow(self, result, delay=0.2):
+        def call():
+            time.sleep(delay)
+            return result
+        return call
+
+    def fail(self):
+        raise ValueError("unreachable")
+
+    def testKeepsFirstResult(self):
+        discarded = []
+        self.assertEqual(race([self.slow("slow"), lambda: "fast"], 0.01, discarded.append), "fast")
+        time.sleep(0.3)
+        self.assertEqual(discarded, ["slow"])
+
+    def testStartsNextAttemptAfterFailure(self):
+        start = time.monotonic()
+        self.assertEqual(race([self.fail, lambda: "ok"], 5, mock.Mock()), "ok")
+        self.assertLess(time.monotonic() - start, 1)
+
+    def testRaisesLastError(self):
+        with self.assertRaises(ValueError):
+            race([self.fail, self.fail], 0.01, mock.Mock())
+
+    @override_settings(LDAP_AUTH_URL=["ldap://ldap1.example.com", "ldap://ldap2.example.com"])
+    def testRacesEachAddressFamily(self):
+        servers = ldap._get_race_servers()
+        self.assertEqual(
+            sorted((server.host, server.mode) for server in servers),
+            sorted(
+                (host, mode)
+                for host in ("ldap1.example.com", "ldap2.example.com")
+                for mode in (ldap3.IP_V6_ONLY, ldap3.IP_V4_ONLY)
+            ),
+        )
+        self.assertEqual(servers[0].mode, ldap3.IP_V6_ONLY)
+
+    @override_settings(LDAP_AUTH_CONNECT_RACE=True, LDAP_AUTH_CONNECT_RACE_DELAY=0.01)
+    def testConnectsToFastestServer(self):
+        with mock.patch("ldap3.Connection") as ldap_connection:
+            ldap_connection.return_value.open.side_effect = [LDAPSocketOpenError("unreachable"), None]
+            with connection(username="tesla", password="password") as c:
+                self.assertIsNotNone(c)
+        self.assertEqual(ldap_connection.return_value.open.call_count, 2)
+        self.assertEqual(ldap_connection.return_value.bind.call_count, 1)
+
+
+class TestReferrals(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch("django_python3_ldap.referrals._counts", Counter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def configure(self, follow):
+        c = ldap3.Connection(ldap3.Server("ldap://ldap1.example.com"))
+        c.strategy.do_operation_on_referral = mock.Mock(side_effect=follow)
+        return referrals.configure(c)
+
+    @override_settings(LDAP_AUTH_REFERRALS="ignore")
+    def testIgnoresReferrals(self):
+        self.assertFalse(self.configure(None).auto_referrals)
+
+    @override_settings(LDAP_AUTH_REFERRALS="allowlist", LDAP_AUTH_REFERRAL_HOSTS=["dc2.example.com"])
+    def testAllowsListedHosts(self):
+        server = ldap._get_server("ldap://ldap1.example.com")
+        self.assertEqual(server.allowed_referral_hosts, [("dc2.example.com", True)])
+
+    def testFollowsAndCachesReferrals(self):
+        c = self.configure(lambda request, referrals: (["entry"], {"result": 0}))
+        self.assertTrue(c.use_referral_cache)
+        self.assertEqual(
+            c.strategy.do_operation_on_referral({}, ["ldap://dc2.example.com"]),
+            (["entry"], {"result": 0}),
+        )
+        self.assertEqual(referrals.get_metrics()["followed"], 1)
+
+    @override_settings(LDAP_AUTH_REFERRAL_HOP_LIMIT=1)
+    def testLimitsHops(self):
+        def follow(request, referrals):
+            # A referral connection that is referred again.
+            return c.strategy.do_operation_on_referral(request, referrals)
+
+        c = self.configure(follow)
+        self.assertEqual(c.strategy.do_operation_on_referral({}, ["ldap://dc2.example.com"]), (None, None))
+        self.assertEqual(referrals.get_metrics()["hop_limited"], 1)
+
+    @override_settings(LDAP_AUTH_REFERRAL_TIME_LIMIT=0.01)
+    def testLimitsTime(self):
+        def follow(request, referrals):
+            time.sleep(0.05)
+            return c.strategy.do_operation_on_referral(request, referrals)
+
+        c = self.configure(follow)
+        self.assertEqual(c.strategy.do_operation_on_referral({}, ["ldap://dc2.example.com"]), (None, None))
+        self.assertEqual(referrals.get_metrics()["time_limited"], 1)
+
+    @override_settings(LDAP_AUTH_REFERRAL_TIME_LIMIT=2)
+    def testLimitsReferralReceiveTimeout(self):
+        c = ldap3.Connection(ldap3.Server("ldap://ldap1.example.com"), receive_timeout=10)
+        referral_connection = mock.Mock(receive_timeout=1)
+        timeouts = []
+
+        def create_referral_connection(referrals):
+            # ldap3 opens the referral connection with the referring connection's receive timeout.
+            timeouts.append(c.receive_timeout)
+            return {}, referral_connection, ("dc2.example.com", 389, False)
+
+        def do_operation_on_referral(request, referrals):
+            return c.strategy.create_referral_connection(referrals)[1].response, None
+
+        c.strategy.create_referral_connection = create_referral_connection
+        c.strategy.do_operation_on_referral = do_operation_on_referral
+        referrals.configure(c)
+        c.strategy.do_operation_on_referral({}, ["ldap://dc2.example.com"])
+        self.assertLessEqual(timeouts[0], 2)
+        self.assertEqual(c.receive_timeout, 10)
+        self.assertEqual(referral_connection.receive_timeout, 10)
+        self.assertLessEqual(referral_connection.socket.settimeout.call_args.args[0], 2)
+
+    def testCountsReusedConnections(self):
+        c = self.configure(None)
+        referral_connection = mock.Mock()
+        c.strategy.referral_cache[("dc2.example.com", 389, False)] = referral_connection
+        with mock.patch.object(c.strategy, "create_referral_connection", mock.Mock(return_value=(
+            {}, referral_connection, ("dc2.example.com", 389, False),
+        ))):
+            referrals.configure(c)
+            c.strategy.create_referral_connection(["ldap://dc2.example.com"])
+        self.assertEqual(referrals.get_metrics()["reused"], 1)
+
+
+class TestLazyAttributes(SimpleTestCase):
+
+    def testSearchesAllAttributesByDefault(self):
+        self.assertEqual(get_user_search_attributes(), [ldap3.ALL_ATTRIBUTES])
+
+    @override_settings(
+        LDAP_AUTH_LAZY_ATTRIBUTES=["jpegPhoto"],
+        LDAP_AUTH_SEARCH_ATTRIBUTES=["uid", "memberOf", "JPEGPHOTO"],
+    )
+    def testLeavesOutLazyAttributes(self):
+        self.assertEqual(get_user_search_attributes(), ["uid", "memberOf"])
+
+    @override_settings(LDAP_AUTH_LAZY_ATTRIBUTES=["jpegPhoto"])
+    def testLazyAttributesRequireSearchAttributes(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_user_search_attributes()
+
+    def testFetchesOnFirstAccess(self):
+        c = mock_attribute_search({"jpegPhoto": [b"photo"]})
+        attribute = ldap.LazyAttribute(c, "uid=tesla,dc=example,dc=com", "jpegPhoto")
+        c.search.assert_not_called()
+        self.assertEqual(attribute.value, b"photo")
+        self.assertEqual(attribute.values, [b"photo"])
+        self.assertEqual(c.search.call_count, 1)
+        self.assertEqual(c.auto_ranges, [False])
+        self.assertEqual(attribute.get_digest(), ldap.LazyAttribute(
+            mock_attribute_search({"jpegPhoto": [b"photo"]}), "uid=tesla,dc=example,dc=com", "jpegPhoto",
+        ).get_digest())
+
+    def testDigestKeepsValues(self):
+        c = mock_attribute_search({"jpegPhoto": [b"photo"]})
+        attribute = ldap.LazyAttribute(c, "uid=tesla,dc=example,dc=com", "jpegPhoto")
+        attribute.get_digest()
+        self.assertEqual(attribute.value, b"photo")
+        attribute.get_digest()
+        self.assertEqual(c.search.call_count, 1)
+
+    def testComparesModifyTimestamp(self):
+        attribute = ldap.LazyAttribute(mock.Mock(), "uid=tesla,dc=example,dc=com", "jpegPhoto", ["20240101000000Z"])
+        self.assertFalse(attribute.is_modified_since("20240101000000Z"))
+        self.assertTrue(attribute.is_modified_since("20230101000000Z"))
+        self.assertTrue(attribute.is_modified_since(None))
+
+    @override_settings(LDAP_AUTH_LAZY_ATTRIBUTES=["jpegPhoto"])
+    def testPassesLazyAttributesToSyncUserRelations(self):
+        synced = {}
+
+        def sync_user_relations(user, ldap_attributes):
+            synced.update(ldap_attributes)
+
+        with mock.patch("django_python3_ldap.utils.sync_user_relations", new=sync_user_relations):
+            Connection(mock_attribute_search({"jpegPhoto": [b"photo"]}))._sync_user_relations(None, {
+                "dn": "uid=tesla,dc=example,dc=com",
+                "attributes": {"uid": ["tesla"]},
+            })
+        self.assertIsInstance(synced["jpegPhoto"], ldap.LazyAttribute)
+        self.assertEqual(synced["jpegPhoto"].value, b"photo")
+
+
+class TestSchemaCache(SimpleTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        patcher = override_settings(LDAP_AUTH_SCHEMA_CACHE_DIR=self.cache_dir.name)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def attach_offline_schema(self, server, connection):
+        # ldap3 servers also call this without a connection when they're created.
+        if connection is None:
+            return
+        server.attach_dsa_info(DsaInfo.from_json(slapd_2_4_dsa_info))
+        server.attach_schema_info(SchemaInfo.from_json(slapd_2_4_schema))
+
+    def wait_for_fetches(self):
+        for thread in threading.enumerate():
+            if thread.name == "django_python3_ldap.schema":
+                thread.join(5)
+
+    def testFetchesAndPersistsSchema(self):
+        with mock.patch("django_python3_ldap.ldap.open_query_connection") as open_query_connection, \
+                mock.patch("ldap3.Server.get_info_from_server", autospec=True, side_effect=self.attach_offline_schema):
+            server = ldap._get_server("ldap://schema1.example.com")
+            self.wait_for_fetches()
+        open_query_connection.assert_called_once_with(server)
+        self.assertIsNotNone(server.schema)
+        self.assertEqual(server.get_info, ldap3.NONE)
+        self.assertTrue(all(os.path.exists(path) for path in schema.get_cache_paths(server)))
+        self.assertEqual(sorted(os.listdir(self.cache_dir.name)), [
+            "schema1.example.com-389.info.json",
+            "schema1.example.com-389.schema.json",
+        ])
+
+    def testLoadsPersistedSchema(self):
+        with mock.patch("django_python3_ldap.ldap.open_query_connection"), \
+                mock.patch("ldap3.Server.get_info_from_server", autospec=True, side_effect=self.attach_offline_schema):
+            ldap._get_server("ldap://schema2.example.com")
+            self.wait_for_fetches()
+        server = ldap3.Server("ldap://schema2.example.com")
+        self.assertTrue(schema.load(server))
+        self.assertIn("inetOrgPerson", server.schema.object_classes)
+
+    @override_settings(LDAP_AUTH_SCHEMA_CACHE_TTL=0)
+    def testAttachesStaleSchema(self):
+        server = ldap3.Server("ldap://schema3.example.com")
+        self.attach_offline_schema(server, mock.Mock())
+        for path, info in zip(schema.get_cache_paths(server), (server.info, server.schema)):
+            with open(path, "w") as cache_file:
+                cache_file.write(info.to_json())
+            os.utime(path, (time.time() - 10, time.time() - 10))
+        server = ldap3.Server("ldap://schema3.example.com")
+        self.assertFalse(schema.load(server))
+        self.assertIsNotNone(server.schema)
+
+    def testIgnoresCorruptSchema(self):
+        for path in schema.get_cache_paths(ldap3.Server("ldap://schema4.example.com")):
+            with open(path, "w") as cache_file:
+                cache_file.write('{"raw": {"objectClass"')
+        server = ldap3.Server("ldap://schema4.example.com")
+        with self.assertLogs("django_python3_ldap.schema", "WARNING"):
+            self.assertFalse(schema.load(server))
+        self.assertIsNone(server.schema)
+        with mock.patch("django_python3_ldap.ldap.open_query_connection", side_effect=LDAPSocketOpenError("down")), \
+                self.assertLogs("django_python3_ldap.schema", "WARNING"):
+            server = ldap._get_server("ldap://schema4.example.com")
+            self.wait_for_fetches()
+        self.assertIsNone(server.schema)
+
+    def testFetchesOncePerServer(self):
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def get_info_from_server(server, connection):
+            if connection is None:
+                return
+            fetching.set()
+            release.wait(5)
+            self.attach_offline_schema(server, connection)
+
+        with mock.patch("django_python3_ldap.ldap.open_query_connection") as open_query_connection, \
+                mock.patch("ldap3.Server.get_info_from_server", autospec=True, side_effect=get_info_from_server):
+            servers = [
+                ldap._get_server("ldap://schema5.example.com", mode)
+                for mode in (ldap3.IP_V6_ONLY, ldap3.IP_V4_ONLY)
+            ]
+            # The fetch doesn't hold up the servers.
+            self.assertTrue(fetching.wait(5))
+            self.assertIsNone(servers[1].schema)
+            release.set()
+            self.wait_for_fetches()
+        self.assertEqual(open_query_connection.call_count, 1)
+        self.assertTrue(all(server.schema is not None for server in servers))
+
+
+class TestCompactSync(TestCase):
+
+    pages = (
+        (
+            ("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]}),
+            ("uid=euler,dc=example,dc=com", {"UID": ["euler"]}),
+        ),
+        (("uid=gauss,dc=example,dc=com", {"uid": ["gauss"]}),),
+    )
+
+    def testUserRecord(self):
+        record = ldap.UserRecord("uid=tesla,dc=example,dc=com", {"uid": ["tesla"]})
+        self.assertEqual(record["dn"], "uid=tesla,dc=example,dc=com")
+        self.assertEqual(record.get("attributes"), {"uid": ["tesla"]})
+        self.assertIsNone(record.get("raw_attributes"))
+        with self.assertRaises(KeyError):
+            record["raw_attributes"]
+        with self.assertRaises(AttributeError):
+            record.raw_attributes = {}
+
+    def testGetMemoryUsage(self):
+        self.assertGreater(get_memory_usage(), 0)
+
+    @override_settings(LDAP_AUTH_SEARCH_ATTRIBUTES=["uid", "memberOf"])
+    def testIterUserRecords(self):
+        c = mock_paged_pages(*self.pages)
+        records = list(Connection(c).iter_user_records(lambda: 2))
+        self.assertEqual([record.dn.split(",")[0] for record in records], ["uid=tesla", "uid=euler", "uid=gauss"])
+        self.assertEqual(records[1].attributes["uid"], ["euler"])
+        self.assertEqual(c.page_sizes, [2, 2])
+        # The same attributes are fetched as by a normal sync.
+        self.assertEqual(c.search.call_args.kwargs["attributes"], ["uid", "memberOf"])
+        self.assertTrue(c.search.call_args.kwargs["get_operational_attributes"])
+        self.assertIsNone(c.response)
+
+    def testMemoryBudget(self):
+        budget = MemoryBudget(100, 1000)
+        with mock.patch("django_python3_ldap.management.commands.ldap_sync_users.get_memory_usage", return_value=2000):
+            budget.adjust()
+            self.assertEqual(budget.size, 50)
+            for _ in range(10):
+                budget.adjust()
+            self.assertEqual(budget.size, 10)
+        with mock.patch("django_python3_ldap.management.commands.ldap_sync_users.get_memory_usage", return_value=100):
+            for _ in range(10):
+                budget.adjust()
+            self.assertEqual(budget.size, 100)
+
+    @override_settings(LDAP_AUTH_SEARCH_ATTRIBUTES=["uid"])
+    def testSyncUsersCompact(self):
+        out = StringIO()
+        with patch_connection(mock_paged_pages(*self.pages)):
+            call_command("ldap_sync_users", memory_limit=1024 * 1024, batch_size=2, stderr=out, stdout=StringIO())
+        self.assertEqual(sorted(User.objects.values_list("username", flat=True)), ["euler", "gauss", "tesla"])
+        self.assertRegex(out.getvalue(), r"Peak memory: [0-9.]+ MB")
+
+    @override_settings(LDAP_AUTH_SEARCH_ATTRIBUTES=["UID", "givenname", "SN"])
+    def testSyncUsersCompactWithMixedCaseAttributes(self):
+        pages = ((
+            ("uid=tesla,dc=example,dc=com", {"uid": ["tesla"], "GIVENNAME": ["Nikola"], "sn": ["Tesla"]}),
+        ),)
+        with patch_connection(mock_paged_pages(*pages)):
+            call_command("ldap_sync_users", compact=True, stderr=StringIO(), stdout=StringIO())
+        user = User.objects.get(username="tesla")
+        self.assertEqual((user.first_name, user.last_name), ("Nikola", "Tesla"))
+
+    def testSyncUsersCompactRequiresSearchAttributes(self):
+        with patch_connection(mock_paged_pages(*self.pages)) as ldap_connection, \
+                self.assertRaisesMessage(CommandError, "LDAP_AUTH_SEARCH_ATTRIBUTES"):
+            call_command("ldap_sync_users", compact=True, stdout=StringIO())
+        ldap_connection.assert_not_called()
+
+    @override_settings(LDAP_AUTH_SEARCH_ATTRIBUTES=["uid"])
+    def testSyncUsersCompactWithWorkers(self):
+        for options in ({"compact": True}, {"memory_limit": 256}):
+            with self.subTest(options=options), self.assertRaisesMessage(CommandError, "--workers"):
+                call_command("ldap_sync_users", workers=2, stdout=StringIO(), **options)
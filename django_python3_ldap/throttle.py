@@ -0,0 +1,105 @@
+"""
+Fixed window throttling of LDAP authentication attempts.
+"""
+
+import hashlib
+import time
+
+from django.core.cache import caches
+
+from django_python3_ldap.conf import settings
+from django_python3_ldap.utils import import_func
+
+
+def get_client_ip(request):
+    """
+    Returns the client key for a request, used to throttle
+    authentication attempts by source.
+    """
+    return request.META.get("REMOTE_ADDR")
+
+
+def _get_buckets(request, user_lookup):
+    """
+    Returns a list of (cache_key, capacity, period) tuples for the
+    throttle buckets that apply to an authentication attempt.
+    """
+    buckets = []
+    if settings.LDAP_AUTH_THROTTLE_USER_RATE:
+        buckets.append(("user", repr(sorted(user_lookup.items())), settings.LDAP_AUTH_THROTTLE_USER_RATE))
+    if settings.LDAP_AUTH_THROTTLE_CLIENT_RATE and request is not None:
+        client_key = import_func(settings.LDAP_AUTH_THROTTLE_CLIENT_KEY)(request)
+        if client_key:
+            buckets.append(("client", str(client_key), settings.LDAP_AUTH_THROTTLE_CLIENT_RATE))
+    return [
+        (
+            "django_python3_ldap.throttle:{kind}:{digest}".format(
+                kind=kind,
+                digest=hashlib.sha256(key.encode("utf-8")).hexdigest(),
+            ),
+            capacity,
+            period,
+        )
+        for kind, key, (capacity, period)
+        in buckets
+    ]
+
+
+def _get_window_key(cache_key, period, now):
+    """
+    Returns the cache key of the counter for the fixed window of `period` seconds containing `now`.
+    """
+    return "{cache_key}:{window}".format(cache_key=cache_key, window=int(now // period))
+
+
+def _incr(cache, key, period):
+    """
+    Atomically increments a window counter, creating it if needed, and returns its new value.
+    """
+    for _ in range(2):
+        cache.add(key, 0, period)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # The counter was evicted between add() and incr(), so create it again.
+            continue
+    return cache.incr(key)
+
+
+def acquire(request, user_lookup):
+    """
+    Counts an authentication attempt in each window that applies to it.
+
+    Returns a list of the window counter keys taken, or None if any window is already
+    at capacity, in which case no attempt is counted. The counters live in the Django
+    cache, so they are shared between processes, and are updated with the cache's
+    atomic add() and incr(), so concurrent attempts can't exceed the capacity.
+
+    As windows are fixed, up to twice the capacity can be taken within one period,
+    across a window boundary.
+    """
+    buckets = _get_buckets(request, user_lookup)
+    cache = caches[settings.LDAP_AUTH_THROTTLE_CACHE_ALIAS]
+    now = time.time()
+    taken = []
+    for cache_key, capacity, period in buckets:
+        key = _get_window_key(cache_key, period, now)
+        taken.append(key)
+        if _incr(cache, key, period) > capacity:
+            release(taken)
+            return None
+    return taken
+
+
+def release(keys):
+    """
+    Uncounts an authentication attempt from the window counters returned by acquire(),
+    so only failed attempts are throttled.
+    """
+    cache = caches[settings.LDAP_AUTH_THROTTLE_CACHE_ALIAS]
+    for key in keys:
+        try:
+            cache.decr(key)
+        except ValueError:
+            # The window has expired.
+            pass
@@ -0,0 +1,69 @@
+"""
+TLS session resumption for LDAP connections.
+"""
+
+import ssl
+import threading
+
+import ldap3
+from ldap3.core.tls import check_hostname
+
+
+class ResumableTls(ldap3.Tls):
+
+    """
+    An ldap3.Tls that reuses one SSL context, and resumes the TLS session
+    of the previous connection to the same server.
+
+    A resumed session skips the certificate exchange and key agreement of
+    a full handshake, saving a round trip and the server's signing cost.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ResumableTls, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._ssl_context = None
+        self._sessions = {}  # (host, port) -> ssl.SSLSession
+
+    def _save_session(self, key, wrapped_socket):
+        try:
+            session = wrapped_socket.session
+        except (OSError, ValueError):
+            return
+        if session is not None:
+            with self._lock:
+                self._sessions[key] = session
+
+    def wrap_socket(self, connection, do_handshake=False):
+        """
+        Adds TLS to the connection socket, resuming the last session with the server.
+
+        The socket is wrapped by ldap3, then moved to the shared SSL context, as a session
+        can only be resumed by the context that created it. The session is saved when the
+        connection is closed, as TLS 1.3 servers only send a resumable session ticket
+        after the handshake, with the first response.
+        """
+        super(ResumableTls, self).wrap_socket(connection, do_handshake=False)
+        wrapped_socket = connection.socket
+        key = (connection.server.host, connection.server.port)
+        with self._lock:
+            if self._ssl_context is None:
+                self._ssl_context = wrapped_socket.context
+            ssl_context = self._ssl_context
+            session = self._sessions.get(key)
+        if wrapped_socket.context is not ssl_context:
+            wrapped_socket.context = ssl_context
+        if session is not None:
+            wrapped_socket.session = session
+        if do_handshake:
+            wrapped_socket.do_handshake()
+            if self.validate in (ssl.CERT_REQUIRED, ssl.CERT_OPTIONAL):
+                check_hostname(wrapped_socket, connection.server.host, self.valid_names)
+        close_socket = connection.strategy._close_socket
+
+        def close():
+            if connection.socket is wrapped_socket:
+                self._save_session(key, wrapped_socket)
+            close_socket()
+
+        connection.strategy._close_socket = close
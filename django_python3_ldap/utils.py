@@ -4,17 +4,36 @@ Some useful LDAP utilities.
 
 import re
 import binascii
+import contextvars
 import itertools
+import math
+import os
+import queue
+import string
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timezone
+
+import ldap3
+from ldap3.core.exceptions import LDAPInvalidDnError
+from ldap3.utils.dn import parse_dn
 
 try:
     from django.utils.encoding import force_str
 except ImportError:
     from django.utils.encoding import force_text as force_str
 
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.module_loading import import_string
 
 from django_python3_ldap.conf import settings
 
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
 
 def import_func(func):
     if callable(func):
@@ -36,6 +55,82 @@ def clean_ldap_name(name):
     )
 
 
+def get_search_bases():
+    """
+    Returns a list of (search_base, search_scope) tuples for the
+    LDAP_AUTH_SEARCH_BASE setting.
+
+    The setting may be a single DN, or a list of DNs and (DN, search_scope) tuples.
+    The default search scope is SUBTREE.
+    """
+    search_bases = settings.LDAP_AUTH_SEARCH_BASE
+    if not isinstance(search_bases, list):
+        search_bases = [search_bases]
+    return [
+        (search_base, ldap3.SUBTREE) if isinstance(search_base, str) else tuple(search_base)
+        for search_base
+        in search_bases
+    ]
+
+
+def _parse_rdns(dn):
+    """
+    Returns the RDNs of a DN, most specific first, each as a tuple of lower-cased (type, value) pairs.
+    """
+    rdns = []
+    rdn = []
+    for attribute_type, value, separator in parse_dn(dn, strip=True):
+        rdn.append((attribute_type.lower(), value.lower()))
+        # Multi-valued RDNs are joined with "+".
+        if separator != "+":
+            rdns.append(tuple(sorted(rdn)))
+            rdn = []
+    return rdns
+
+
+def is_in_search_base(dn, search_base, search_scope):
+    """
+    Returns True if the given DN is within the search base and scope.
+
+    DNs are compared RDN by RDN, so "ou=xsales,dc=example,dc=com" is not in
+    "ou=sales,dc=example,dc=com", and a LEVEL scope only matches direct children.
+    """
+    try:
+        dn_rdns = _parse_rdns(dn)
+        base_rdns = _parse_rdns(search_base)
+    except LDAPInvalidDnError:
+        return False
+    depth = len(dn_rdns) - len(base_rdns)
+    if depth < 0 or dn_rdns[depth:] != base_rdns:
+        return False
+    if search_scope == ldap3.BASE:
+        return depth == 0
+    if search_scope == ldap3.LEVEL:
+        return depth == 1
+    return True
+
+
+def get_user_search_attributes():
+    """
+    Returns the list of attributes to fetch in user searches.
+
+    This is LDAP_AUTH_SEARCH_ATTRIBUTES, or all attributes if it is None, without
+    LDAP_AUTH_LAZY_ATTRIBUTES. As an LDAP search can't exclude attributes, lazy
+    attributes require LDAP_AUTH_SEARCH_ATTRIBUTES to list the attributes to fetch.
+    """
+    lazy_attributes = {name.lower() for name in settings.LDAP_AUTH_LAZY_ATTRIBUTES}
+    attributes = settings.LDAP_AUTH_SEARCH_ATTRIBUTES
+    if attributes is None:
+        if lazy_attributes:
+            raise ImproperlyConfigured(
+                "LDAP_AUTH_LAZY_ATTRIBUTES requires LDAP_AUTH_SEARCH_ATTRIBUTES to list the attributes "
+                "fetched by user searches, including any used by LDAP_AUTH_SYNC_USER_RELATIONS "
+                "and LDAP_AUTH_CLEAN_USER_DATA"
+            )
+        return [ldap3.ALL_ATTRIBUTES]
+    return [name for name in attributes if name.lower() not in lazy_attributes]
+
+
 def convert_model_fields_to_ldap_fields(model_fields):
     """
     Converts a set of model fields into a set of corresponding
@@ -81,7 +176,7 @@ def format_username_openldap(model_fields):
             for field_name, field_value
             in convert_model_fields_to_ldap_fields(model_fields).items()
         ),
-        search_base=settings.LDAP_AUTH_SEARCH_BASE,
+        search_base=get_search_bases()[0][0],
     )
 
 
@@ -113,6 +208,33 @@ def format_username_active_directory_principal(model_fields):
     return username
 
 
+def route_directory_by_realm(user_lookup):
+    """
+    Returns the name of the directory in LDAP_AUTH_DIRECTORIES for a user identifier,
+    by matching the realm of a `user@realm` or `REALM\\user` lookup value against
+    LDAP_AUTH_DIRECTORY_REALMS. Returns None to use the default directory.
+    """
+    realms = {
+        realm.lower(): name
+        for realm, name
+        in settings.LDAP_AUTH_DIRECTORY_REALMS.items()
+    }
+    if not realms:
+        return None
+    for value in user_lookup.values():
+        if not isinstance(value, str):
+            continue
+        if "\\" in value:
+            realm = value.split("\\", 1)[0]
+        elif "@" in value:
+            realm = value.rsplit("@", 1)[1]
+        else:
+            continue
+        if realm.lower() in realms:
+            return realms[realm.lower()]
+    return None
+
+
 def sync_user_relations(user, ldap_attributes, *, connection=None, dn=None):
     # do nothing by default
     pass
@@ -143,3 +265,258 @@ def group_lookup_args(*args):
         for i in range(fields_len):
             lookup[settings.LDAP_AUTH_USER_LOOKUP_FIELDS[i]] = chunk[i]
         yield lookup
+
+
+def iter_batches(iterable, batch_size):
+    """
+    Yields the given iterable as a series of lists, each containing at most `batch_size` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def format_sync_shard_filters():
+    """
+    Returns a list of LDAP search filters that partition the users in the
+    LDAP database into shards, for enumerating them in parallel.
+
+    By default, users are sharded by the first character of the LDAP attribute
+    of the first lookup field, with a final shard for all other users.
+    """
+    if settings.LDAP_AUTH_SYNC_SHARD_FILTERS:
+        return list(settings.LDAP_AUTH_SYNC_SHARD_FILTERS)
+    attribute_name = clean_ldap_name(settings.LDAP_AUTH_USER_FIELDS[settings.LDAP_AUTH_USER_LOOKUP_FIELDS[0]])
+    search_filters = [
+        "({attribute_name}={prefix}*)".format(
+            attribute_name=attribute_name,
+            prefix=prefix,
+        )
+        for prefix
+        in string.ascii_lowercase + string.digits
+    ]
+    search_filters.append("(!(|{search_filters}))".format(
+        search_filters="".join(search_filters),
+    ))
+    return search_filters
+
+
+def iter_threaded(funcs, maxsize=0):
+    """
+    Yields the items from the iterables returned by the given functions,
+    calling each function in its own thread.
+
+    Items are passed to the caller through a queue holding at most `maxsize` items,
+    so the threads block when the caller falls behind. An exception raised in a thread
+    is re-raised in the caller. If the caller stops iterating, the threads are stopped.
+
+    The iterables must not contain None.
+    """
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(message):
+        while not stopped.is_set():
+            try:
+                items.put(message, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def run(func):
+        try:
+            for item in func():
+                if not put((item, None)):
+                    return
+        except BaseException as ex:
+            put((None, ex))
+        finally:
+            put((None, None))
+
+    threads = [
+        threading.Thread(target=contextvars.copy_context().run, args=(run, func), daemon=True)
+        for func
+        in funcs
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            item, ex = items.get()
+            if ex is not None:
+                raise ex
+            if item is None:
+                running -= 1
+            else:
+                yield item
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+
+def first_result(funcs):
+    """
+    Calls the given functions concurrently, returning the first result that is not None.
+
+    Functions still running when a result is found are left to finish in the background,
+    and functions not yet started are cancelled. If no function returns a result, the first
+    exception raised, if any, is re-raised.
+    """
+    executor = ThreadPoolExecutor(max_workers=len(funcs))
+    try:
+        futures = [
+            executor.submit(contextvars.copy_context().run, func)
+            for func
+            in funcs
+        ]
+        error = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as ex:
+                error = error or ex
+                continue
+            if result is not None:
+                return result
+        if error is not None:
+            raise error
+        return None
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def race(funcs, delay, discard):
+    """
+    Calls the given functions concurrently, starting each one `delay` seconds after the
+    previous one, or as soon as all running functions have failed. Returns the first result.
+
+    Functions still running when a result is found are left to finish in the background,
+    then discard is called with their results. Functions not yet started are skipped. If
+    every function fails, the last exception is re-raised.
+    """
+    executor = ThreadPoolExecutor(max_workers=len(funcs))
+    pending = set()
+    results = []
+    error = None
+
+    def collect(done):
+        nonlocal error
+        for future in done:
+            try:
+                results.append(future.result())
+            except Exception as ex:
+                error = ex
+
+    try:
+        for func in funcs:
+            pending.add(executor.submit(contextvars.copy_context().run, func))
+            while pending and not results:
+                done, pending = wait(pending, timeout=delay, return_when=FIRST_COMPLETED)
+                collect(done)
+                # Start the next function once the delay has passed, or nothing is running.
+                if not done:
+                    break
+            if results:
+                break
+        while pending and not results:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+        if not results:
+            raise error
+        for result in results[1:]:
+            discard(result)
+        return results[0]
+    finally:
+        for future in pending:
+            future.add_done_callback(lambda future: future.exception() is None and discard(future.result()))
+        executor.shutdown(wait=False)
+
+
+class SingleFlight(object):
+
+    """
+    Coalesces concurrent calls with the same key into a single
+    call, whose result is shared by all callers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def call(self, key, func):
+        """
+        Calls the given function, unless a call with the same key is already in progress,
+        in which case waits for that call to finish instead.
+
+        Returns a tuple of (result, shared), where shared is True if the result
+        came from another caller's call.
+        """
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = {"done": threading.Event()}
+        if not leader:
+            flight["done"].wait()
+            if "error" in flight:
+                raise flight["error"]
+            return flight["result"], True
+        try:
+            flight["result"] = func()
+        except BaseException as ex:
+            flight["error"] = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            flight["done"].set()
+        return flight["result"], False
+
+
+def format_generalized_time(value):
+    """
+    Formats a timestamp attribute value, such as modifyTimestamp, as an LDAP generalized time.
+    """
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime("%Y%m%d%H%M%SZ")
+    return value
+
+
+def percentile(values, percent):
+    """
+    Returns the nearest-rank percentile of a list of numbers, or None if it is empty.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+
+def get_memory_usage():
+    """
+    Returns the resident memory of this process in bytes, or None if it can't be read.
+    """
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def get_peak_memory_usage():
+    """
+    Returns the peak resident memory of this process in bytes, or None if it can't be read.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, and other platforms kilobytes.
+    return peak if sys.platform == "darwin" else peak * 1024